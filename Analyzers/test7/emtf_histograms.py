@@ -0,0 +1,347 @@
+"""Histograms filled with NumPy, and written as ROOT histograms at the end.
+
+NumpyHist and NumpyHist2D take the same arguments as rootpy Hist and Hist2D,
+and provide the methods used by the analyses (fill, FindBin, FindFixBin,
+GetBinCenter, GetBinContent, GetNbinsX, Write). fill() only appends the values
+to a buffer, which is binned with np.bincount when it is full or when the
+contents are needed, instead of calling ROOT for every entry. fill_array()
+bins whole arrays at once.
+
+The bins follow ROOT: 0 is the underflow, nbins+1 is the overflow, and the bin
+of a 2D histogram is binx + (nbinsx+2) * biny. A value falls in the same bin as
+with TAxis::FindFixBin(). The contents are plain arrays, so histograms from
+different jobs can be added with add(). When written, the mean and RMS of the
+ROOT histogram are computed from the bin contents.
+
+HistogramRegistry holds the histograms of an analysis by name. The histograms
+are declared once with book(), a registry can be merged with another one, and
+it is saved to a .npz file or to a ROOT file. The .npz files written by the
+condor jobs are merged without hadd:
+
+  python emtf_histograms.py histos_tbb.root histos_tbb_*.npz
+"""
+
+import numpy as np
+
+import json
+import sys
+from collections import OrderedDict
+
+
+# ______________________________________________________________________________
+class NumpyAxis(object):
+  def __init__(self, nbins, low=None, high=None):
+    if low is None:
+      # Variable bins, nbins are the bin edges
+      self.edges = np.asarray(nbins, dtype=np.float64)
+      self.nbins = len(self.edges) - 1
+      self.fixed = False
+    else:
+      self.nbins = int(nbins)
+      self.edges = np.linspace(float(low), float(high), num=self.nbins+1)
+      self.fixed = True
+    self.xmin = float(self.edges[0])
+    self.xmax = float(self.edges[-1])
+
+  def find_bins(self, x):
+    # Same as TAxis::FindFixBin()
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+      if self.fixed:
+        b = 1 + np.floor(self.nbins * (x - self.xmin) / (self.xmax - self.xmin))
+        b = np.where((self.xmin <= x) & (x < self.xmax), b, 0).astype(np.int64)
+      else:
+        b = np.searchsorted(self.edges, x, side='right')
+      b[x < self.xmin] = 0
+      b[~(x < self.xmax)] = self.nbins + 1  # including NaN
+    return b
+
+  def find_bin(self, x):
+    return int(self.find_bins([x])[0])
+
+  def bin_center(self, b):
+    # Same as TAxis::GetBinCenter()
+    if not self.fixed and (1 <= b <= self.nbins):
+      return 0.5 * (self.edges[b-1] + self.edges[b])
+    binwidth = (self.xmax - self.xmin) / float(self.nbins)
+    return self.xmin + (b-1) * binwidth + 0.5 * binwidth
+
+# Storage of the bin contents, by ROOT histogram type
+root_types = {'C': np.int8, 'S': np.int16, 'I': np.int32, 'F': np.float32, 'D': np.float64}
+
+def parse_axes(args, ndim=None):
+  # Splits the rootpy arguments into axes, e.g. (nbins, low, high) or (edges,)
+  axes = []
+  args = list(args)
+  while args and (ndim is None or len(axes) < ndim):
+    if np.ndim(args[0]) == 1:
+      axes.append(NumpyAxis(args.pop(0)))
+    else:
+      axes.append(NumpyAxis(*args[:3]))
+      args = args[3:]
+  assert(not args)
+  return axes
+
+class NumpyHistBase(object):
+  def __init__(self, args, kwargs, ndim):
+    self.args = args
+    self.kwargs = dict(kwargs)
+    self.buffer_size = self.kwargs.pop('buffer_size', 10000)
+    self.name = self.kwargs.get('name', None)
+    self.axes = parse_axes(args, ndim)
+    assert(len(self.axes) == ndim)
+    size = 1
+    for axis in self.axes:
+      size *= axis.nbins + 2
+    self.contents = np.zeros(size, dtype=root_types[self.kwargs.get('type', 'F')])
+    self.sumw2 = None  # only kept after Sumw2() or a weighted fill
+    self.entries = 0
+    self.buffer = []
+
+  def Sumw2(self):
+    if self.sumw2 is None:
+      self.flush()
+      self.sumw2 = self.contents.astype(np.float64)
+
+  def fill(self, *values):
+    if len(values) == len(self.axes):
+      values += (1.,)
+    self.buffer.append(values)
+    if len(self.buffer) >= self.buffer_size:
+      self.flush()
+
+  def fill_array(self, *arrays):
+    # Same as calling fill() for each row of the arrays, the weights can be given as an extra array
+    arrays = [np.asarray(a, dtype=np.float64) for a in arrays]
+    if len(arrays) == len(self.axes):
+      arrays.append(np.ones_like(arrays[0]))
+    if arrays[0].size:
+      self._fill_values(np.column_stack(arrays))
+
+  def flush(self):
+    if not self.buffer:
+      return
+    values = np.asarray(self.buffer, dtype=np.float64)
+    self.buffer = []
+    self._fill_values(values)
+
+  def _fill_values(self, values):
+    ndim = len(self.axes)
+    w = values[:, ndim]
+    b = np.zeros(values.shape[0], dtype=np.int64)
+    stride = 1
+    for (i, axis) in enumerate(self.axes):
+      b += axis.find_bins(values[:, i]) * stride
+      stride *= axis.nbins + 2
+    if self.sumw2 is None and np.any(w != 1.):  # weighted fill
+      self.sumw2 = self.contents.astype(np.float64)
+    self.contents += np.bincount(b, weights=w, minlength=self.contents.size).astype(self.contents.dtype)
+    if self.sumw2 is not None:
+      self.sumw2 += np.bincount(b, weights=w*w, minlength=self.sumw2.size)
+    self.entries += values.shape[0]
+
+  def add(self, other):
+    self.flush()
+    other.flush()
+    assert(self.contents.shape == other.contents.shape)
+    if other.sumw2 is not None:
+      self.Sumw2()
+    if self.sumw2 is not None:
+      self.sumw2 += other.sumw2 if other.sumw2 is not None else other.contents
+    self.contents += other.contents.astype(self.contents.dtype)
+    self.entries += other.entries
+    return self
+
+  def clone(self):
+    self.flush()
+    h = self.__class__(*self.args, buffer_size=self.buffer_size, **self.kwargs)
+    h.add(self)
+    return h
+
+  def GetNbinsX(self):
+    return self.axes[0].nbins
+
+  def FindFixBin(self, *values):
+    b = 0
+    stride = 1
+    for (axis, x) in zip(self.axes, values):
+      b += axis.find_bin(x) * stride
+      stride *= axis.nbins + 2
+    return b
+
+  FindBin = FindFixBin
+
+  def GetBinCenter(self, b):
+    return self.axes[0].bin_center(b)
+
+  def to_root(self):
+    self.flush()
+    h = self.create_root()
+    for i in range(self.contents.size):
+      h.SetBinContent(i, self.contents[i])
+    if self.sumw2 is not None:
+      if not h.GetSumw2N():
+        h.Sumw2()
+      for i in range(self.sumw2.size):
+        h.SetBinError(i, np.sqrt(self.sumw2[i]))
+    h.ResetStats()
+    h.SetEntries(self.entries)
+    return h
+
+  def Write(self, *args):
+    h = self.to_root()
+    h.Write(*args)
+    return h
+
+class NumpyHist(NumpyHistBase):
+  def __init__(self, *args, **kwargs):
+    super(NumpyHist, self).__init__(args, kwargs, ndim=1)
+
+  def GetBinContent(self, b):
+    self.flush()
+    return self.contents[b]
+
+  def create_root(self):
+    from rootpy.plotting import Hist
+    return Hist(*self.args, **self.kwargs)
+
+class NumpyHist2D(NumpyHistBase):
+  def __init__(self, *args, **kwargs):
+    super(NumpyHist2D, self).__init__(args, kwargs, ndim=2)
+
+  def GetNbinsY(self):
+    return self.axes[1].nbins
+
+  def GetBinContent(self, binx, biny=0):
+    self.flush()
+    return self.contents[binx + (self.axes[0].nbins + 2) * biny]
+
+  def create_root(self):
+    from rootpy.plotting import Hist2D
+    return Hist2D(*self.args, **self.kwargs)
+
+# ______________________________________________________________________________
+class HistogramRegistry(object):
+  """Histograms by name, with the same dict interface used by the analyses.
+
+  Booking the same name twice is an error, so every histogram is declared in
+  one place. Registries with the same histograms are merged with merge().
+  """
+
+  def __init__(self):
+    self.histograms = OrderedDict()
+
+  def book(self, name, *args, **kwargs):
+    """Books a histogram with the rootpy Hist/Hist2D arguments.
+
+    The dimension is given by the binning, e.g. (nbins, low, high) or (edges,)
+    for each axis. The title and type (e.g. 'F', 'D', 'I') are passed as
+    keyword arguments, and sumw2=True keeps the sum of the squared weights.
+    """
+    if name in self.histograms:
+      raise KeyError('Histogram is already booked: {0}'.format(name))
+    sumw2 = kwargs.pop('sumw2', False)
+    kwargs['name'] = name
+    ndim = len(parse_axes(args))
+    if ndim == 1:
+      h = NumpyHist(*args, **kwargs)
+    elif ndim == 2:
+      h = NumpyHist2D(*args, **kwargs)
+    else:
+      raise ValueError('Cannot book a histogram with {0} axes: {1}'.format(ndim, name))
+    if sumw2:
+      h.Sumw2()
+    self.histograms[name] = h
+    return h
+
+  def __getitem__(self, name):
+    return self.histograms[name]
+
+  def __contains__(self, name):
+    return name in self.histograms
+
+  def __len__(self):
+    return len(self.histograms)
+
+  def __iter__(self):
+    return iter(self.histograms)
+
+  def keys(self):
+    return list(self.histograms.keys())
+
+  def iteritems(self):
+    return iter(self.histograms.items())
+
+  items = iteritems
+
+  def merge(self, other):
+    for (name, h) in other.iteritems():
+      if name in self.histograms:
+        mine = self.histograms[name]
+        if (mine.__class__, mine.args, mine.kwargs.get('type')) != (h.__class__, h.args, h.kwargs.get('type')):
+          raise ValueError('Cannot merge histograms with different binnings: {0}'.format(name))
+        mine.add(h)
+      else:
+        self.histograms[name] = h.clone()
+    return self
+
+  def save(self, filename):
+    # Binning and titles are kept as JSON, the bins as arrays in the same order
+    specs = []
+    arrays = {}
+    for (i, (name, h)) in enumerate(self.iteritems()):
+      h.flush()
+      args = [np.asarray(arg).tolist() for arg in h.args]
+      specs.append(dict(ndim=len(h.axes), args=args, kwargs=h.kwargs, entries=h.entries))
+      arrays['contents_%i' % i] = h.contents
+      if h.sumw2 is not None:
+        arrays['sumw2_%i' % i] = h.sumw2
+    arrays['specs'] = np.array(json.dumps(specs))
+    np.savez_compressed(filename, **arrays)
+
+  @classmethod
+  def load(cls, filename):
+    self = cls()
+    with np.load(filename) as f:
+      specs = json.loads(str(f['specs']))
+      for (i, spec) in enumerate(specs):
+        args = [tuple(arg) if isinstance(arg, list) else arg for arg in spec['args']]
+        kwargs = dict((str(k), str(v)) for (k, v) in spec['kwargs'].items())
+        h = self._book_spec(spec['ndim'], args, kwargs)
+        h.contents[:] = f['contents_%i' % i]
+        if ('sumw2_%i' % i) in f.files:
+          h.sumw2 = f['sumw2_%i' % i].astype(np.float64)
+        h.entries = spec['entries']
+    return self
+
+  def _book_spec(self, ndim, args, kwargs):
+    h = NumpyHist(*args, **kwargs) if ndim == 1 else NumpyHist2D(*args, **kwargs)
+    self.histograms[h.name] = h
+    return h
+
+  def save_root(self, filename):
+    from rootpy.io import root_open
+    with root_open(filename, 'recreate'):
+      for (name, h) in self.iteritems():
+        h.Write()
+
+def merge_files(filenames):
+  registry = HistogramRegistry()
+  for filename in filenames:
+    registry.merge(HistogramRegistry.load(filename))
+  return registry
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print('Usage: python {0} OUTPUT.{{root,npz}} INPUT.npz [INPUT.npz ...]'.format(sys.argv[0]))
+    sys.exit(1)
+  outfile = sys.argv[1]
+  registry = merge_files(sys.argv[2:])
+  print('[INFO] Merged {0} histograms from {1} files'.format(len(registry), len(sys.argv[2:])))
+  print('[INFO] Creating file: %s' % outfile)
+  if outfile.endswith('.root'):
+    registry.save_root(outfile)
+  else:
+    registry.save(outfile)
@@ -0,0 +1,92 @@
+"""Cache of the outputs of the pipeline stages, per input file.
+
+The rates are often redone with the same input, the same pattern bank and the
+same NN models, only to tune the track producer, the ghost busting or the
+muon correlator. StageCache keeps the outputs of the earlier stages (e.g. the
+roads after pattern recognition, cleaning and slimming, and the pT assignment
+results) in one file per stage and input, so that the next run resumes from
+the deepest stage found in the cache.
+
+The key of a stage is the SHA-1 of everything that its outputs depend on: the
+identity of the input (see get_tree_identity() in rootpy_trackbuilding11.py),
+the contents of the pattern bank and the model files, the stage options, and
+the source code of the stage classes (see source_identity()). A change in any
+of them gives a new key, so a stale entry is never used. Changes in the helper
+functions called by the stages are not tracked, clear the cache directory
+after such changes.
+
+The records of a stage are pickled one by one, and read back as a generator.
+A file is written under a temporary name and renamed when complete, so that
+an interrupted job does not leave a partial entry behind.
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+
+
+# ______________________________________________________________________________
+def make_key(*parts):
+  """Returns the SHA-1 of the parts, converted to strings."""
+  h = hashlib.sha1()
+  for part in parts:
+    h.update(str(part).encode('utf-8'))
+    h.update(b'\0')
+  return h.hexdigest()
+
+def source_identity(*objs):
+  """Returns the SHA-1 of the source code of the classes, functions or modules."""
+  return make_key(*[inspect.getsource(obj) for obj in objs])
+
+class StageWriter(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.tmpname = filename + '.tmp%i' % os.getpid()
+    self.f = open(self.tmpname, 'wb')
+    self.nrecords = 0
+
+  def write(self, record):
+    pickle.dump(record, self.f, pickle.HIGHEST_PROTOCOL)
+    self.nrecords += 1
+
+  def close(self):
+    self.f.close()
+    os.rename(self.tmpname, self.filename)
+
+  def abort(self):
+    self.f.close()
+    os.remove(self.tmpname)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+class StageCache(object):
+  def __init__(self, cachedir):
+    self.cachedir = cachedir
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+
+  def filename(self, stage, key):
+    return os.path.join(self.cachedir, '{0}_{1}.pkl'.format(stage, key))
+
+  def exists(self, stage, key):
+    return os.path.isfile(self.filename(stage, key))
+
+  def read(self, stage, key):
+    with open(self.filename(stage, key), 'rb') as f:
+      while True:
+        try:
+          record = pickle.load(f)
+        except EOFError:
+          break
+        yield record
+
+  def writer(self, stage, key):
+    return StageWriter(self.filename(stage, key))
@@ -0,0 +1,287 @@
+"""Per-event summary tables of the rates and efficiency analyses.
+
+RatesAnalysis and EffieAnalysis record one row per event (event metadata, and
+the gen particle for the efficiency) and one row per track (for each
+algorithm: the EMTF tracks and the EMTF++ tracks) into a SummaryTable. The
+histograms are then filled from the tables by fill_rates_histograms() and
+fill_effie_histograms(), so a different pT threshold, eta binning or quality
+cut only needs the summary file instead of running the whole chain again:
+
+  python rootpy_trackbuilding11.py  # with analysis = 'rates_summary' or 'effie_summary'
+
+The tracks are linked to their event by 'entry', the row of the event in the
+events table. Tables from different jobs are concatenated by load_summary().
+The pileup scan keeps the events of all the pileup points in one file, with
+the number of events of each point (see pileup_point_dtype), and
+select_events() takes the events of one point.
+"""
+
+import numpy as np
+
+
+# ______________________________________________________________________________
+rates_event_dtype = np.dtype([
+    ('jobid', np.int32), ('event', np.int32), ('pileup', np.int16),
+])
+
+effie_event_dtype = np.dtype([
+    ('jobid', np.int32), ('event', np.int32), ('pileup', np.int16),
+    ('part_pt', np.float64), ('part_eta', np.float64), ('part_phi', np.float64), ('part_q', np.int8),
+    ('part_invpt', np.float64), ('part_d0', np.float64), ('part_vz', np.float64), ('part_bx', np.int8),
+    ('nroads', np.int32), ('nclean_roads', np.int32),
+])
+
+# pt, xml_pt and eta are kept in double precision, so that the cuts give the
+# same results as on the tracks. 'matched' is -1 if not known (EMTF tracks).
+summary_track_dtype = np.dtype([
+    ('entry', np.int32), ('algo', np.int8), ('itrk', np.int16),
+    ('pt', np.float64), ('xml_pt', np.float64), ('q', np.int8), ('eta', np.float64), ('phi', np.float32),
+    ('mode', np.int8), ('bx', np.int8), ('quality', np.int8),
+    ('y_pred', np.float32), ('y_discr', np.float32), ('matched', np.int8),
+])
+
+# Pileup points of a pileup scan, with the time spent by the workers
+pileup_point_dtype = np.dtype([
+    ('pileup', np.int16), ('nshards', np.int32), ('nevents', np.int64), ('seconds', np.float64),
+])
+
+summary_track_defaults = dict(bx=0, quality=-1, y_pred=np.nan, y_discr=np.nan, matched=-1)
+
+class SummaryTable(object):
+  def __init__(self, event_dtype, algos):
+    self.event_dtype = np.dtype(event_dtype)
+    self.algos = list(algos)
+    self.events = []
+    self.tracks = []
+
+  def add_event(self, **values):
+    """Adds an event, returns its entry. Missing columns are set to zero."""
+    row = np.zeros(1, dtype=self.event_dtype)
+    for (k, v) in values.items():
+      row[k] = v
+    self.events.append(row)
+    return len(self.events) - 1
+
+  def add_tracks(self, entry, algo, tracks, matched=None):
+    """Adds the tracks of an algorithm, either a track table or a list of track objects."""
+    n = len(tracks)
+    rows = np.zeros(n, dtype=summary_track_dtype)
+    rows['entry'] = entry
+    rows['algo'] = self.algos.index(algo)
+    rows['itrk'] = np.arange(n)
+    names = getattr(getattr(tracks, 'dtype', None), 'names', None)
+    for k in summary_track_dtype.names[3:]:
+      if k == 'matched':
+        continue
+      if names is not None:
+        rows[k] = tracks[k] if k in names else summary_track_defaults[k]
+      else:
+        rows[k] = [getattr(trk, k, summary_track_defaults.get(k)) for trk in tracks]
+    rows['matched'] = summary_track_defaults['matched'] if matched is None else matched
+    self.tracks.append(rows)
+
+  def get_events(self):
+    if not self.events:
+      return np.zeros(0, dtype=self.event_dtype)
+    return np.concatenate(self.events)
+
+  def get_tracks(self):
+    if not self.tracks:
+      return np.zeros(0, dtype=summary_track_dtype)
+    return np.concatenate(self.tracks)
+
+  def save(self, filename):
+    np.savez_compressed(filename, events=self.get_events(), tracks=self.get_tracks(), algos=np.array(self.algos))
+
+def concatenate_summaries(tables):
+  """Concatenates a list of (events, tracks), returns (events, tracks)."""
+  all_events = []
+  all_tracks = []
+  offset = 0
+  for (events, tracks) in tables:
+    tracks = tracks.copy()
+    tracks['entry'] += offset
+    offset += len(events)
+    all_events.append(events)
+    all_tracks.append(tracks)
+  return (np.concatenate(all_events), np.concatenate(all_tracks))
+
+def load_summary(filenames):
+  """Concatenates the summary files, returns (events, tracks, algos)."""
+  tables = []
+  algos = None
+  for filename in filenames:
+    with np.load(filename) as f:
+      tables.append((f['events'], f['tracks']))
+      if algos is None:
+        algos = [str(a) for a in f['algos']]
+      elif algos != [str(a) for a in f['algos']]:
+        raise ValueError('Cannot merge summary files with different algos: {0}'.format(filename))
+  (events, tracks) = concatenate_summaries(tables)
+  return (events, tracks, algos)
+
+def select_events(events, tracks, selected):
+  """Keeps the selected events and their tracks, returns (events, tracks)."""
+  selected = np.asarray(selected, dtype=np.bool_)
+  new_entry = np.cumsum(selected) - 1
+  tracks = tracks[selected[tracks['entry']]].copy()
+  tracks['entry'] = new_entry[tracks['entry']]
+  return (events[selected], tracks)
+
+
+# ______________________________________________________________________________
+# Helpers to fill the histograms from the tables
+
+def highest_pt_by_event(nevents, tracks, selected):
+  # Highest pT of the selected tracks of each event, -inf if none
+  highest_pt = np.full(nevents, -np.inf)
+  np.maximum.at(highest_pt, tracks['entry'][selected], tracks['pt'][selected])
+  return highest_pt
+
+def argmax_pt_by_event(tracks, selected):
+  # Index of the track with the highest pT in each event, the first one if tied
+  ind = np.nonzero(selected)[0]
+  order = np.lexsort((ind, -tracks['pt'][ind], tracks['entry'][ind]))
+  ind = ind[order]
+  first = np.ones(len(ind), dtype=np.bool_)
+  first[1:] = tracks['entry'][ind][1:] != tracks['entry'][ind][:-1]
+  return ind[first]
+
+def fill_highest_pt(h, highest_pt):
+  highest_pt = highest_pt[highest_pt > 0.]
+  h.fill_array(np.minimum(100.-1e-4, highest_pt))
+
+def fill_eta(h, tracks, selected):
+  # Fill each eta bin once per event
+  axis = h.axes[0]
+  b = axis.find_bins(np.abs(tracks['eta'][selected]))
+  pairs = np.unique(tracks['entry'][selected].astype(np.int64) * (axis.nbins + 2) + b)
+  b = pairs % (axis.nbins + 2)
+  h.fill_array(np.array([axis.bin_center(bb) for bb in b], dtype=np.float64))
+
+
+# ______________________________________________________________________________
+def fill_rates_histograms(histograms, events, tracks, algos):
+  """Fills the histograms booked by RatesAnalysis. algos[0] is 'emtf', the others are the EMTF++ model tags."""
+  nevents = len(events)
+  histograms["nevents"].fill_array(np.ones(nevents))
+
+  abs_eta = np.abs(tracks['eta'])
+  for (ialgo, m) in enumerate(algos):
+    is_algo = (tracks['algo'] == ialgo)
+    if m == "emtf":
+      # EMTF tracks
+      base = is_algo & (tracks['bx'] == 0) & np.in1d(tracks['mode'], (11,13,14,15))
+      regions = [
+        ("absEtaMin1.24_absEtaMax2.4", (1.24 <= abs_eta) & (abs_eta <= 2.4)),
+        ("absEtaMin1.24_absEtaMax1.65", (1.24 <= abs_eta) & (abs_eta < 1.65)),
+        ("absEtaMin1.65_absEtaMax2.15", (1.65 <= abs_eta) & (abs_eta < 2.15)),
+        ("absEtaMin2.15_absEtaMax2.4", (2.15 <= abs_eta) & (abs_eta <= 2.4)),
+      ]
+    else:
+      # EMTF++ tracks
+      base = is_algo
+      regions = [
+        ("absEtaMin1.24_absEtaMax2.4", (1.24 <= abs_eta) & (abs_eta <= 2.4)),
+        ("absEtaMin1.24_absEtaMax1.65", (1.24 <= abs_eta) & (abs_eta <= 1.65)),
+        ("absEtaMin1.65_absEtaMax2.15", (1.65 <= abs_eta) & (abs_eta <= 2.15)),
+        ("absEtaMin2.15_absEtaMax2.4", (2.15 <= abs_eta) & (abs_eta <= 2.4)),
+      ]
+
+    for (region, in_region) in regions:
+      hname = "highest_%s_%s_qmin12_pt" % (m, region)
+      fill_highest_pt(histograms[hname], highest_pt_by_event(nevents, tracks, base & in_region))
+
+    for l in range(14,22+1):
+      hname = "%s_ptmin%i_qmin12_eta" % (m, l)
+      fill_eta(histograms[hname], tracks, base & (0 <= abs_eta) & (abs_eta <= 9.9) & (tracks['pt'] > float(l)))
+
+    if m != "emtf":
+      # For fake rate plot (EMTF++ tracks only)
+      ind = argmax_pt_by_event(tracks, base & regions[0][1])
+      ind = ind[tracks['pt'][ind] > 0.]
+      highest_pt = np.minimum(100.-1e-4, tracks['pt'][ind])
+      matched = tracks['matched'][ind] > 0
+      histograms["highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_matched0_pt" % m].fill_array(highest_pt[~matched])
+      histograms["highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_matched1_pt" % m].fill_array(highest_pt[matched])
+
+
+# ______________________________________________________________________________
+def fill_effie_histograms(histograms, events, tracks, algos, thresholds=(0, 5, 10, 20, 30, 40, 50, 60)):
+  """Fills the histograms booked by EffieAnalysis. algos are 'emtf' and 'emtf2026'."""
+  nevents = len(events)
+  pt = events['part_pt']
+  eta = events['part_eta']
+  abs_eta = np.abs(eta)
+  phi = np.rad2deg(events['part_phi'])
+  invpt = events['part_invpt']
+  d0 = events['part_d0']
+  abs_d0 = np.abs(d0)
+  abs_vz = np.abs(events['part_vz'])
+  is_bx0 = (events['part_bx'] == 0)
+  with np.errstate(invalid='ignore'):
+    in_eta = (1.24 <= abs_eta) & (abs_eta <= 2.4)
+    has_d0 = (abs_d0 >= 0)  # false if d0 is NaN
+  select_part = is_bx0 & in_eta & has_d0
+  select_part_eta = is_bx0 & has_d0  # no cut on eta
+  select_part_d0 = is_bx0 & in_eta  # no cut on d0
+  is_highpt = (pt > 20.)
+  is_lowpt = (5 < pt) & (pt <= 20.)
+
+  def fill_efficiency(hname, trigger, selected, *values):
+    values = [v[selected] for v in values]
+    histograms[hname + "_denom"].fill_array(*values)
+    values = [v[trigger[selected]] for v in values]
+    histograms[hname + "_numer"].fill_array(*values)
+
+  trk_abs_eta = np.abs(tracks['eta'])
+  trk_part_eta = eta[tracks['entry']]
+
+  for (ialgo, m) in enumerate(algos):
+    is_algo = (tracks['algo'] == ialgo)
+    if m == "emtf":
+      # EMTF tracks
+      base = is_algo & (1.24 <= trk_abs_eta) & (trk_abs_eta <= 2.4) & (tracks['bx'] == 0) & np.in1d(tracks['mode'], (11,13,14,15)) & (tracks['eta'] * trk_part_eta > 0)
+    else:
+      # EMTF++ tracks
+      base = is_algo & (1.24 <= trk_abs_eta) & (trk_abs_eta <= 2.4)
+    highest_pt = highest_pt_by_event(nevents, tracks, base)
+
+    # Check various L1 pT thresholds
+    for l in thresholds:
+      trigger = (highest_pt > float(l))  # using scaled pT
+
+      fill_efficiency("%s_eff_vs_genpt_l1pt%i" % (m,l), trigger, select_part, pt)
+      fill_efficiency("%s_eff_vs_genpt_highpt_l1pt%i" % (m,l), trigger, select_part, pt)
+      fill_efficiency("%s_eff_vs_genphi_l1pt%i" % (m,l), trigger, select_part & is_highpt, phi)
+      fill_efficiency("%s_eff_vs_geneta_l1pt%i" % (m,l), trigger, select_part_eta & is_highpt, abs_eta)
+      fill_efficiency("%s_eff_vs_gend0_l1pt%i" % (m,l), trigger, select_part_d0 & is_highpt, abs_d0)
+      fill_efficiency("%s_eff_vs_gendz_l1pt%i" % (m,l), trigger, select_part & is_highpt, abs_vz)
+      fill_efficiency("%s_eff_vs_genphi_lowpt_l1pt%i" % (m,l), trigger, select_part & is_lowpt, phi)
+      fill_efficiency("%s_eff_vs_geneta_lowpt_l1pt%i" % (m,l), trigger, select_part_eta & is_lowpt, abs_eta)
+
+      fill_efficiency("%s_eff_vs_gend0d1_l1pt%i" % (m,l), trigger, select_part_d0, d0, invpt)
+      fill_efficiency("%s_eff_vs_genetad1_l1pt%i" % (m,l), trigger, select_part_d0, abs_eta, invpt)
+      fill_efficiency("%s_eff_vs_genetad0_l1pt%i" % (m,l), trigger, select_part_d0 & is_highpt, abs_eta, d0)
+
+      if l == 0:
+        # Resolution, using the unscaled pT of the first track
+        first = is_algo & (tracks['itrk'] == 0)
+        trk_invpt = np.full(nevents, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+          trk_invpt[tracks['entry'][first]] = np.true_divide(tracks['q'][first], tracks['xml_pt'][first])
+          res = -(trk_invpt - invpt)/np.abs(invpt)
+        selected = is_bx0 & trigger
+        histograms["%s_l1pt_vs_genpt" % m].fill_array(invpt[selected], trk_invpt[selected])
+        histograms["%s_l1ptres_vs_genpt" % m].fill_array(invpt[selected], res[selected])
+        selected &= is_highpt
+        histograms["%s_l1pt_vs_geneta" % m].fill_array(abs_eta[selected], trk_invpt[selected])
+        histograms["%s_l1ptres_vs_geneta" % m].fill_array(abs_eta[selected], res[selected])
+
+      if l == 0 and m != "emtf":
+        # Pattern recognition & road cleaning (EMTF++ tracks only)
+        for (k, n) in (("roads", events['nroads']), ("croads", events['nclean_roads'])):
+          trigger_roads = (n > 0)
+          fill_efficiency("%s_eff_vs_genpt_%s" % (m,k), trigger_roads, select_part, pt)
+          fill_efficiency("%s_eff_vs_geneta_%s" % (m,k), trigger_roads, is_bx0 & is_highpt, abs_eta)
+          fill_efficiency("%s_eff_vs_gend0_%s" % (m,k), trigger_roads, select_part & is_highpt, abs_d0)
@@ -0,0 +1,156 @@
+"""Cache of the NN outputs, keyed by the encoded input row and the model.
+
+The same roads are often predicted again and again (mixing, augmentation,
+rate studies with different trigger thresholds). CachedModel wraps a model
+with predict() and only runs the model on the rows that are not found in the
+cache. The key of a row is the SHA-1 of the model identity + the bytes of the
+row, so a different model or a different input never reuses an entry.
+
+The cache is kept in memory (LRU, bounded by the number of entries) and
+optionally in a sqlite file, which persists across jobs. sqlite does not like
+many concurrent writers on a network file system, so use a local file per job
+(or copy one in) when running on condor.
+"""
+
+import numpy as np
+
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+
+# ______________________________________________________________________________
+def file_identity(*filenames):
+  """Returns the SHA-1 of the contents of the files, to be used as model identity."""
+  h = hashlib.sha1()
+  for filename in filenames:
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+  return h.hexdigest()
+
+class CachedModel(object):
+  def __init__(self, model, identity, maxsize=1000000, filename=None):
+    self.model = model
+    self.identity = identity.encode('utf-8') if not isinstance(identity, bytes) else identity
+    self.maxsize = maxsize
+    self.memory = OrderedDict()
+    self.filename = filename
+    self.db = None
+    if filename is not None:
+      self.db = sqlite3.connect(filename)
+      self.db.execute('CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value BLOB)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS meta (identity BLOB PRIMARY KEY, dtype TEXT, splits TEXT)')
+      self.db.commit()
+    self.output_dtype = None
+    self.output_splits = None  # column splits if the model has a list of outputs
+    self._load_meta()
+    self.nrows = 0
+    self.nhits_memory = 0
+    self.nhits_disk = 0
+    self.trainable = False
+    self.updates = []
+
+  def get_keys(self, x):
+    x = np.ascontiguousarray(x)
+    keys = []
+    for row in x:
+      h = hashlib.sha1(self.identity)
+      h.update(row.tobytes())
+      keys.append(h.digest())
+    return keys
+
+  def _put_memory(self, key, value):
+    self.memory.pop(key, None)
+    self.memory[key] = value
+    while len(self.memory) > self.maxsize:
+      self.memory.popitem(last=False)
+
+  def _get_memory(self, key):
+    value = self.memory.pop(key, None)
+    if value is not None:
+      self.memory[key] = value  # most recently used
+    return value
+
+  def _load_meta(self):
+    # The output format is stored per model, so that a new job can read the entries back
+    if self.db is None:
+      return
+    row = self.db.execute('SELECT dtype, splits FROM meta WHERE identity = ?', [sqlite3.Binary(self.identity)]).fetchone()
+    if row is not None:
+      self.output_dtype = np.dtype(str(row[0]))
+      if row[1]:
+        self.output_splits = [int(s) for s in row[1].split(',')]
+
+  def _save_meta(self):
+    splits = ','.join([str(s) for s in self.output_splits]) if self.output_splits is not None else ''
+    self.db.execute('INSERT OR REPLACE INTO meta (identity, dtype, splits) VALUES (?, ?, ?)',
+                    [sqlite3.Binary(self.identity), self.output_dtype.str, splits])
+
+  def _get_disk(self, keys):
+    found = {}
+    n = 500  # max number of sqlite host parameters is 999
+    for i in range(0, len(keys), n):
+      chunk = keys[i:i+n]
+      query = 'SELECT key, value FROM cache WHERE key IN ({0})'.format(','.join(['?'] * len(chunk)))
+      for (key, value) in self.db.execute(query, [sqlite3.Binary(k) for k in chunk]):
+        found[bytes(key)] = bytes(value)
+    return found
+
+  def predict(self, x, batch_size=None):
+    x = np.asarray(x)
+    keys = self.get_keys(x)
+    values = [self._get_memory(key) for key in keys]
+    self.nrows += len(keys)
+    self.nhits_memory += sum(value is not None for value in values)
+
+    # Look up the remaining rows on disk
+    if self.db is not None and self.output_dtype is not None:
+      missing = [i for (i, value) in enumerate(values) if value is None]
+      found = self._get_disk([keys[i] for i in missing])
+      for i in missing:
+        value = found.get(keys[i])
+        if value is not None:
+          value = np.frombuffer(value, dtype=self.output_dtype)
+          values[i] = value
+          self._put_memory(keys[i], value)
+          self.nhits_disk += 1
+
+    # Run the model on the remaining rows
+    missing = [i for (i, value) in enumerate(values) if value is None]
+    if missing:
+      y = self.model.predict(x[missing])
+      if isinstance(y, list):
+        self.output_splits = [int(s) for s in np.cumsum([yy.shape[1] for yy in y])[:-1]]
+        y = np.hstack(y)
+      self.output_dtype = y.dtype
+      rows = []
+      for (i, value) in zip(missing, y):
+        value = value.copy()
+        values[i] = value
+        self._put_memory(keys[i], value)
+        rows.append((sqlite3.Binary(keys[i]), sqlite3.Binary(value.tobytes())))
+      if self.db is not None:
+        self._save_meta()
+        self.db.executemany('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', rows)
+        self.db.commit()
+
+    if len(values) == 0:
+      return self.model.predict(x)
+    y = np.vstack(values)
+    if self.output_splits is not None:
+      return np.split(y, self.output_splits, axis=1)
+    return y
+
+  def hit_rate(self):
+    return float(self.nhits_memory + self.nhits_disk) / max(self.nrows, 1)
+
+  def report(self):
+    print('[INFO] NN cache: {0} rows, {1} memory hits, {2} disk hits, hit rate: {3:.3f}'.format(
+        self.nrows, self.nhits_memory, self.nhits_disk, self.hit_rate()))
+
+  def close(self):
+    if self.db is not None:
+      self.db.commit()
+      self.db.close()
+      self.db = None
@@ -0,0 +1,66 @@
+"""Inference with a frozen TensorFlow graph.
+
+The graph is produced by test5/convert_to_constant_graph.py. Loading it avoids
+importing Keras and rebuilding the model from JSON + HDF5. TensorFlow itself
+is imported only when a graph is loaded.
+"""
+
+# ______________________________________________________________________________
+class GraphModel(object):
+  """Runs a frozen graph with the same predict() as a Keras model.
+
+  If the input and output node names are not given, the input is the only
+  placeholder (besides the Keras learning phase), and the outputs are the nodes
+  that are not used by any other node, in the order of the graph.
+  """
+
+  def __init__(self, filename, input_name=None, output_names=None):
+    import tensorflow as tf
+    if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1'):
+      tf = tf.compat.v1
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+
+    learning_phase_name = 'keras_learning_phase'
+    node_names = [node.name for node in graph_def.node]
+    if input_name is None:
+      placeholders = [node.name for node in graph_def.node if node.op == 'Placeholder' and node.name != learning_phase_name]
+      if len(placeholders) != 1:
+        raise RuntimeError('Cannot find the input node in {0}: {1}'.format(filename, placeholders))
+      input_name = placeholders[0]
+    if output_names is None:
+      used = set()
+      for node in graph_def.node:
+        for name in node.input:
+          used.add(name.lstrip('^').split(':')[0])
+      output_names = [node.name for node in graph_def.node if node.name not in used and node.op not in ('Placeholder', 'PlaceholderWithDefault', 'Const', 'NoOp')]
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      tf.import_graph_def(graph_def, name='')
+    self.sess = tf.Session(graph=self.graph)
+    self.x = self.graph.get_tensor_by_name(input_name + ':0')
+    self.y = [self.graph.get_tensor_by_name(name + ':0') for name in output_names]
+    self.learning_phase = None
+    if learning_phase_name in node_names:
+      self.learning_phase = self.graph.get_tensor_by_name(learning_phase_name + ':0')
+    self.trainable = False
+    self.updates = []
+
+  def predict(self, x, batch_size=None):
+    feed_dict = {self.x: x}
+    if self.learning_phase is not None:
+      feed_dict[self.learning_phase] = False  # test mode
+    y = self.sess.run(self.y, feed_dict=feed_dict)
+    if len(y) == 1:
+      return y[0]
+    return y
+
+def load_graph_model(filename, input_name=None, output_names=None):
+  return GraphModel(filename, input_name=input_name, output_names=output_names)
+
+def graph_model_file(model_file):
+  # e.g. 'model.29.json' -> 'model_graph.29.pb', same as convert_to_constant_graph.py
+  return model_file.replace('model', 'model_graph').replace('.json', '.pb')
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+"""NumPy-only inference for the dense pT assignment NN.
+
+The Keras model (JSON + HDF5 weights) is converted once into a compact npz
+file, with BatchNormalization folded into the neighbouring Dense layers. The
+forward pass only needs numpy, so the trackbuilding jobs do not have to import
+TensorFlow/Keras.
+
+The forward pass runs in float32 like Keras. The BN folding changes the order
+of the floating-point operations, so the outputs are not bit-by-bit identical
+to Keras predict(). For models 20-29, the differences with respect to a float64
+evaluation of the unfolded network are below 5e-5 of the largest output
+magnitude, similar to the float32 rounding of the unfolded network itself.
+
+A fixed-point emulation (QuantizedModel) runs the same network with integer
+weights, activations and inputs, to study the bit widths used in the firmware.
+
+Usage:
+  python nn_numpy.py model.29.json  # writes model_numpy.29.npz
+  python nn_numpy.py model_numpy.29.npz histos_tba.npz  # scans bit widths
+"""
+
+import numpy as np
+
+import sys
+import json
+
+
+# ______________________________________________________________________________
+# Activations
+
+def np_linear(x):
+  return x
+
+def np_tanh(x):
+  return np.tanh(x)
+
+def np_sigmoid(x):
+  # Sigmoid f(x) = 1/(1+exp(-x)) = (1+tanh(x/2))/2, which does not overflow
+  return 0.5 * (np.tanh(0.5 * x) + 1.)
+
+def np_relu(x):
+  # ReLU(x) = max(0, x)
+  return np.maximum(x, 0.)
+
+def np_softplus(x):
+  # Softplus f(x) = log(1+exp(x))
+  return np.logaddexp(0., x)
+
+def np_elu(x):
+  # ELU(x) = x if x > 0 else exp(x)-1
+  return np.where(x > 0., x, np.expm1(np.minimum(x, 0.)))
+
+def np_softmax(x):
+  e = np.exp(x - x.max(axis=-1, keepdims=True))
+  return e / e.sum(axis=-1, keepdims=True)
+
+activations = {
+  'linear': np_linear,
+  'tanh': np_tanh,
+  'NewTanh': np_tanh,  # see nn_models.NewTanh
+  'sigmoid': np_sigmoid,
+  'relu': np_relu,
+  'softplus': np_softplus,
+  'elu': np_elu,
+  'softmax': np_softmax,
+}
+
+def get_activation(name):
+  if name is None:
+    name = 'linear'
+  if name not in activations:
+    raise NotImplementedError('Cannot recognize activation: {0}'.format(name))
+  return activations[name]
+
+
+# ______________________________________________________________________________
+# Model
+
+class NumpyModel(object):
+  """Stack of dense stages y = activation(x W + b).
+
+  Each stage reads the input (-1) or the output of a previous stage. The model
+  returns the outputs of the stages listed in 'outputs', in the same way as
+  Keras predict(): a single array if there is one output, a list otherwise.
+  """
+
+  def __init__(self, stages, outputs, dtype=np.float32):
+    self.stages = []
+    for (inbound, kernel, bias, activation) in stages:
+      get_activation(activation)  # check
+      self.stages.append((inbound, kernel.astype(dtype), bias.astype(dtype), activation))
+    self.outputs = list(outputs)
+    self.dtype = dtype
+    self.trainable = False
+    self.updates = []
+
+  def predict(self, x, batch_size=None):
+    x = np.asarray(x, dtype=self.dtype)
+    values = {-1: x}
+    for i, (inbound, kernel, bias, activation) in enumerate(self.stages):
+      y = np.dot(values[inbound], kernel)
+      y += bias
+      values[i] = get_activation(activation)(y)
+    if len(self.outputs) == 1:
+      return values[self.outputs[0]]
+    return [values[i] for i in self.outputs]
+
+  def count_params(self):
+    return sum(kernel.size + bias.size for (inbound, kernel, bias, activation) in self.stages)
+
+def _to_str(s):
+  if isinstance(s, bytes):
+    return s.decode('utf-8')
+  return s
+
+def save_numpy_model(model, filename):
+  config = {'outputs': model.outputs, 'stages': []}
+  arrays = {}
+  for i, (inbound, kernel, bias, activation) in enumerate(model.stages):
+    config['stages'].append({'inbound': inbound, 'activation': activation})
+    arrays['kernel_%i' % i] = kernel
+    arrays['bias_%i' % i] = bias
+  np.savez_compressed(filename, config=np.array(json.dumps(config)), **arrays)
+
+def load_numpy_model(filename, dtype=np.float32):
+  with np.load(filename) as loaded:
+    config = json.loads(_to_str(loaded['config'].item()))
+    stages = []
+    for i, stage in enumerate(config['stages']):
+      stages.append((stage['inbound'], loaded['kernel_%i' % i], loaded['bias_%i' % i], stage['activation']))
+  return NumpyModel(stages, config['outputs'], dtype=dtype)
+
+def numpy_model_file(model_file):
+  # e.g. 'model.29.json' -> 'model_numpy.29.npz'
+  return model_file.replace('model', 'model_numpy').replace('.json', '.npz')
+
+
+# ______________________________________________________________________________
+# Conversion from Keras
+
+def read_keras_layers(model_file, model_weights_file):
+  """Returns a list of (class_name, config, inbound, weights) in topological order.
+
+  'inbound' is the name of the input layer, or None for the model input.
+  'weights' is a dict of numpy arrays, e.g. {'kernel': ..., 'bias': ...}.
+  """
+  import h5py
+
+  with open(model_file, 'r') as f:
+    model_config = json.load(f)
+
+  layers = []
+  if model_config['class_name'] == 'Sequential':
+    config = model_config['config']
+    if isinstance(config, dict):
+      config = config['layers']
+    inbound = None
+    for layer in config:
+      name = layer['config']['name']
+      layers.append([layer['class_name'], layer['config'], inbound, {}])
+      inbound = name
+    outputs = [inbound]
+  elif model_config['class_name'] == 'Model':
+    config = model_config['config']
+    input_names = [x[0] for x in config['input_layers']]
+    if len(input_names) != 1:
+      raise NotImplementedError('Only models with one input are supported')
+    for layer in config['layers']:
+      if layer['class_name'] == 'InputLayer':
+        continue
+      inbound_nodes = layer['inbound_nodes']
+      if len(inbound_nodes) != 1 or len(inbound_nodes[0]) != 1:
+        raise NotImplementedError('Only layers with one inbound node are supported: {0}'.format(layer['name']))
+      inbound = inbound_nodes[0][0][0]
+      if inbound in input_names:
+        inbound = None
+      layers.append([layer['class_name'], layer['config'], inbound, {}])
+    outputs = [x[0] for x in config['output_layers']]
+  else:
+    raise NotImplementedError('Cannot recognize model: {0}'.format(model_config['class_name']))
+
+  with h5py.File(model_weights_file, 'r') as f:
+    if 'model_weights' in f:  # saved by model.save()
+      f = f['model_weights']
+    for layer in layers:
+      name = layer[1]['name']
+      if name not in f:
+        continue
+      g = f[name]
+      for weight_name in g.attrs['weight_names']:
+        weight_name = _to_str(weight_name)
+        key = weight_name.split('/')[-1].split(':')[0]  # e.g. 'dense_1/kernel:0' -> 'kernel'
+        layer[3][key] = np.asarray(g[weight_name], dtype=np.float64)
+  return [tuple(layer) for layer in layers], outputs
+
+def fold_keras_layers(layers, outputs):
+  """Folds the Keras layers into dense stages.
+
+  Every tensor is kept as an affine transformation (A, c) of either the model
+  input or the output of a stage. Dense and BatchNormalization layers update
+  (A, c); a non-linear activation turns (A, c) into a new stage.
+  """
+  stages = []
+  tensors = {}  # name -> (base, A, c)
+
+  def materialize(tensor, activation):
+    (base, A, c) = tensor
+    stages.append((base, A, c, activation))
+    return (len(stages)-1, None, None)
+
+  def pending_affine(tensor, ncols):
+    (base, A, c) = tensor
+    if A is None:
+      A = np.eye(ncols)
+      c = np.zeros(ncols)
+    return (base, A, c)
+
+  for (class_name, config, inbound, weights) in layers:
+    name = config['name']
+    if inbound is None:
+      tensor = (-1, None, None)
+    else:
+      tensor = tensors[inbound]
+
+    if class_name == 'Dense':
+      kernel = weights['kernel']
+      bias = weights.get('bias', np.zeros(kernel.shape[1]))
+      (base, A, c) = pending_affine(tensor, kernel.shape[0])
+      tensor = (base, A.dot(kernel), c.dot(kernel) + bias)
+      activation = config.get('activation', 'linear')
+      if activation != 'linear':
+        tensor = materialize(tensor, activation)
+
+    elif class_name == 'BatchNormalization':
+      if config.get('axis', -1) not in (-1, 1):
+        raise NotImplementedError('Only BatchNormalization on the last axis is supported: {0}'.format(name))
+      mean = weights['moving_mean']
+      variance = weights['moving_variance']
+      gamma = weights.get('gamma', np.ones_like(mean))
+      beta = weights.get('beta', np.zeros_like(mean))
+      # y = (x - mean) / sqrt(variance + epsilon) * gamma + beta = x * s + t
+      s = gamma / np.sqrt(variance + config['epsilon'])
+      t = beta - mean * s
+      (base, A, c) = pending_affine(tensor, len(mean))
+      tensor = (base, A * s, c * s + t)
+
+    elif class_name == 'Activation':
+      activation = config['activation']
+      if activation != 'linear':
+        (base, A, c) = tensor
+        if A is None:
+          raise NotImplementedError('Activation without a preceding Dense layer is not supported: {0}'.format(name))
+        tensor = materialize(tensor, activation)
+
+    elif class_name in ('Dropout', 'GaussianNoise', 'GaussianDropout', 'AlphaDropout'):
+      pass  # identity at inference
+
+    else:
+      raise NotImplementedError('Cannot recognize layer: {0} ({1})'.format(name, class_name))
+
+    tensors[name] = tensor
+
+  # Outputs that end with a linear layer
+  output_indices = []
+  for name in outputs:
+    tensor = tensors[name]
+    if tensor[1] is not None:
+      tensor = materialize(tensor, 'linear')
+    output_indices.append(tensor[0])
+  return stages, output_indices
+
+def convert_keras_model(model_file, model_weights_file):
+  layers, outputs = read_keras_layers(model_file, model_weights_file)
+  stages, output_indices = fold_keras_layers(layers, outputs)
+  return NumpyModel(stages, output_indices)
+
+
+# ______________________________________________________________________________
+# Fixed-point emulation
+
+# Copied from test9/emtf_utils.py
+def calc_quant_scale(num_bits, num_int_bits):
+  return 1.0 / (1 << (num_bits - num_int_bits))
+
+# Copied from test9/emtf_utils.py
+def calc_quant_range(num_bits, num_int_bits, narrow_range=False):
+  quant_min = 1 if narrow_range else 0
+  quant_max = (1 << num_bits) - 1
+  zero_point = (quant_max - quant_min + 1) // 2
+  zero_point_from_min = quant_min + zero_point
+  range_min = quant_min - zero_point_from_min
+  range_max = quant_max - zero_point_from_min
+  range_min /= float(1 << (num_bits - num_int_bits))
+  range_max /= float(1 << (num_bits - num_int_bits))
+  return (range_min, range_max)
+
+def get_int_dtype(num_bits):
+  if num_bits <= 16:
+    return np.int16
+  elif num_bits <= 32:
+    return np.int32
+  return np.int64
+
+def quantize(x, num_bits, num_int_bits):
+  # Returns the integer q such that q * scale is the closest fixed-point value,
+  # where scale = 2^-(num_bits - num_int_bits). Out-of-range values saturate.
+  scale = calc_quant_scale(num_bits, num_int_bits)
+  (range_min, range_max) = calc_quant_range(num_bits, num_int_bits)
+  q = np.round(np.clip(x, range_min, range_max) / scale)
+  return q.astype(get_int_dtype(num_bits))
+
+def find_num_int_bits(x):
+  # Number of integer bits (including the sign bit) needed to represent x
+  max_abs = np.abs(x).max()
+  if max_abs == 0.:
+    return 1
+  return max(1, int(np.floor(np.log2(max_abs))) + 2)
+
+class QuantizedModel(object):
+  """Fixed-point emulation of a NumpyModel.
+
+  The inputs (i.e. the Encoder outputs), the weights and the activations are
+  quantized to signed integers with (num_bits, num_int_bits). The matrix
+  products are done in integer arithmetic, with an int32 accumulator if it
+  cannot overflow, otherwise int64. The bias is added in the accumulator
+  precision. The activation is then evaluated on the accumulator value, which
+  is what a lookup table does in the firmware, and the result is quantized
+  again. The output stages are not quantized again, they are returned as
+  float32 like NumpyModel.
+
+  'weight_bits' is either num_bits, in which case num_int_bits is found for each
+  stage from its largest weight, or a tuple (num_bits, num_int_bits).
+  """
+
+  def __init__(self, model, input_bits=(16, 13), weight_bits=16, activation_bits=(10, 1)):
+    self.input_bits = tuple(input_bits)
+    self.activation_bits = tuple(activation_bits)
+    self.outputs = list(model.outputs)
+    self.trainable = False
+    self.updates = []
+
+    self.stages = []
+    stage_bits = {-1: self.input_bits}
+    for i, (inbound, kernel, bias, activation) in enumerate(model.stages):
+      if isinstance(weight_bits, (tuple, list)):
+        w_bits = tuple(weight_bits)
+      else:
+        w_bits = (weight_bits, min(weight_bits, find_num_int_bits(kernel)))
+      x_bits = stage_bits[inbound]
+      acc_scale = calc_quant_scale(*x_bits) * calc_quant_scale(*w_bits)
+      bias_q = np.round(bias.astype(np.float64) / acc_scale).astype(np.int64)
+      acc_num_bits = x_bits[0] + w_bits[0] + int(np.ceil(np.log2(kernel.shape[0] + 1)))
+      acc_num_bits = max(acc_num_bits, find_num_int_bits(bias_q) + 1)
+      acc_dtype = np.int32 if acc_num_bits <= 32 else np.int64
+      kernel_q = quantize(kernel, *w_bits).astype(acc_dtype)
+      bias_q = bias_q.astype(acc_dtype)
+      self.stages.append((inbound, kernel_q, bias_q, activation, acc_scale, acc_dtype, w_bits))
+      stage_bits[i] = self.activation_bits
+
+  def predict(self, x, batch_size=None):
+    values = {-1: quantize(x, *self.input_bits)}
+    results = {}
+    for i, (inbound, kernel_q, bias_q, activation, acc_scale, acc_dtype, w_bits) in enumerate(self.stages):
+      acc = np.dot(values[inbound].astype(acc_dtype), kernel_q)
+      acc = acc + bias_q
+      y = get_activation(activation)(acc * acc_scale)
+      if i in self.outputs:
+        results[i] = y.astype(np.float32)
+      values[i] = quantize(y, *self.activation_bits)
+    if len(self.outputs) == 1:
+      return results[self.outputs[0]]
+    return [results[i] for i in self.outputs]
+
+def compare_models(model, other, x):
+  """Returns the agreement of the outputs of 'other' with the outputs of 'model'.
+
+  For each output column: (max abs diff, rms diff, rms diff / std of 'model').
+  """
+  y_ref = model.predict(x)
+  y = other.predict(x)
+  if not isinstance(y_ref, list):
+    y_ref, y = [y_ref], [y]
+  y_ref = np.hstack(y_ref).astype(np.float64)
+  y = np.hstack(y).astype(np.float64)
+  diff = y - y_ref
+  max_abs_diff = np.abs(diff).max(axis=0)
+  rms_diff = np.sqrt(np.square(diff).mean(axis=0))
+  std = y_ref.std(axis=0)
+  rel_rms_diff = rms_diff / np.where(std > 0., std, 1.)
+  return (max_abs_diff, rms_diff, rel_rms_diff)
+
+def print_comparison(comparison):
+  (max_abs_diff, rms_diff, rel_rms_diff) = comparison
+  for i in range(len(max_abs_diff)):
+    print('.. output {0}: max abs diff: {1:.4g} rms diff: {2:.4g} rms diff/std: {3:.4g}'.format(i, max_abs_diff[i], rms_diff[i], rel_rms_diff[i]))
+
+def scan_bit_widths(model, x, input_bits_list=((16, 13),), weight_bits_list=(8, 10, 12, 16),
+                    activation_bits_list=((8, 1), (10, 1), (12, 1), (16, 1))):
+  """Returns a list of (input_bits, weight_bits, activation_bits, comparison)."""
+  results = []
+  for input_bits in input_bits_list:
+    for weight_bits in weight_bits_list:
+      for activation_bits in activation_bits_list:
+        qmodel = QuantizedModel(model, input_bits=input_bits, weight_bits=weight_bits, activation_bits=activation_bits)
+        comparison = compare_models(model, qmodel, x)
+        results.append((input_bits, weight_bits, activation_bits, comparison))
+        print('input_bits: {0} weight_bits: {1} activation_bits: {2} worst rms diff/std: {3:.4g}'.format(
+            input_bits, weight_bits, activation_bits, comparison[2].max()))
+  return results
+
+
+# ______________________________________________________________________________
+def usage():
+  print('usage: python {0} FILE [DATA]'.format(sys.argv[0]))
+  print('')
+  print('arguments:')
+  print('  FILE    a model JSON file, e.g. \'model.json\', to be converted, or')
+  print('          a converted model file, e.g. \'model_numpy.npz\', to be quantized')
+  print('  DATA    a file with the road variables, e.g. \'histos_tba.npz\', used')
+  print('          to scan the bit widths of the quantized model')
+
+
+# ______________________________________________________________________________
+if __name__ == "__main__":
+  if len(sys.argv) < 2:
+    usage()
+    sys.exit(1)
+
+  model_file = sys.argv[1]
+
+  if model_file.endswith('.npz'):
+    if len(sys.argv) < 3:
+      usage()
+      sys.exit(1)
+
+    # Load model and inputs
+    model = load_numpy_model(model_file)
+    with np.load(sys.argv[2]) as loaded:
+      variables = loaded['variables']
+    from nn_encode import create_encoder
+    x = create_encoder(variables).get_x()
+    print('x: {}'.format(x.shape))
+
+    # Scan the bit widths of the quantized model
+    scan_bit_widths(model, x)
+
+    # Agreement of the default quantized model
+    print('default: input_bits: (16, 13) weight_bits: 16 activation_bits: (10, 1)')
+    print_comparison(compare_models(model, QuantizedModel(model), x))
+    sys.exit(0)
+
+  model_weights_file = model_file.replace('model', 'model_weights').replace('.json', '.h5')
+  numpy_file = numpy_model_file(model_file)
+
+  # Convert model
+  model = convert_keras_model(model_file, model_weights_file)
+  print('stages: {}'.format([(inbound, kernel.shape, activation) for (inbound, kernel, bias, activation) in model.stages]))
+  print('outputs: {}'.format(model.outputs))
+  print('params: {}'.format(model.count_params()))
+
+  # Save as npz
+  save_numpy_model(model, numpy_file)
+  print('numpy model: {}'.format(numpy_file))
@@ -1,7 +1,8 @@
 import numpy as np
 np.random.seed(2026)
 
-import os, sys, datetime
+import os, sys, datetime, functools, resource, atexit, glob
+from collections import OrderedDict
 from six.moves import range, zip, map, filter
 
 from rootpy.plotting import Hist, Hist2D, Graph, Efficiency
@@ -10,6 +11,11 @@ from rootpy.io import root_open
 from rootpy.ROOT import gROOT
 gROOT.SetBatch(True)
 
+from emtf_histograms import HistogramRegistry
+from emtf_summary import SummaryTable, rates_event_dtype, effie_event_dtype, pileup_point_dtype, load_summary, \
+    concatenate_summaries, select_events, fill_rates_histograms, fill_effie_histograms
+from emtf_stage_cache import StageCache, make_key, source_identity
+
 # Adjust matplotlib logging
 import logging
 mpl_logger = logging.getLogger('matplotlib')
@@ -169,6 +175,15 @@ def pick_the_median(lst):  # assume sorted list
   middle = 0 if len(lst) == 0 else (len(lst)-1)//2
   return lst[middle]
 
+def pick_the_median_segmented(values, row_splits):  # assume no empty row
+  # Same as pick_the_median(np.sort(values[row_splits[i]:row_splits[i+1]])) for every row i
+  segment_ids = ragged_row_splits_to_segment_ids(row_splits)
+  sorted_values = values[np.lexsort((values, segment_ids))]
+  row_lengths = row_splits[1:] - row_splits[:-1]
+  assert((row_lengths > 0).all())
+  middle = row_splits[:-1] + (row_lengths-1)//2
+  return sorted_values[middle]
+
 def calculate_d0(invPt, phi, xv, yv, B=3.811):
   _invPt = np.asarray(invPt, dtype=np.float64)   # needs double precision
   _invPt = np.where(np.abs(_invPt) < 1./10000, np.sign(_invPt+1e-15) * 1./10000, _invPt)
@@ -885,26 +900,7 @@ class Road(object):
   def to_variables(self):
     # Convert into an entry in a numpy array
     # At the moment, each entry carries (nlayers * (9+1)) + 4 values
-    amap = {}
-    (endcap, sector, ipt, ieta, iphi) = self.id
-    #road_info = (ipt, ieta, iphi)
-    road_info = (ipt, ieta, self.phi_median, self.theta_median)
-    #np.random.shuffle(self.hits)  # randomize the order
-    for hit in self.hits:
-      hit_lay = hit.emtf_layer
-      if hit_lay not in amap:
-        amap[hit_lay] = hit
-    arr = np.zeros((ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS, dtype=np.float32)
-    arr[0*nlayers:ROAD_LAYER_NVARS*nlayers] = np.nan                # variables (n=nlayers * 9)
-    arr[ROAD_LAYER_NVARS*nlayers:ROAD_LAYER_NVARS_P1*nlayers] = 1.0 # mask      (n=nlayers * 1)
-    arr[ROAD_LAYER_NVARS_P1*nlayers:] = road_info                   # road info (n=4)
-    for lay, hit in amap.iteritems():
-      ind = [i*nlayers + lay for i in xrange(ROAD_LAYER_NVARS)]
-      arr[ind] = (hit.emtf_phi, hit.emtf_theta, hit.emtf_bend, hit.emtf_qual, hit.emtf_time,
-                  hit.ring, hit.fr, hit.old_emtf_phi, hit.old_emtf_bend)
-      ind = (ROAD_LAYER_NVARS*nlayers + lay)
-      arr[ind] = 0.0  # unmask
-    return arr
+    return roads_to_variables([self])[0]
 
 class Track(object):
   def __init__(self, _id, hits, mode, quality, sort_code,
@@ -931,6 +927,25 @@ class Track(object):
   def zone(self):
     return self.id[3]
 
+# Track table, with one entry per track instead of a Track object (see TrackProducer.run_table())
+# - the columns have the same names as the Track attributes, and the track id
+#   (endcap, sector, ipt, ieta, iphi) is split into columns
+# - the hits of a track are the hits of the road slim_roads[road], their ghost
+#   busting variables are in hits[hit_offset:hit_offset+nhits] of the hit table
+track_table_dtype = np.dtype([
+    ('endcap', np.int8), ('sector', np.int8), ('endsec', np.int8),
+    ('ipt', np.int8), ('ieta', np.int8), ('iphi', np.int16),
+    ('mode', np.int8), ('ndof', np.int8), ('quality', np.int8), ('sort_code', np.int32),
+    ('xml_pt', np.float64), ('pt', np.float64), ('q', np.int8),
+    ('y_pred', np.float64), ('y_discr', np.float32), ('y_displ', np.float64), ('d0_displ', np.float64), ('pt_displ', np.float64),
+    ('emtf_phi', np.float32), ('emtf_theta', np.float32), ('phi', np.float64), ('eta', np.float64),
+    ('road', np.int32), ('hit_offset', np.int32), ('nhits', np.int16),
+])
+
+track_hit_table_dtype = np.dtype([
+    ('endsec', np.int8), ('emtf_layer', np.int8), ('emtf_phi', np.int32),
+])
+
 # Save particle list as a numpy array
 def particles_to_parameters(particles):
   parameters = np.zeros((len(particles), PARTICLE_NVARS), dtype=np.float32)
@@ -939,10 +954,36 @@ def particles_to_parameters(particles):
   return parameters
 
 # Save road list as a numpy array
-def roads_to_variables(roads):
-  variables = np.zeros((len(roads), (ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS), dtype=np.float32)
-  for i, road in enumerate(roads):
-    variables[i] = road.to_variables()
+# - the roads can come from many events, they are written into one matrix
+# - if 'out' is given, the first len(roads) rows of 'out' are overwritten and returned
+def roads_to_variables(roads, out=None):
+  nvariables = (ROAD_LAYER_NVARS_P1 * nlayers) + ROAD_INFO_NVARS
+  if out is None:
+    out = np.empty((len(roads), nvariables), dtype=np.float32)
+  if not (out.ndim == 2 and out.shape[0] >= len(roads) and out.shape[1] == nvariables and out.dtype == np.float32):
+    raise ValueError('out must be a float32 array with shape ({0}+, {1}), got {2} {3}'.format(len(roads), nvariables, out.dtype, out.shape))
+  variables = out[:len(roads)]
+  variables[:, 0*nlayers:ROAD_LAYER_NVARS*nlayers] = np.nan                # variables (n=nlayers * 9)
+  variables[:, ROAD_LAYER_NVARS*nlayers:ROAD_LAYER_NVARS_P1*nlayers] = 1.0 # mask      (n=nlayers * 1)
+  if len(roads) == 0:
+    return variables
+
+  #road_info = (ipt, ieta, iphi)
+  road_info = [(road.id[2], road.id[3], road.phi_median, road.theta_median) for road in roads]
+  variables[:, ROAD_LAYER_NVARS_P1*nlayers:] = road_info                   # road info (n=4)
+
+  # Flatten the road hits, keep the first hit in each (road, emtf_layer)
+  road_hits = create_ragged_array([[(hit.emtf_layer, hit.emtf_phi, hit.emtf_theta, hit.emtf_bend, hit.emtf_qual, hit.emtf_time,
+                                     hit.ring, hit.fr, hit.old_emtf_phi, hit.old_emtf_bend) for hit in road.hits] for road in roads])
+  values = road_hits.values.reshape(-1, ROAD_LAYER_NVARS+1)
+  segment_ids = ragged_row_splits_to_segment_ids(road_hits.row_splits)
+  hits_lay = values[:, 0].astype(np.int64)
+  _, first_ihits = np.unique((segment_ids * nlayers) + hits_lay, return_index=True)
+  rows = segment_ids[first_ihits]
+  lays = hits_lay[first_ihits]
+  cols = (np.arange(ROAD_LAYER_NVARS) * nlayers)[np.newaxis, :] + lays[:, np.newaxis]
+  variables[rows[:, np.newaxis], cols] = values[first_ihits, 1:]
+  variables[rows, (ROAD_LAYER_NVARS*nlayers) + lays] = 0.0  # unmask
   return variables
 
 # Based on
@@ -1028,6 +1069,13 @@ def create_ragged_array(pylist):
     values = RaggedTensorValue(values, row_splits)
   return values
 
+def ragged_row_splits_to_segment_ids(row_splits):
+  row_lengths = row_splits[1:] - row_splits[:-1]
+  nrows = row_splits.shape[0] - 1
+  indices = np.arange(nrows, dtype=row_splits.dtype)
+  segment_ids = np.repeat(indices, repeats=row_lengths)
+  return segment_ids
+
 # This class only exists in numpy v1.16.0 or newer
 #from numpy.compat import contextlib_nullcontext
 class contextlib_nullcontext(object):
@@ -1393,56 +1441,63 @@ class RoadCleaning(object):
 
 
 # Road slimming module
+# - all the roads are slimmed at once, using the flattened (CSR) road hits
 class RoadSlimming(object):
   def __init__(self, bank):
     self.bank = bank
+    # Retrieve the phi offset terms for each (ipt, ieta, emtf_layer)
+    self.patterns_xc = find_pattern_x_inverse(self.bank.x_array[..., 1])
 
   def run(self, roads):
-    slim_roads = []
-
-    # Loop over roads
-    for road in roads:
-      ipt, ieta, iphi = road.id[2:]
-
-      # Retrieve the phi offset terms for each emtf_layer
-      patterns_xc = self.bank.x_array[ipt, ieta, :, 1]
-      patterns_xc = find_pattern_x_inverse(patterns_xc)
-
-      # Find the median phi and theta
-      # Note: they do not have to be exact. An approximation is good enough, provided that it is stable against outliers.
-      road_phi_median = np.sort(np.array([hit.emtf_phi - patterns_xc[hit.emtf_layer] for hit in road.hits]))
-      road_phi_median = pick_the_median(road_phi_median)
-
-      road_theta_median = np.sort(np.array([hit.emtf_theta for hit in road.hits]))
-      road_theta_median = pick_the_median(road_theta_median)
-
-      # Loop over all the emtf_layer's, select unique hit for each emtf_layer
-      slim_road_hits = []
-
-      for hit_lay in xrange(nlayers):
-        sort_criteria = []  # for sorting hits
-
-        for ihit, hit in enumerate(road.hits):
-          if hit_lay == hit.emtf_layer:
-            dphi = np.abs(hit.emtf_phi - (road_phi_median + patterns_xc[hit.emtf_layer]))
-            dtheta = np.abs(hit.emtf_theta - road_theta_median)
-            neg_qual = -np.abs(hit.emtf_qual)
-            sort_criteria.append((ihit, dphi, dtheta, neg_qual))
+    # Skip if no roads
+    if len(roads) == 0:
+      return []
 
-        # Find the best hit, which is (max qual, min dtheta, min dphi, min ihit)
-        if sort_criteria:
-          best_ihit = min(sort_criteria, key=lambda x: (x[3], x[2], x[1], x[0]))[0]
-          best_hit = road.hits[best_ihit]
-          slim_road_hits.append(best_hit)
+    # Flatten the road hits. The hits of road i are in [row_splits[i], row_splits[i+1]).
+    road_hits = create_ragged_array([[(hit.emtf_layer, hit.emtf_phi, hit.emtf_theta, hit.emtf_qual) for hit in road.hits] for road in roads])
+    row_splits = road_hits.row_splits
+    segment_ids = ragged_row_splits_to_segment_ids(row_splits)
+    hits_lay, hits_phi, hits_theta, hits_qual = road_hits.values.reshape(-1, 4).T
+    road_ipt_ieta = np.array([road.id[2:4] for road in roads], dtype=np.int32)
+    hits_xc = self.patterns_xc[road_ipt_ieta[segment_ids, 0], road_ipt_ieta[segment_ids, 1], hits_lay]
+
+    # Find the median phi and theta
+    # Note: they do not have to be exact. An approximation is good enough, provided that it is stable against outliers.
+    road_phi_median = pick_the_median_segmented(hits_phi - hits_xc, row_splits)
+    road_theta_median = pick_the_median_segmented(hits_theta, row_splits)
+
+    # Select unique hit for each (road, emtf_layer)
+    # Find the best hit, which is (max qual, min dtheta, min dphi, min ihit)
+    # Note: np.lexsort is stable, so the ties are resolved by the hit index.
+    dphi = np.abs(hits_phi - (road_phi_median[segment_ids] + hits_xc))
+    dtheta = np.abs(hits_theta - road_theta_median[segment_ids])
+    neg_qual = -np.abs(hits_qual)
+    order = np.lexsort((dphi, dtheta, neg_qual, hits_lay, segment_ids))
+    group = (segment_ids[order] * nlayers) + hits_lay[order]
+    is_first = np.ones(order.shape, dtype=np.bool)
+    is_first[1:] = (group[1:] != group[:-1])
+    best_ihits = order[is_first]  # sorted by (road, emtf_layer)
+    best_row_splits = np.append(0, np.cumsum(np.bincount(segment_ids[best_ihits], minlength=len(roads))))
 
-      slim_road = Road(road.id, slim_road_hits, road.mode, road.quality, road.sort_code, road_phi_median, road_theta_median)
+    slim_roads = []
+    all_hits = [hit for road in roads for hit in road.hits]
+    for iroad, road in enumerate(roads):
+      slim_road_hits = [all_hits[ihit] for ihit in best_ihits[best_row_splits[iroad]:best_row_splits[iroad+1]]]
+      slim_road = Road(road.id, slim_road_hits, road.mode, road.quality, road.sort_code, road_phi_median[iroad], road_theta_median[iroad])
       slim_roads.append(slim_road)
     return slim_roads
 
 
 # pT assignment module
+# - each model is a named (encoder, model) pair: 'default', 'run3' or 'omtf'
+# - names selects the models to run; the first one is the main model, used by
+#   predict() and run(), while predict_all() and run_all() give the predictions
+#   of all the models for the same roads
+# - each model runs on the roads of the pattern recognition it is trained on,
+#   get_groups() gives the models of each (omtf_input, run2_input)
+# - the roads are encoded once for the models that share the same encoder
 class PtAssignment(object):
-  def __init__(self, kerasfile, omtf_input=False, run2_input=False):
+  def __init__(self, kerasfile, omtf_input=False, run2_input=False, backend='keras', cachesize=0, cachefile=None, names=None):
     (model_file, model_weights_file, model_run3_file, model_run3_weights_file, model_omtf_file, model_omtf_weights_file) = kerasfile
     self.omtf_input = omtf_input
     self.run2_input = run2_input
@@ -1451,38 +1506,146 @@ class PtAssignment(object):
     self.reg_dxy_scale = 0.4
 
     # Get encoders
-    from nn_encode import create_encoder
+    from nn_encode import create_encoder, encode_chunked
     from nn_encode_run3 import create_encoder as create_encoder_run3
     from nn_encode_omtf import create_encoder as create_encoder_omtf
+    self.encode_chunked = encode_chunked
     from functools import partial
     self.create_encoder = partial(create_encoder, reg_pt_scale=self.reg_pt_scale, reg_dxy_scale=self.reg_dxy_scale)
     self.create_encoder_run3 = partial(create_encoder_run3, reg_pt_scale=self.reg_pt_scale, reg_dxy_scale=self.reg_dxy_scale)
     self.create_encoder_omtf = partial(create_encoder_omtf, reg_pt_scale=self.reg_pt_scale, reg_dxy_scale=self.reg_dxy_scale)
+    self.encoders = {'default': self.create_encoder, 'run3': self.create_encoder_run3}
+
+    # Named models: (encoder, get_x() options, model file, model weights file)
+    # The OMTF encoder does the same preprocessing as the default encoder, and
+    # only keeps different columns in get_x(), so the default encoder is used
+    self.model_configs = OrderedDict([
+      ('default', ('default', dict(drop_columns_emtf=True, drop_columns_omtf=False), model_file, model_weights_file)),
+      ('run3', ('run3', dict(), model_run3_file, model_run3_weights_file)),
+      ('omtf', ('default', dict(drop_columns_emtf=False, drop_columns_omtf=True), model_omtf_file, model_omtf_weights_file)),
+    ])
+    # Roads that each model is trained on: (omtf_input, run2_input) of the pattern recognition
+    self.model_inputs = {'default': (False, False), 'run3': (False, True), 'omtf': (True, False)}
+    if names is None:
+      if omtf_input:
+        names = ['omtf']
+      elif run2_input:
+        names = ['run3']
+      else:
+        names = ['default']
+    for name in names:
+      if name not in self.model_configs:
+        raise RuntimeError('Cannot recognize model: {0}'.format(name))
+    self.names = list(names)
+
+    # Models are loaded at the first prediction, so that TensorFlow is not
+    # imported by the jobs that never call predict()
+    if backend not in ('keras', 'graph', 'numpy', 'quant'):
+      raise RuntimeError('Cannot recognize backend: {0}'.format(backend))
+    self.backend = backend
+    self.loaded_models = {}
+
+    # Cache of the NN outputs (see nn_cache.py)
+    self.cachesize = cachesize
+    self.cachefile = cachefile
 
-    # Load Keras models
-    from nn_models import load_my_model, update_keras_custom_objects
-    update_keras_custom_objects()
-    self.loaded_model = load_my_model(name=model_file, weights_name=model_weights_file)
-    #self.loaded_model_run3 = load_my_model(name=model_run3_file, weights_name=model_run3_weights_file)
-    #self.loaded_model_omtf = load_my_model(name=model_omtf_file, weights_name=model_omtf_weights_file)
-    self.loaded_model.trainable = False
-    #self.loaded_model_run3.trainable = False
-    #self.loaded_model_omtf.trainable = False
-    assert(not self.loaded_model.updates)
-    #assert(not self.loaded_model_run3.updates)
-    #assert(not self.loaded_model_omtf.updates)
+  @property
+  def loaded_model(self):
+    return self.get_model(self.names[0])
+
+  def get_groups(self):
+    # (omtf_input, run2_input) -> names of the models, the group of the main model first
+    groups = OrderedDict()
+    for name in self.names:
+      groups.setdefault(self.model_inputs[name], []).append(name)
+    return groups
+
+  def get_model(self, name):
+    if name not in self.loaded_models:
+      self.loaded_models[name] = self.load_model(name)
+    return self.loaded_models[name]
+
+  def get_model_files(self, name):
+    (_, _, model_file, model_weights_file) = self.model_configs[name]
+    if self.backend in ('numpy', 'quant'):
+      from nn_numpy import numpy_model_file
+      return [numpy_model_file(model_file)]
+    elif self.backend == 'graph':
+      from nn_graph import graph_model_file
+      return [graph_model_file(model_file)]
+    else:
+      return [model_file, model_weights_file]
+
+  def get_identity(self):
+    # The backend and the contents of the model files of all the models that are run
+    from nn_cache import file_identity
+    return make_key(self.backend, *[name + ':' + file_identity(*self.get_model_files(name)) for name in self.names])
+
+  def load_model(self, name='default'):
+    (_, _, model_file, model_weights_file) = self.model_configs[name]
+    model_files = self.get_model_files(name)
+    start_time = datetime.datetime.now()
+
+    if self.backend in ('numpy', 'quant'):
+      # Load NumPy models (converted by nn_numpy.py), which do not need TensorFlow
+      # 'quant' runs the fixed-point emulation of the NumPy models
+      from nn_numpy import load_numpy_model, QuantizedModel
+      loaded_model = load_numpy_model(model_files[0])
+      if self.backend == 'quant':
+        loaded_model = QuantizedModel(loaded_model)
+
+    elif self.backend == 'graph':
+      # Load frozen graphs (converted by test5/convert_to_constant_graph.py), which do not need Keras
+      from nn_graph import load_graph_model
+      loaded_model = load_graph_model(model_files[0])
 
-  def predict(self, x):
-    if self.omtf_input:
-      encoder = self.create_encoder_omtf(x)
-      loaded_model = self.loaded_model_omtf
-    elif self.run2_input:
-      encoder = self.create_encoder_run3(x)
-      loaded_model = self.loaded_model_run3
     else:
-      encoder = self.create_encoder(x)
-      loaded_model = self.loaded_model
+      # Load Keras models
+      from nn_models import load_my_model, update_keras_custom_objects
+      update_keras_custom_objects()
+      loaded_model = load_my_model(name=model_file, weights_name=model_weights_file)
+      loaded_model.trainable = False
+      assert(not loaded_model.updates)
+
+    stop_time = datetime.datetime.now()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # in MB
+    print('[INFO] Loaded NN model {0} ({1}) in {2}, max RSS: {3:.0f} MB'.format(model_file, self.backend, stop_time - start_time, maxrss))
+
+    if self.cachesize > 0 or self.cachefile is not None:
+      # The model identity includes the backend, as 'quant' does not give the same outputs as 'numpy'
+      from nn_cache import CachedModel, file_identity
+      identity = self.backend + ':' + file_identity(*model_files)
+      loaded_model = CachedModel(loaded_model, identity, maxsize=self.cachesize, filename=self.cachefile)
+      atexit.register(loaded_model.close)
+      atexit.register(loaded_model.report)
+      print('[INFO] Using NN cache (size: {0}, file: {1})'.format(self.cachesize, self.cachefile))
+    return loaded_model
 
+  def predict(self, x):
+    return self.predict_all(x, names=self.names[:1])[self.names[0]]
+
+  def predict_all(self, x, names=None):
+    if names is None:
+      names = self.names
+
+    # Encode once per encoder, with the layouts of x needed by its models
+    x_kwargs = OrderedDict()
+    for name in names:
+      (encoder, kwargs, _, _) = self.model_configs[name]
+      x_kwargs.setdefault(encoder, {})[name] = kwargs
+    encoded = {}
+    for (encoder, kwargs) in x_kwargs.iteritems():
+      encoded[encoder] = self.encode_chunked(self.encoders[encoder], x, x_kwargs=kwargs)
+
+    results = OrderedDict()
+    for name in names:
+      encoded_1 = encoded[self.model_configs[name][0]]
+      x_new = encoded_1[name]
+      y = self.get_model(name).predict(x_new)
+      results[name] = (x_new, self.transform(y), encoded_1['x_mask'], encoded_1['x_road'])
+    return results
+
+  def transform(self, y):
     def np_relu(x):
       # ReLU(x) = max(0, x)
       return x * (x >= 0.)
@@ -1504,11 +1667,6 @@ class PtAssignment(object):
     def get_scale(scale):
       return 1e-5 + np_softplus(0.01 * scale)
 
-    x_new = encoder.get_x()
-    y = loaded_model.predict(x_new)
-    z = encoder.get_x_mask()
-    t = encoder.get_x_road()
-
     assert y.ndim == 2
     y[..., 0] = get_loc(y[..., 0])
     y[..., 1] = get_sign(y[..., 1])
@@ -1529,7 +1687,7 @@ class PtAssignment(object):
     y[..., 0] *= y[..., 1]
     y[..., 3] *= y[..., 4]
     y[..., 6] *= y[..., 7]
-    return (x_new, y, z, t)
+    return y
 
   def postprocessing(self, x_new, y):
     y_pred = y[..., 0]
@@ -1547,16 +1705,89 @@ class PtAssignment(object):
     return y_new
 
   def run(self, x):
-    x_new = np.array([], dtype=np.float32)
-    y = np.array([], dtype=np.float32)
-    z = np.array([], dtype=np.float32)
-    t = np.array([], dtype=np.float32)
+    return self.run_all(x, names=self.names[:1])[self.names[0]]
+
+  def run_all(self, x, names=None):
+    if names is None:
+      names = self.names
+
+    results = OrderedDict()
     if len(x) == 0:
-      return (x_new, y, z, t)
+      for name in names:
+        x_new = np.array([], dtype=np.float32)
+        y = np.array([], dtype=np.float32)
+        z = np.array([], dtype=np.float32)
+        t = np.array([], dtype=np.float32)
+        results[name] = (x_new, y, z, t)
+      return results
+
+    for (name, (x_new, y, z, t)) in self.predict_all(x, names=names).iteritems():
+      y_new = self.postprocessing(x_new, y)
+      results[name] = (x_new, y_new, z, t)
+    return results
+
+# pT assignment over roads accumulated from many events
+# - put() holds the slim roads of an event together with a callback; the slim
+#   roads are given per (omtf_input, run2_input), for each group of models of
+#   PtAssignment.get_groups()
+# - when at least batch_size roads are held (or at flush()), the roads of each
+#   group are encoded and predicted at once by the models of the group, then the
+#   callbacks are called in the order of put() with (slim_roads, results), where
+#   results maps each model name to (variables, predictions, x_mask_vars,
+#   x_road_vars), the same as the per-event roads_to_variables() +
+#   PtAssignment.run_all() on the roads of its group
+# - batch_size <= 1 calls back immediately, i.e. once per event
+# - anything the callback needs from the event must be copied beforehand, as
+#   the event object is reused by the tree (see EventSnapshot)
+class PtAssignmentBatcher(object):
+  def __init__(self, ptassig, batch_size=1024):
+    self.ptassig = ptassig
+    self.batch_size = batch_size
+    self.pending = []
+    self.pending_nroads = 0
+
+  def put(self, slim_roads, callback):
+    self.pending.append((slim_roads, callback))
+    self.pending_nroads += sum([len(group_roads) for group_roads in slim_roads.itervalues()])
+    if self.batch_size <= 1 or self.pending_nroads >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if not self.pending:
+      return
+    pending = self.pending
+    self.pending = []
+    self.pending_nroads = 0
+
+    empty = np.array([], dtype=np.float32)
+    pending_results = [OrderedDict((name, None) for name in self.ptassig.names) for _ in pending]
+    for (inputs, names) in self.ptassig.get_groups().iteritems():
+      all_slim_roads = [road for (slim_roads, callback) in pending for road in slim_roads[inputs]]
+      all_variables = roads_to_variables(all_slim_roads)
+      all_results = self.ptassig.run_all(all_variables, names=names)
+
+      i = 0
+      for ((slim_roads, callback), results) in zip(pending, pending_results):
+        j = i + len(slim_roads[inputs])
+        for (name, (all_x_new, all_y, all_z, all_t)) in all_results.iteritems():
+          if i == j:
+            results[name] = (empty, empty, empty, empty)
+          else:
+            results[name] = (all_x_new[i:j], all_y[i:j], all_z[i:j], all_t[i:j])
+        i = j
+      assert(i == len(all_slim_roads))
+
+    for ((slim_roads, callback), results) in zip(pending, pending_results):
+      callback(slim_roads, results)
 
-    (x_new, y, z, t) = self.predict(x)
-    y_new = self.postprocessing(x_new, y)
-    return (x_new, y_new, z, t)
+# Copy of the attributes of the event objects (tracks, particles, etc)
+class EventSnapshot(object):
+  def __init__(self, obj, attrs):
+    for attr in attrs:
+      setattr(self, attr, getattr(obj, attr))
+
+def snapshot_collection(collection, attrs):
+  return [EventSnapshot(obj, attrs) for obj in collection]
 
 
 # Track producer module
@@ -1608,6 +1839,9 @@ class TrackProducer(object):
     self.s_lut = np.asarray(self.s_lut)
     self.s_lut_wp50 = np.asarray(self.s_lut_wp50)
 
+    # Lower edges of the LUT bins, precomputed as binx * s_step for the vectorized functions
+    self.s_lut_x = np.arange(self.s_nbins, dtype=np.int32) * self.s_step
+
   def get_trigger_pt(self, y_pred):
     xml_pt = np.abs(1.0/y_pred)
     if xml_pt <= 2.:  # do not use the LUT if below 2 GeV
@@ -1708,7 +1942,50 @@ class TrackProducer(object):
     #    trigger = (y_discr >= 0.) and strg_ok
     return trigger
 
-  def run(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
+  # Vectorized versions of get_trigger_pt(), get_trigger_pt_wp50() and pass_trigger()
+  # - they take arrays with one entry per track, and give the same results as
+  #   calling the scalar versions on each entry
+  # - y_pred should be in double precision, as the scalar versions are called with
+  #   Python floats
+  def get_trigger_pt_vectorized(self, y_pred, s_lut=None):
+    if s_lut is None:
+      s_lut = self.s_lut
+    xml_pt = np.abs(1.0/y_pred)
+
+    def digitize(x, bins=(self.s_nbins, self.s_min, self.s_max)):
+      x = np.clip(x, bins[1], bins[2]-1e-5)
+      x = (x - bins[1]) / (bins[2] - bins[1]) * bins[0]
+      binx = x.astype(np.int32)
+      binx[binx == bins[0]-1] -= 1  # avoid boundary
+      return binx
+
+    def interpolate(x, x0, x1, y0, y1):
+      y = (x - x0) / (x1 - x0) * (y1 - y0) + y0
+      return y
+
+    binx = digitize(xml_pt)
+    x0, x1 = self.s_lut_x[binx], self.s_lut_x[binx+1]
+    y0, y1 = s_lut[binx], s_lut[binx+1]
+    trg_pt = interpolate(xml_pt, x0, x1, y0, y1)
+    use_lut = (xml_pt > 2.)  # do not use the LUT if below 2 GeV
+    assert(np.all(trg_pt[use_lut] > 2.))
+    return np.where(use_lut, trg_pt, xml_pt)
+
+  def get_trigger_pt_wp50_vectorized(self, y_pred):
+    return self.get_trigger_pt_vectorized(y_pred, s_lut=self.s_lut_wp50)
+
+  def pass_trigger_vectorized(self, ndof, mode, strg, zone, theta_median, y_pred, y_discr, d0_pred):
+    ipt1 = strg.astype(np.int32)
+    ipt2 = np.clip(np.digitize(y_pred, pt_bins[1:]), 0, len(pt_bins)-2)  # same as find_pt_bin()
+    quality1 = find_emtf_road_quality(ipt1)
+    quality2 = find_emtf_road_quality(ipt2)
+    strg_ok = (quality2 <= (quality1+1))
+    trigger = (y_discr >= 0.)
+    return trigger
+
+  # Variables of all the roads as arrays, and the trigger decision
+  # - used by run() and run_table()
+  def get_track_variables(self, variables, predictions, x_mask_vars, x_road_vars):
 
     # __________________________________________________________________________
     # Extra pieces
@@ -1737,66 +2014,137 @@ class TrackProducer(object):
       return eta
 
     def get_ndof_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
+      assert(x_mask.shape[1] == nlayers)
       assert(x_mask.dtype == np.bool)
       valid = ~x_mask
-      return valid.sum()
+      return valid.sum(axis=1)
 
     def get_mode_from_x_mask(x_mask):
-      assert(x_mask.shape[0] == nlayers)
+      assert(x_mask.shape[1] == nlayers)
       assert(x_mask.dtype == np.bool)
       valid = ~x_mask
-      mode = np.int32(0)
-      if np.any((valid[0], valid[1], valid[5], valid[9], valid[11])):   # ME1/1, ME1/2, RE1/2, GE1/1, ME0
-        mode |= (1<<3)
-      if np.any((valid[2], valid[6], valid[10])):  # ME2, RE2, GE2/1
-        mode |= (1<<2)
-      if np.any((valid[3], valid[7])):  # ME3, RE3
-        mode |= (1<<1)
-      if np.any((valid[4], valid[8])):  # ME4, RE4
-        mode |= (1<<0)
+      mode = np.zeros(x_mask.shape[0], dtype=np.int32)
+      mode[valid[:, (0,1,5,9,11)].any(axis=1)] |= (1<<3)  # ME1/1, ME1/2, RE1/2, GE1/1, ME0
+      mode[valid[:, (2,6,10)].any(axis=1)] |= (1<<2)      # ME2, RE2, GE2/1
+      mode[valid[:, (3,7)].any(axis=1)] |= (1<<1)         # ME3, RE3
+      mode[valid[:, (4,8)].any(axis=1)] |= (1<<0)         # ME4, RE4
       return mode
 
     # __________________________________________________________________________
+    assert(variables.shape[1:] == (36,))
+    assert(predictions.shape[1:] == (9,))
+    assert(x_mask_vars.shape[1:] == (nlayers,))
+    assert(x_road_vars.shape[1:] == (4,))
+
+    y_pred = predictions[:, 0].astype(np.float64)
+    y_discr = np.ones_like(predictions[:, 0], dtype=np.float32)  # OBSOLETE since v3
+    d1_pred = predictions[:, 3].astype(np.float64)
+    d0_pred = predictions[:, 6].astype(np.float64)
+    ndof = get_ndof_from_x_mask(x_mask_vars)
+    mode = get_mode_from_x_mask(x_mask_vars)
+    strg, zone, phi_median, theta_median = x_road_vars.T
+    eta = theta_to_eta_f(theta_median) # absolute eta
+
+    passed = self.pass_trigger_vectorized(ndof, mode, strg, zone, theta_median, y_pred, y_discr, d0_pred)
+
+    xml_pt = np.abs(1.0/y_pred)
+    pt = self.get_trigger_pt_vectorized(y_pred)
+    use_wp50 = (2.15 <= eta) & (eta <= 2.25)
+    pt[use_wp50] = self.get_trigger_pt_wp50_vectorized(y_pred[use_wp50])
+
+    pt_displ = self.get_trigger_pt_vectorized(d1_pred)
+
+    trk_q = np.sign(y_pred).astype(np.int32)
+
+    track_vars = dict(
+        passed=passed, mode=mode, ndof=ndof, xml_pt=xml_pt, pt=pt, q=trk_q, y_pred=y_pred, y_discr=y_discr,
+        y_displ=d1_pred, d0_displ=d0_pred, pt_displ=pt_displ, emtf_phi=phi_median, emtf_theta=theta_median)
+    return track_vars
+
+  def run(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
     assert(len(slim_roads) == len(variables))
     assert(len(slim_roads) == len(predictions))
     assert(len(slim_roads) == len(x_mask_vars))
     assert(len(slim_roads) == len(x_road_vars))
 
     tracks = []
+    if len(slim_roads) == 0:
+      return tracks
 
-    for myroad, x, y, x_mask, x_road in zip(slim_roads, variables, predictions, x_mask_vars, x_road_vars):
-      assert(x.shape == (36,))
-      assert(y.shape == (9,))
-      assert(x_mask.shape == (nlayers,))
-      assert(x_road.shape == (4,))
-
-      y_pred = np.asscalar(y[..., 0])
-      y_discr = np.ones_like(y[..., 0], dtype=np.float32)  # OBSOLETE since v3
-      d1_pred = np.asscalar(y[..., 3])
-      d0_pred = np.asscalar(y[..., 6])
-      ndof = get_ndof_from_x_mask(x_mask)
-      mode = get_mode_from_x_mask(x_mask)
-      strg, zone, phi_median, theta_median = x_road
-      eta = theta_to_eta_f(theta_median) # absolute eta
-
-      passed = self.pass_trigger(ndof, mode, strg, zone, theta_median, y_pred, y_discr, d0_pred)
-
-      if passed:
-        xml_pt = np.abs(1.0/y_pred)
-        pt = self.get_trigger_pt(y_pred)
-        if 2.15 <= eta <= 2.25:
-          pt = self.get_trigger_pt_wp50(y_pred)
-
-        pt_displ = self.get_trigger_pt(d1_pred)
-
-        trk_q = np.sign(y_pred).astype(np.int32)
-        trk = Track(myroad.id, myroad.hits, mode, myroad.quality, myroad.sort_code,
-                    xml_pt, pt, trk_q, y_pred, y_discr,
-                    d1_pred, d0_pred, pt_displ, phi_median, theta_median)
-        tracks.append(trk)
+    # All the roads are converted at once, only the accepted ones become tracks
+    v = self.get_track_variables(variables, predictions, x_mask_vars, x_road_vars)
+
+    for i in np.nonzero(v['passed'])[0]:
+      myroad = slim_roads[i]
+      trk = Track(myroad.id, myroad.hits, v['mode'][i], myroad.quality, myroad.sort_code,
+                  v['xml_pt'][i], v['pt'][i], v['q'][i], v['y_pred'][i], v['y_discr'][i],
+                  v['y_displ'][i], v['d0_displ'][i], v['pt_displ'][i], v['emtf_phi'][i], v['emtf_theta'][i])
+      tracks.append(trk)
     return tracks
 
+  def run_table(self, slim_roads, variables, predictions, x_mask_vars, x_road_vars):
+    # Same as run(), but returns (tracks, hits) as a track table and a hit table
+    # (see track_table_dtype) instead of a list of Track objects
+
+    def calc_phi_glob_deg_vectorized(emtf_phi, sector):
+      # Same as calc_phi_glob_deg(calc_phi_loc_deg(emtf_phi), sector)
+      loc = emtf_phi.astype(np.float64)/60. - 22.
+      glob = loc + 15. + (60. * (sector-1))
+      glob[glob >= 180.] -= 360.
+      return glob
+
+    def calc_eta_from_theta_int_vectorized(emtf_theta, endcap):
+      # Same as calc_eta_from_theta_deg(calc_theta_deg_from_int(emtf_theta), endcap)
+      theta_deg = emtf_theta.astype(np.float64) * (45.0-8.5)/128. + 8.5
+      theta_deg = np.abs(theta_deg)
+      while np.any(theta_deg >= 180.):
+        theta_deg[theta_deg >= 180.] -= 180.
+      theta_deg = np.where(theta_deg >= 180./2, 180. - theta_deg, theta_deg)
+      eta = calc_eta_from_theta_rad(np.deg2rad(theta_deg))
+      eta[endcap == -1] *= -1
+      return eta
+
+    assert(len(slim_roads) == len(variables))
+    assert(len(slim_roads) == len(predictions))
+    assert(len(slim_roads) == len(x_mask_vars))
+    assert(len(slim_roads) == len(x_road_vars))
+
+    if len(slim_roads) == 0:
+      tracks = np.zeros(0, dtype=track_table_dtype).view(np.recarray)
+      hits = np.zeros(0, dtype=track_hit_table_dtype).view(np.recarray)
+      return (tracks, hits)
+
+    v = self.get_track_variables(variables, predictions, x_mask_vars, x_road_vars)
+    passed = np.nonzero(v['passed'])[0]
+    passed_roads = [slim_roads[i] for i in passed]
+
+    tracks = np.zeros(len(passed), dtype=track_table_dtype).view(np.recarray)
+    road_ids = np.array([myroad.id for myroad in passed_roads], dtype=np.int32).reshape(-1, 5)
+    tracks.endcap, tracks.sector, tracks.ipt, tracks.ieta, tracks.iphi = road_ids.T
+    tracks.endsec = np.where(road_ids[:, 0] == 1, road_ids[:, 1] - 1, road_ids[:, 1] - 1 + 6)  # same as find_endsec()
+    tracks.quality = [myroad.quality for myroad in passed_roads]
+    tracks.sort_code = [myroad.sort_code for myroad in passed_roads]
+    for k in ('mode', 'ndof', 'xml_pt', 'pt', 'q', 'y_pred', 'y_discr', 'y_displ', 'd0_displ', 'pt_displ', 'emtf_phi', 'emtf_theta'):
+      tracks[k] = v[k][passed]
+    tracks.phi = calc_phi_glob_deg_vectorized(tracks.emtf_phi, road_ids[:, 1])
+    tracks.eta = calc_eta_from_theta_int_vectorized(tracks.emtf_theta, road_ids[:, 0])
+    tracks.road = passed
+
+    # Hit table
+    nhits = np.array([len(myroad.hits) for myroad in passed_roads], dtype=np.int32)
+    tracks.nhits = nhits
+    tracks.hit_offset = np.cumsum(nhits) - nhits
+    hits = [(hit.endsec, hit.emtf_layer, hit.emtf_phi) for myroad in passed_roads for hit in myroad.hits]
+    hits = np.array(hits, dtype=track_hit_table_dtype).view(np.recarray)
+    return (tracks, hits)
+
+  def run_all(self, slim_roads, results):
+    # results maps each model name to (variables, predictions, x_mask_vars, x_road_vars)
+    all_tracks = OrderedDict()
+    for (name, (variables, predictions, x_mask_vars, x_road_vars)) in results.iteritems():
+      all_tracks[name] = self.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
+    return all_tracks
+
 
 # Ghost busting module
 class GhostBusting(object):
@@ -1833,30 +2181,68 @@ class GhostBusting(object):
       return find_endsec(trk.id[0], trk.id[1])
 
     # Loop over the sorted tracks and remove duplicates (ghosts)
+    # A track is a ghost if it shares a hit with any track before it (kept or
+    # not), so the hits of every track are added to the index
+    seen_hits = set()
     for i in xrange(len(tracks)):
-      keep = True
-
       # Do not share ME1/1, ME1/2, RE1/2, GE1/1, ME0, MB1, MB2
       # Need to check for neighbor sector hits
-      if keep:
-        track_i = tracks[i]
-        hits_i = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_i.hits if hit.emtf_layer in (0,1,5,9,11,12,13)]
-
-        for j in xrange(i):
-          track_j = tracks[j]
-          hits_j = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_j.hits if hit.emtf_layer in (0,1,5,9,11,12,13)]
-          if set(hits_i).intersection(hits_j):  # has sharing
-            keep = False
-            break
+      track_i = tracks[i]
+      hits_i = [(get_gb_endsec(hit)*100 + hit.emtf_layer, get_gb_emtf_phi(hit)) for hit in track_i.hits if hit.emtf_layer in (0,1,5,9,11,12,13)]
+      keep = seen_hits.isdisjoint(hits_i)  # no sharing
+      seen_hits.update(hits_i)
 
       if keep:
-        track_i = tracks[i]
+        tracks_after_gb.append(track_i)
 
-        # Output tracks following the order of sector processors
-        ind = np.searchsorted([get_gb_track_endsec(x) for x in tracks_after_gb], get_gb_track_endsec(track_i))
-        tracks_after_gb.insert(ind, track_i)
+    # Output tracks following the order of sector processors
+    # Within the same sector processor, the track kept last comes first, as it
+    # used to be inserted with searchsorted() before the tracks of the same sector
+    tracks_after_gb.reverse()
+    tracks_after_gb.sort(key=get_gb_track_endsec)  # stable sort
     return tracks_after_gb
 
+  def run_table(self, tracks, hits):
+    # Same as run(), with the track and hit tables from TrackProducer.run_table()
+    if len(tracks) == 0:
+      return tracks
+
+    # Sort by 'sort code' (stable, like list.sort())
+    order = np.argsort(-tracks.sort_code, kind='mergesort')
+
+    # Hits of the sorted tracks that cannot be shared: ME1/1, ME1/2, RE1/2, GE1/1, ME0, MB1, MB2
+    nhits = tracks.nhits[order].astype(np.int64)
+    rank = np.repeat(np.arange(len(order)), nhits)
+    ind = np.concatenate([np.arange(tracks.hit_offset[i], tracks.hit_offset[i] + tracks.nhits[i]) for i in order])
+    endsec = hits.endsec[ind].astype(np.int64)
+    emtf_layer = hits.emtf_layer[ind].astype(np.int64)
+    emtf_phi = hits.emtf_phi[ind].astype(np.int64)
+    sel = np.in1d(emtf_layer, (0,1,5,9,11,12,13))
+    (rank, endsec, emtf_layer, emtf_phi) = (rank[sel], endsec[sel], emtf_layer[sel], emtf_phi[sel])
+
+    # Need to check for neighbor sector hits, same as get_gb_endsec() and get_gb_emtf_phi()
+    neighbor = (emtf_phi < (22*60))
+    first_sector = (endsec == 0) | (endsec == 6)
+    other_sector = ((1 <= endsec) & (endsec <= 5)) | ((7 <= endsec) & (endsec <= 11))
+    endsec[neighbor & first_sector] += 5
+    endsec[neighbor & other_sector] -= 1
+    emtf_phi[neighbor] += (60*60)
+
+    # A track is a ghost if it shares a hit with any track before it
+    keys = (endsec*100 + emtf_layer) * (1<<16) + emtf_phi
+    (_, inverse) = np.unique(keys, return_inverse=True)
+    first_rank = np.full(inverse.max()+1 if inverse.size else 0, len(order), dtype=np.int64)
+    np.minimum.at(first_rank, inverse, rank)
+    ghost = np.zeros(len(order), dtype=np.bool)
+    ghost[rank[first_rank[inverse] < rank]] = True
+
+    # Output tracks following the order of sector processors. Within the same
+    # sector processor, the tracks kept later come first, as in run()
+    kept = order[~ghost]
+    kept_rank = np.arange(len(order))[~ghost]
+    kept = kept[np.lexsort((-kept_rank, tracks.endsec[kept]))]
+    return tracks[kept]
+
 
 # Track-muon correlation module (stolen from Luca Cadamuro)
 #     https://github.com/cms-l1t-offline/cmssw/blob/phase2-l1t-integration-CMSSW_10_6_0_pre4/L1Trigger/L1TTrackMatch/interface/L1TkMuCorrDynamicWindows.h
@@ -1916,124 +2302,118 @@ class TrackMuonCorrelation(object):
     self.also_check_pt = True
 
   def run(self, particles, tracks):
-    matched = np.zeros((len(particles), len(tracks)), dtype=np.bool)
+    # The matching is done for all (particle, track) pairs at once, as
+    # (n_particles, n_tracks) arrays. The tracks can be a list of Track objects
+    # or a track table.
 
     def sf_progressive(x, xstart, xstop, ystart, ystop):
-      if (x < xstart):
-        return ystart
-      elif (x >= xstop):
-        return ystop
-      else:
-        return ystart + (x-xstart)*(ystop-ystart)/(xstop-xstart)
+      y = ystart + (x-xstart)*(ystop-ystart)/(xstop-xstart)
+      y = np.where(x < xstart, ystart, y)
+      y = np.where(x >= xstop, ystop, y)
+      return y
 
     def get_ibin(eta):
-      ieta = np.digitize((abs(eta),), self.bounds[1:])[0]  # skip lowest edge
-      if ieta > self.nbins-1:
-        ieta = self.nbins-1
+      ieta = np.digitize(np.abs(eta), self.bounds[1:])  # skip lowest edge
+      ieta = np.minimum(ieta, self.nbins-1)
       return ieta
 
-    def get_theta_bound_low(part_eta, part_pt):
+    def get_bound(wdws, part_eta, part_pt):
       # [Const]+[A]*TMath::Power(x,[B])
       f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_theta_low[get_ibin(part_eta)]
+      a, b, c = wdws[get_ibin(part_eta)].T
       return f(part_pt, a, b, c)
 
-    def get_theta_bound_high(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_theta_high[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
-
-    def get_phi_bound_low(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_phi_low[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
+    def delta_phi_vectorized(lhs, rhs):  # same as delta_phi()
+      rad = lhs - rhs
+      while np.any(rad < -np.pi):
+        rad[rad < -np.pi] += np.pi*2
+      while np.any(rad >= +np.pi):
+        rad[rad >= +np.pi] -= np.pi*2
+      return rad
 
-    def get_phi_bound_high(part_eta, part_pt):
-      # [Const]+[A]*TMath::Power(x,[B])
-      f = lambda x, a, b, c: a + b * np.power(np.clip(x, 2., 100.), c)
-      a, b, c = self.wdws_phi_high[get_ibin(part_eta)]
-      return f(part_pt, a, b, c)
-
-    # Loop over tracking particles
+    # Tracking particles
     for ipart, part in enumerate(particles):
       part.invpt = np.true_divide(part.q, part.pt)
       part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
 
-      # Skip particles that are not (BX=0, |eta|>1, |d0|<10 cm, |z0|<100 cm)
-      if not ((part.bx == 0) and (np.abs(part.eta) > 1.) and (np.abs(part.d0) < 10.) and (np.abs(part.vz) < 100.)):
-        continue
+    part_pt = np.array([part.pt for part in particles], dtype=np.float64)
+    part_eta = np.array([part.eta for part in particles], dtype=np.float64)
+    part_phi = np.array([part.phi for part in particles], dtype=np.float64)
+    part_theta = np.array([part.theta for part in particles], dtype=np.float64)
+    part_q = np.array([part.q for part in particles], dtype=np.int32)
+    part_d0 = np.array([part.d0 for part in particles], dtype=np.float64)
+    part_vz = np.array([part.vz for part in particles], dtype=np.float64)
+    part_bx = np.array([part.bx for part in particles], dtype=np.int32)
+
+    # Skip particles that are not (BX=0, |eta|>1, |d0|<10 cm, |z0|<100 cm)
+    part_sel = (part_bx == 0) & (np.abs(part_eta) > 1.) & (np.abs(part_d0) < 10.) & (np.abs(part_vz) < 100.)
+
+    # Standalone muons
+    if isinstance(tracks, np.ndarray):  # track table
+      trk_pt, trk_eta, trk_phi = tracks.pt, tracks.eta, tracks.phi
+    else:
+      trk_pt = np.array([trk.pt for trk in tracks], dtype=np.float64)
+      trk_eta = np.array([trk.eta for trk in tracks], dtype=np.float64)
+      trk_phi = np.array([trk.phi for trk in tracks], dtype=np.float64)
 
-      # Get boundaries
-      if self.do_relax_factor:
-        sf_l = sf_progressive(part.pt, self.pt_start, self.pt_end, self.initial_sf_l, self.safety_factor_l)
-        sf_h = sf_progressive(part.pt, self.pt_start, self.pt_end, self.initial_sf_h, self.safety_factor_h)
-      else:
-        sf_l = self.safety_factor_l
-        sf_h = self.safety_factor_h
-
-      theta_bound_low = (1 - sf_l) * get_theta_bound_low(part.eta, part.pt)
-      theta_bound_high = (1 + sf_h) * get_theta_bound_high(part.eta, part.pt)
-      phi_bound_low = (1 - sf_l) * get_phi_bound_low(part.eta, part.pt)
-      phi_bound_high = (1 + sf_h) * get_phi_bound_high(part.eta, part.pt)
-
-      # Luca uses 0.004 rad in phi & theta
-      if theta_bound_low < 0.004:
-        theta_bound_low = -1.  # disable check
-      if phi_bound_low < 0.004:
-        phi_bound_low = -1.  # disable check
-      assert(theta_bound_high > 0.004 and phi_bound_high > 0.004)
-      assert(theta_bound_low < theta_bound_high and phi_bound_low < phi_bound_high)
-
-      # Loop over standalone muons
-      for itrk, trk in enumerate(tracks):
-        emtf_theta_glob = calc_theta_rad_from_eta(trk.eta)  # in radians
-        emtf_phi_glob = np.deg2rad(trk.phi)  # in radians
-
-        # Calculate deltas
-        dtheta = np.abs(delta_theta(emtf_theta_glob, part.theta))
-        tmp_dphi = delta_phi(emtf_phi_glob, part.phi)
-        dphi = np.abs(tmp_dphi)
-        dphi_sign = -1 if tmp_dphi < 0 else +1
-        if part.pt > 100.:
-          dphi_sign = -part.q  # disable check
-
-        matched[ipart, itrk] = (
-            (theta_bound_low < dtheta <= theta_bound_high) and \
-            (phi_bound_low < dphi <= phi_bound_high) and \
-            ((dphi_sign * part.q) < 0) and \
-            ((trk.eta * part.eta) > 0)
-        )
-
-        if matched[ipart, itrk] and self.also_check_pt:
-          # Require particle pT above some fraction of track pT
-          if part.pt <= self.pt_end:
-            matched[ipart, itrk] = matched[ipart, itrk] and (part.pt >= (1 - self.safety_factor_l) * trk.pt)
+    matched = np.zeros((len(particles), len(tracks)), dtype=np.bool)
+    if not part_sel.any() or len(tracks) == 0:
+      return matched
+
+    # Get boundaries, for the selected particles
+    (part_pt, part_eta, part_phi, part_theta, part_q) = (x[part_sel] for x in (part_pt, part_eta, part_phi, part_theta, part_q))
+    if self.do_relax_factor:
+      sf_l = sf_progressive(part_pt, self.pt_start, self.pt_end, self.initial_sf_l, self.safety_factor_l)
+      sf_h = sf_progressive(part_pt, self.pt_start, self.pt_end, self.initial_sf_h, self.safety_factor_h)
+    else:
+      sf_l = self.safety_factor_l
+      sf_h = self.safety_factor_h
+
+    theta_bound_low = (1 - sf_l) * get_bound(self.wdws_theta_low, part_eta, part_pt)
+    theta_bound_high = (1 + sf_h) * get_bound(self.wdws_theta_high, part_eta, part_pt)
+    phi_bound_low = (1 - sf_l) * get_bound(self.wdws_phi_low, part_eta, part_pt)
+    phi_bound_high = (1 + sf_h) * get_bound(self.wdws_phi_high, part_eta, part_pt)
+
+    # Luca uses 0.004 rad in phi & theta
+    theta_bound_low[theta_bound_low < 0.004] = -1.  # disable check
+    phi_bound_low[phi_bound_low < 0.004] = -1.  # disable check
+    assert(np.all(theta_bound_high > 0.004) and np.all(phi_bound_high > 0.004))
+    assert(np.all(theta_bound_low < theta_bound_high) and np.all(phi_bound_low < phi_bound_high))
+
+    # Calculate deltas, with particles along axis 0 and tracks along axis 1
+    emtf_theta_glob = calc_theta_rad_from_eta(trk_eta)  # in radians
+    emtf_phi_glob = np.deg2rad(trk_phi)  # in radians
+
+    dtheta = np.abs(delta_theta(emtf_theta_glob[np.newaxis, :], part_theta[:, np.newaxis]))
+    tmp_dphi = delta_phi_vectorized(emtf_phi_glob[np.newaxis, :], part_phi[:, np.newaxis])
+    dphi = np.abs(tmp_dphi)
+    dphi_sign = np.where(tmp_dphi < 0, -1, +1)
+    dphi_sign[part_pt > 100.] = -part_q[part_pt > 100.][:, np.newaxis]  # disable check
+
+    m = (theta_bound_low[:, np.newaxis] < dtheta) & (dtheta <= theta_bound_high[:, np.newaxis]) & \
+        (phi_bound_low[:, np.newaxis] < dphi) & (dphi <= phi_bound_high[:, np.newaxis]) & \
+        ((dphi_sign * part_q[:, np.newaxis]) < 0) & \
+        ((trk_eta[np.newaxis, :] * part_eta[:, np.newaxis]) > 0)
+
+    if self.also_check_pt:
+      # Require particle pT above some fraction of track pT
+      check_pt = (part_pt <= self.pt_end)[:, np.newaxis]
+      m &= ~check_pt | (part_pt[:, np.newaxis] >= (1 - self.safety_factor_l) * trk_pt[np.newaxis, :])
+    matched[part_sel] = m
 
     # Make sure the matching is unique
-    for ipart in xrange(matched.shape[0]):
-      if matched[ipart, :].any():
-        # find the first track match set to True, then set all the following track matches to False
-        for itrk in xrange(matched.shape[1]):
-          if matched[ipart, itrk]:
-            matched[ipart, itrk+1:] = False
-            break
-
-    for itrk in xrange(matched.shape[1]):
-      if matched[:, itrk].any():
-        # now find the highest-pT track match, then set the other track matches to False
-        highest_pt = -999999.
-        highest_pt_ipart = -999
-        for ipart in xrange(matched.shape[0]):
-          if matched[ipart, itrk]:
-            part = particles[ipart]
-            if highest_pt < part.pt:
-              highest_pt = part.pt
-              highest_pt_ipart = ipart
-        assert(highest_pt_ipart >= 0)
-        matched[:, itrk] = False
-        matched[highest_pt_ipart, itrk] = True
+    # - a particle keeps only its first track match
+    ipart = np.nonzero(matched.any(axis=1))[0]
+    itrk = np.argmax(matched[ipart], axis=1)
+    matched[:] = False
+    matched[ipart, itrk] = True
+
+    # - a track keeps only its highest-pT particle match (the first one if equal pT)
+    all_part_pt = np.array([part.pt for part in particles], dtype=np.float64)
+    itrk = np.nonzero(matched.any(axis=0))[0]
+    ipart = np.argmax(np.where(matched[:, itrk], all_part_pt[:, np.newaxis], -np.inf), axis=0)
+    matched[:, itrk] = False
+    matched[ipart, itrk] = True
     return matched
 
 
@@ -2074,44 +2454,123 @@ class DummyAnalysis(object):
 
 
 # ______________________________________________________________________________
-# Analysis: roads
+# Analysis with event hooks
 
-class RoadsAnalysis(DummyAnalysis):
-  def run(self, omtf_input=False, run2_input=False):
-    # Book histograms
-    histograms = {}
-    eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 120.)
+class EventReconstruction(object):
+  """The reconstruction of an event, shared by the analyses that run in the same loop.
 
-    for k in ("denom", "numer"):
-      hname = "eff_vs_genpt_%s" % k
-      histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
-      histograms[hname].Sumw2()
+  Each stage is run when an analysis first asks for it, and only once per event.
+  with_inputs() gives the reconstruction of the same event with other inputs,
+  e.g. for the models of other algos (see nn_models).
+  """
 
-      hname = "eff_vs_geneta_%s" % k
-      histograms[hname] = Hist(70, 1.1, 2.5, name=hname, title="; gen |#eta|", type='F')
-      histograms[hname].Sumw2()
+  def __init__(self, omtf_input=False, run2_input=False, bank=None):
+    self.inputs = (omtf_input, run2_input)
+    self.bank = PatternBank(bankfile) if bank is None else bank
+    self.recog = PatternRecognition(self.bank, omtf_input=omtf_input, run2_input=run2_input)
+    self.clean = RoadCleaning()
+    self.slim = RoadSlimming(self.bank)
+    self.evt = None
+    self.products = {}
+    self.others = {}  # (omtf_input, run2_input) -> EventReconstruction
+
+  def set_event(self, evt):
+    self.evt = evt
+    self.products = {}
+    for other in self.others.itervalues():
+      other.set_event(evt)
+
+  def with_inputs(self, omtf_input, run2_input):
+    inputs = (omtf_input, run2_input)
+    if inputs == self.inputs:
+      return self
+    if inputs not in self.others:
+      other = EventReconstruction(omtf_input=omtf_input, run2_input=run2_input, bank=self.bank)
+      other.set_event(self.evt)
+      self.others[inputs] = other
+    return self.others[inputs]
+
+  def get(self, name, produce):
+    if name not in self.products:
+      self.products[name] = produce()
+    return self.products[name]
 
-      hname = "eff_vs_genphi_%s" % k
-      histograms[hname] = Hist(64, -3.2, 3.2, name=hname, title="; gen #phi", type='F')
-      histograms[hname].Sumw2()
+  @property
+  def roads(self):
+    return self.get('roads', lambda: self.recog.run(self.evt.hits))
 
+  @property
+  def clean_roads(self):
+    return self.get('clean_roads', lambda: self.clean.run(self.roads))
+
+  @property
+  def slim_roads(self):
+    return self.get('slim_roads', lambda: self.slim.run(self.clean_roads))
+
+class EventAnalysis(DummyAnalysis):
+  """An analysis written as begin(), process() for each event, and end().
+
+  run() loops over the tree of the analysis. MultiAnalysis runs several of them
+  in the same loop, over the tree of the first one.
+  """
+
+  maxEvents = -1
+
+  # True if the outputs are labelled with the input of the analysis (e.g. the
+  # pileup of the rates), then it must be the first analysis of a loop
+  labels_input = False
+
+  def load_tree(self):
+    raise NotImplementedError
+
+  def begin(self, omtf_input=False, run2_input=False):
+    self.omtf_input = omtf_input
+    self.run2_input = run2_input
+
+  def process(self, ievt, evt, reco):
+    pass
+
+  def end(self):
+    pass
+
+  def run(self, omtf_input=False, run2_input=False, **kwargs):
+    MultiAnalysis([(self, kwargs)]).run(omtf_input=omtf_input, run2_input=run2_input)
+
+class MultiAnalysis(object):
+  def __init__(self, analyses):
+    self.analyses = analyses  # list of (analysis, keyword arguments of begin())
+
+    # Each class writes its own output files, and only the first analysis
+    # reads its own input
+    names = [analysis.__class__.__name__ for (analysis, kwargs) in analyses]
+    for (i, (analysis, kwargs)) in enumerate(analyses):
+      if names.count(names[i]) > 1:
+        raise RuntimeError('Cannot run {0} twice in the same loop, its output files would be overwritten'.format(names[i]))
+      if i > 0 and analysis.labels_input:
+        raise RuntimeError('Cannot run {0} over the input of {1}, it must be the first analysis of the loop'.format(names[i], names[0]))
+
+  def run(self, omtf_input=False, run2_input=False):
+    self.begin(omtf_input=omtf_input, run2_input=run2_input)
+    self.loop()
+    self.end()
+
+  def begin(self, omtf_input=False, run2_input=False):
+    self.omtf_input = omtf_input
+    self.run2_input = run2_input
+    for (analysis, kwargs) in self.analyses:
+      analysis.begin(omtf_input=omtf_input, run2_input=run2_input, **kwargs)
+
+  def loop(self):
     # Load tree
-    if omtf_input:
-      tree = load_pgun_omtf_batch(jobid)
-    else:
-      tree = load_pgun_batch(jobid)
+    tree = self.analyses[0][0].load_tree()
 
     # Workers
-    bank = PatternBank(bankfile)
-    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
-    clean = RoadCleaning()
-    slim = RoadSlimming(bank)
-    out_particles = []
-    out_roads = []
-    npassed, ntotal = 0, 0
+    reco = EventReconstruction(omtf_input=self.omtf_input, run2_input=self.run2_input)
 
     # Event range
-    maxEvents = -1
+    maxEvents = max([analysis.maxEvents for (analysis, kwargs) in self.analyses])
+    if any([analysis.maxEvents == -1 for (analysis, kwargs) in self.analyses]):
+      maxEvents = -1
 
     # __________________________________________________________________________
     # Loop over events
@@ -2119,86 +2578,136 @@ class RoadsAnalysis(DummyAnalysis):
       if maxEvents != -1 and ievt == maxEvents:
         break
 
-      if len(evt.particles) == 0:
-        continue
+      reco.set_event(evt)
+      for (analysis, kwargs) in self.analyses:
+        if analysis.maxEvents == -1 or ievt < analysis.maxEvents:
+          analysis.process(ievt, evt, reco)
 
-      part = evt.particles[0]  # particle gun
-      part.invpt = np.true_divide(part.q, part.pt)
-      part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
+    # End loop over events
+    unload_tree()
 
-      roads = recog.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-      assert(len(clean_roads) == len(slim_roads))
+  def end(self):
+    for (analysis, kwargs) in self.analyses:
+      analysis.end()
 
-      if len(slim_roads) > 0:
-        mypart = Particle(part.pt, part.eta, part.phi, part.q, part.vx, part.vy, part.vz)
-        out_particles.append(mypart)
-        out_roads.append(slim_roads[0])
 
-      # Quick efficiency
-      is_important = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0) and (part.pt > 4.)
-      is_possible = lambda hits: any([((hit.type == kCSC or hit.type == kME0) and hit.station == 1) for hit in hits]) and \
-          any([(hit.type == kCSC and hit.station >= 2) for hit in hits])
+# ______________________________________________________________________________
+# Analysis: roads
 
-      if ievt < 20 or (len(clean_roads) == 0 and is_important(part) and is_possible(evt.hits)):
-        print("evt {0} has {1} roads and {2} clean roads".format(ievt, len(roads), len(clean_roads)))
-        print(".. part invpt: {0} pt: {1} phi: {2} eta: {3} theta: {4}".format(part.invpt, part.pt, part.phi, part.eta, part.theta))
-        #part.ipt = find_pt_bin(part.invpt)
-        #part.ieta = find_eta_bin(part.eta)
-        #part.exphi = emtf_extrapolation(part)
-        #part.sector = find_sector(part.exphi)
-        #part.endcap = find_endcap(part.eta)
-        #part.emtf_phi = calc_phi_loc_int(np.rad2deg(part.exphi), part.sector)
-        #part.emtf_theta = calc_theta_int(calc_theta_deg_from_eta(part.eta), part.endcap)
-        #part_road_id = (part.endcap, part.sector, part.ipt, part.ieta, (part.emtf_phi+16)//32)
-        #part_nhits = sum([1 for hit in evt.hits if hit.endcap == part.endcap and hit.sector == part.sector])
-        #print(".. part road id: {0} nhits: {1} exphi: {2} emtf_phi: {3}".format(part_road_id, part_nhits, part.exphi, part.emtf_phi))
-        for ihit, hit in enumerate(evt.hits):
-          hit_id = (hit.type, hit.station, hit.ring, find_endsec(hit.endcap, hit.sector), hit.fr, hit.bx)
-          hit_sim_tp = hit.sim_tp1
-          if (hit.type == kCSC) and (hit_sim_tp != hit.sim_tp2):
-            hit_sim_tp = -1
-          print(".. hit {0} id: {1} lay: {2} ph: {3} ({4}) th: {5} bd: {6} ql: {7} tp: {8}".format(ihit, hit_id, find_emtf_layer(hit), hit.emtf_phi, find_pattern_x(hit.emtf_phi), hit.emtf_theta, find_emtf_bend(hit), find_emtf_qual(hit), hit_sim_tp))
-        for iroad, myroad in enumerate(roads):
-          print(".. road {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
-        for iroad, myroad in enumerate(clean_roads):
-          print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
-          for ihit, myhit in enumerate(myroad.hits):
-            print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
-        for iroad, myroad in enumerate(slim_roads):
-          print(".. sroad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
-          for ihit, myhit in enumerate(myroad.hits):
-            print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+class RoadsAnalysis(EventAnalysis):
+  def book_histograms(self):
+    histograms = HistogramRegistry()
+    eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 120.)
 
-      # Quick efficiency
-      if is_important(part):
-        trigger = len(clean_roads) > 0
-        ntotal += 1
-        if trigger:
-          npassed += 1
+    for k in ("denom", "numer"):
+      hname = "eff_vs_genpt_%s" % k
+      histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F', sumw2=True)
 
-        hname = "eff_vs_genpt_denom"
+      hname = "eff_vs_geneta_%s" % k
+      histograms.book(hname, 70, 1.1, 2.5, title="; gen |#eta|", type='F', sumw2=True)
+
+      hname = "eff_vs_genphi_%s" % k
+      histograms.book(hname, 64, -3.2, 3.2, title="; gen #phi", type='F', sumw2=True)
+    return histograms
+
+  def load_tree(self):
+    if self.omtf_input:
+      return load_pgun_omtf_batch(jobid)
+    else:
+      return load_pgun_batch(jobid)
+
+  def begin(self, omtf_input=False, run2_input=False):
+    super(RoadsAnalysis, self).begin(omtf_input=omtf_input, run2_input=run2_input)
+
+    # Book histograms
+    self.histograms = self.book_histograms()
+
+    self.out_particles = []
+    self.out_roads = []
+    self.npassed, self.ntotal = 0, 0
+
+  def process(self, ievt, evt, reco):
+    histograms = self.histograms
+
+    if len(evt.particles) == 0:
+      return
+
+    part = evt.particles[0]  # particle gun
+    part.invpt = np.true_divide(part.q, part.pt)
+    part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
+
+    roads = reco.roads
+    clean_roads = reco.clean_roads
+    slim_roads = reco.slim_roads
+    assert(len(clean_roads) == len(slim_roads))
+
+    if len(slim_roads) > 0:
+      mypart = Particle(part.pt, part.eta, part.phi, part.q, part.vx, part.vy, part.vz)
+      self.out_particles.append(mypart)
+      self.out_roads.append(slim_roads[0])
+
+    # Quick efficiency
+    is_important = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0) and (part.pt > 4.)
+    is_possible = lambda hits: any([((hit.type == kCSC or hit.type == kME0) and hit.station == 1) for hit in hits]) and \
+        any([(hit.type == kCSC and hit.station >= 2) for hit in hits])
+
+    if ievt < 20 or (len(clean_roads) == 0 and is_important(part) and is_possible(evt.hits)):
+      print("evt {0} has {1} roads and {2} clean roads".format(ievt, len(roads), len(clean_roads)))
+      print(".. part invpt: {0} pt: {1} phi: {2} eta: {3} theta: {4}".format(part.invpt, part.pt, part.phi, part.eta, part.theta))
+      #part.ipt = find_pt_bin(part.invpt)
+      #part.ieta = find_eta_bin(part.eta)
+      #part.exphi = emtf_extrapolation(part)
+      #part.sector = find_sector(part.exphi)
+      #part.endcap = find_endcap(part.eta)
+      #part.emtf_phi = calc_phi_loc_int(np.rad2deg(part.exphi), part.sector)
+      #part.emtf_theta = calc_theta_int(calc_theta_deg_from_eta(part.eta), part.endcap)
+      #part_road_id = (part.endcap, part.sector, part.ipt, part.ieta, (part.emtf_phi+16)//32)
+      #part_nhits = sum([1 for hit in evt.hits if hit.endcap == part.endcap and hit.sector == part.sector])
+      #print(".. part road id: {0} nhits: {1} exphi: {2} emtf_phi: {3}".format(part_road_id, part_nhits, part.exphi, part.emtf_phi))
+      for ihit, hit in enumerate(evt.hits):
+        hit_id = (hit.type, hit.station, hit.ring, find_endsec(hit.endcap, hit.sector), hit.fr, hit.bx)
+        hit_sim_tp = hit.sim_tp1
+        if (hit.type == kCSC) and (hit_sim_tp != hit.sim_tp2):
+          hit_sim_tp = -1
+        print(".. hit {0} id: {1} lay: {2} ph: {3} ({4}) th: {5} bd: {6} ql: {7} tp: {8}".format(ihit, hit_id, find_emtf_layer(hit), hit.emtf_phi, find_pattern_x(hit.emtf_phi), hit.emtf_theta, find_emtf_bend(hit), find_emtf_qual(hit), hit_sim_tp))
+      for iroad, myroad in enumerate(roads):
+        print(".. road {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
+      for iroad, myroad in enumerate(clean_roads):
+        print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
+        for ihit, myhit in enumerate(myroad.hits):
+          print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+      for iroad, myroad in enumerate(slim_roads):
+        print(".. sroad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
+        for ihit, myhit in enumerate(myroad.hits):
+          print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+
+    # Quick efficiency
+    if is_important(part):
+      trigger = len(clean_roads) > 0
+      self.ntotal += 1
+      if trigger:
+        self.npassed += 1
+
+      hname = "eff_vs_genpt_denom"
+      histograms[hname].fill(part.pt)
+      if trigger:
+        hname = "eff_vs_genpt_numer"
         histograms[hname].fill(part.pt)
-        if trigger:
-          hname = "eff_vs_genpt_numer"
-          histograms[hname].fill(part.pt)
 
-        if part.pt > 20.:
-          hname = "eff_vs_geneta_denom"
+      if part.pt > 20.:
+        hname = "eff_vs_geneta_denom"
+        histograms[hname].fill(abs(part.eta))
+        if trigger:
+          hname = "eff_vs_geneta_numer"
           histograms[hname].fill(abs(part.eta))
-          if trigger:
-            hname = "eff_vs_geneta_numer"
-            histograms[hname].fill(abs(part.eta))
-          hname = "eff_vs_genphi_denom"
+        hname = "eff_vs_genphi_denom"
+        histograms[hname].fill(part.phi)
+        if trigger:
+          hname = "eff_vs_genphi_numer"
           histograms[hname].fill(part.phi)
-          if trigger:
-            hname = "eff_vs_genphi_numer"
-            histograms[hname].fill(part.phi)
-
-    # End loop over events
-    unload_tree()
 
+  def end(self):
+    npassed, ntotal = self.npassed, self.ntotal
     print('[INFO] npassed/ntotal: %i/%i = %f' % (npassed, ntotal, float(npassed)/ntotal if ntotal > 0 else 0.))
 
     # __________________________________________________________________________
@@ -2208,204 +2717,366 @@ class RoadsAnalysis(DummyAnalysis):
       outfile = outfile[:-4] + ('_%i.npz' % jobid)
     print('[INFO] Creating file: %s' % outfile)
     with contextlib_nullcontext(outfile) as f:
-      assert(len(out_particles) == len(out_roads))
-      parameters = particles_to_parameters(out_particles)
-      variables = roads_to_variables(out_roads)
+      assert(len(self.out_particles) == len(self.out_roads))
+      parameters = particles_to_parameters(self.out_particles)
+      variables = roads_to_variables(self.out_roads)
       np.savez_compressed(f, parameters=parameters, variables=variables)
 
 
 # ______________________________________________________________________________
 # Analysis: rates
 
-class RatesAnalysis(DummyAnalysis):
-  def run(self, omtf_input=False, run2_input=False, pileup=200):
-    # Book histograms
-    histograms = {}
+class RatesAnalysis(EventAnalysis):
+  labels_input = True  # the events are saved with their pileup
+
+  def get_model_tags(self):
+    # Histograms of the main model are named 'emtf2026', those of the other
+    # models are named 'emtf2026_<model name>'
+    return ["emtf2026"] + ["emtf2026_%s" % name for name in (nn_models or [])[1:]]
+
+  def book_histograms(self, model_tags=None):
+    # The histograms are filled with NumPy and converted into ROOT histograms
+    # when written (see emtf_histograms.py)
+    if model_tags is None:
+      model_tags = self.get_model_tags()
+    histograms = HistogramRegistry()
     hname = "nevents"
-    histograms[hname] = Hist(5, 0, 5, name=hname, title="; count", type='F')
+    histograms.book(hname, 5, 0, 5, title="; count", type='F')
 
-    for m in ("emtf", "emtf2026"):
+    for m in ["emtf"] + model_tags:
       hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin1.24_absEtaMax1.65_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin1.65_absEtaMax2.15_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
       hname = "highest_%s_absEtaMin2.15_absEtaMax2.4_qmin12_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV]; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV]; entries", type='F')
 
       hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_matched0_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV] {no MC match}; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV] {no MC match}; entries", type='F')
       hname = "highest_%s_absEtaMin1.24_absEtaMax2.4_qmin12_matched1_pt" % m
-      histograms[hname] = Hist(100, 0., 100., name=hname, title="; p_{T} [GeV] {found MC match}; entries", type='F')
+      histograms.book(hname, 100, 0., 100., title="; p_{T} [GeV] {found MC match}; entries", type='F')
 
       for l in xrange(14,22+1):
         hname = "%s_ptmin%i_qmin12_eta" % (m,l)
-        histograms[hname] = Hist(18, 0.75, 2.55, name=hname, title="; |#eta|; entries", type='F')
+        histograms.book(hname, 18, 0.75, 2.55, title="; |#eta|; entries", type='F')
+    return histograms
+
+  def load_tree(self):
+    return load_minbias_batch(jobid, pileup=self.pileup)
+
+  def begin(self, omtf_input=False, run2_input=False, pileup=200, ptassig=None):
+    super(RatesAnalysis, self).begin(omtf_input=omtf_input, run2_input=run2_input)
+    self.pileup = pileup
+
+    # Book histograms
+    self.histograms = self.book_histograms()
+    self.model_tags = self.get_model_tags()
+
+    # Workers (the pT assignment can be given, so that its models are loaded once for many runs)
+    if ptassig is None:
+      ptassig = PtAssignment(kerasfile, omtf_input=omtf_input, run2_input=run2_input, backend=nn_backend,
+                             cachesize=nn_cachesize, cachefile=nn_cachefile, names=nn_models)
+    self.ptassig = ptassig
+    self.trkprod = TrackProducer(omtf_input=omtf_input, run2_input=run2_input)
+    self.ghost = GhostBusting()
+    self.mucorr = TrackMuonCorrelation()
+
+    # pT assignment is deferred until enough roads are accumulated
+    self.batcher = PtAssignmentBatcher(self.ptassig, batch_size=batch_size)
+    self.summary = SummaryTable(rates_event_dtype, ["emtf"] + self.model_tags)
+    self.track_attrs = ('endcap', 'sector', 'pt', 'xml_pt', 'q', 'eta', 'phi', 'mode', 'bx')
+    self.particle_attrs = ('pt', 'eta', 'phi', 'theta', 'q', 'vx', 'vy', 'vz', 'bx')
+
+  def get_event_roads(self, reco):
+    # The roads and clean roads of the main model, and the slim roads of each
+    # group of models, from the reconstruction of the same event with the
+    # inputs of the group
+    group_recos = [(inputs, reco.with_inputs(*inputs)) for inputs in self.ptassig.get_groups()]
+    slim_roads = OrderedDict((inputs, group_reco.slim_roads) for (inputs, group_reco) in group_recos)
+    main_reco = group_recos[0][1]
+    return (main_reco.roads, main_reco.clean_roads, slim_roads)
+
+  def process(self, ievt, evt, reco):
+    (roads, clean_roads, slim_roads) = self.get_event_roads(reco)
+
+    if batch_size > 1:
+      evt_tracks = snapshot_collection(evt.tracks, self.track_attrs)
+      evt_particles = snapshot_collection(evt.particles, self.particle_attrs)
+    else:
+      evt_tracks = evt.tracks
+      evt_particles = evt.particles
+    self.batcher.put(slim_roads, functools.partial(self.process_tracks, ievt, evt_tracks, evt_particles, roads, clean_roads))
+
+  def run(self, omtf_input=False, run2_input=False, pileup=200):
+    if stage_cache_dir is None:
+      super(RatesAnalysis, self).run(omtf_input=omtf_input, run2_input=run2_input, pileup=pileup)
+    else:
+      self.run_stage_cache(StageCache(stage_cache_dir), omtf_input=omtf_input, run2_input=run2_input, pileup=pileup)
+
+  # ____________________________________________________________________________
+  # Resume from the deepest stage found in the stage cache, and write the
+  # outputs of the stages that are run (see emtf_stage_cache.py)
+  def run_stage_cache(self, cache, omtf_input=False, run2_input=False, pileup=200):
+    self.begin(omtf_input=omtf_input, run2_input=run2_input, pileup=pileup)
 
     # Load tree
-    tree = load_minbias_batch(jobid, pileup=pileup)
+    tree = self.load_tree()
 
-    # Workers
-    bank = PatternBank(bankfile)
-    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
-    clean = RoadCleaning()
-    slim = RoadSlimming(bank)
-    ptassig = PtAssignment(kerasfile, omtf_input=omtf_input, run2_input=run2_input)
-    trkprod = TrackProducer(omtf_input=omtf_input, run2_input=run2_input)
-    ghost = GhostBusting()
-    mucorr = TrackMuonCorrelation()
+    # Stage keys
+    from nn_cache import file_identity
+    import nn_encode, nn_encode_run3, nn_encode_omtf
+    reco_key = make_key(get_tree_identity(tree, self.maxEvents), file_identity(bankfile), omtf_input, run2_input, self.ptassig.get_groups().keys(),
+                        source_identity(EventReconstruction, PatternRecognition, RoadCleaning, RoadSlimming))
+    ptassig_key = make_key(reco_key, self.ptassig.get_identity(), self.track_attrs, self.particle_attrs,
+                           source_identity(PtAssignment, PtAssignmentBatcher, roads_to_variables, nn_encode, nn_encode_run3, nn_encode_omtf))
 
-    # Event range
-    maxEvents = -1
+    if cache.exists('ptassig', ptassig_key):
+      print('[INFO] Using stage cache: %s' % cache.filename('ptassig', ptassig_key))
+      for record in cache.read('ptassig', ptassig_key):
+        self.process_tracks(*record)
 
-    # __________________________________________________________________________
-    # Loop over events
+    else:
+      reco_cached = cache.exists('reco', reco_key)
+      with (contextlib_nullcontext() if reco_cached else cache.writer('reco', reco_key)) as reco_writer, \
+          cache.writer('ptassig', ptassig_key) as ptassig_writer:
+        if reco_cached:
+          print('[INFO] Using stage cache: %s' % cache.filename('reco', reco_key))
+          records = cache.read('reco', reco_key)
+        else:
+          records = self.reconstruct_events(tree, reco_writer)
+
+        for (ievt, evt_tracks, evt_particles, roads, clean_roads, slim_roads) in records:
+          self.batcher.put(slim_roads, functools.partial(self.process_cached_tracks, ptassig_writer, ievt, evt_tracks, evt_particles, roads, clean_roads))
+        self.batcher.flush()
+
+    # End loop over events
+    unload_tree()
+
+    self.end()
+
+  def reconstruct_events(self, tree, writer):
+    # The event objects are copied, as they cannot be pickled
+    reco = EventReconstruction(omtf_input=self.omtf_input, run2_input=self.run2_input)
     for ievt, evt in enumerate(tree):
-      if maxEvents != -1 and ievt == maxEvents:
+      if self.maxEvents != -1 and ievt == self.maxEvents:
         break
 
-      roads = recog.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-      variables = roads_to_variables(slim_roads)
-      variables, predictions, x_mask_vars, x_road_vars = ptassig.run(variables)
-      tracks = trkprod.run(slim_roads, variables, predictions, x_mask_vars, x_road_vars)
+      reco.set_event(evt)
+      evt_tracks = snapshot_collection(evt.tracks, self.track_attrs)
+      evt_particles = snapshot_collection(evt.particles, self.particle_attrs)
+      (roads, clean_roads, slim_roads) = self.get_event_roads(reco)
+      record = (ievt, evt_tracks, evt_particles, roads, clean_roads, slim_roads)
+      writer.write(record)
+      yield record
+
+  def process_cached_tracks(self, writer, *record):
+    writer.write(record)
+    self.process_tracks(*record)
+
+  # ____________________________________________________________________________
+  # Process an event after its pT assignment
+  def process_tracks(self, ievt, evt_tracks, evt_particles, roads, clean_roads, slim_roads, results):
+    # EMTF++ tracks are kept in track tables (see track_table_dtype), the
+    # tracks of each model are made from the slim roads of its group
+    all_emtf2026_tracks = OrderedDict()
+    all_emtf2026_matched = OrderedDict()
+    for (name, (variables, predictions, x_mask_vars, x_road_vars)) in results.iteritems():
+      group_slim_roads = slim_roads[self.ptassig.model_inputs[name]]
+      (tracks, hits) = self.trkprod.run_table(group_slim_roads, variables, predictions, x_mask_vars, x_road_vars)
 
       # Ghost busting & muon correlator
-      emtf2026_tracks = ghost.run(tracks)
-      emtf2026_matched = mucorr.run(evt.particles, emtf2026_tracks)
-
-      found_high_pt_tracks = any(map(lambda trk: trk.pt > 20., emtf2026_tracks))
-
-      if found_high_pt_tracks:
-        print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, len(roads), len(clean_roads), len(evt.tracks), len(emtf2026_tracks)))
-        for ipart, part in enumerate(evt.particles):
-          if part.pt > 5.:
-            part.invpt = np.true_divide(part.q, part.pt)
-            print(".. part invpt: {0} pt: {1} phi: {2} eta: {3} theta: {4}".format(part.invpt, part.pt, part.phi, part.eta, part.theta))
-        for iroad, myroad in enumerate(clean_roads):
-          print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
-          #for ihit, myhit in enumerate(myroad.hits):
-          #  print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
-        for itrk, mytrk in enumerate(emtf2026_tracks):
-          print(".. trk {0} id: {1} nhits: {2} mode: {3} pt: {4} y_pred: {5} y_discr: {6}".format(itrk, mytrk.id, len(mytrk.hits), mytrk.mode, mytrk.pt, mytrk.y_pred, mytrk.y_discr))
-          for ihit, myhit in enumerate(mytrk.hits):
-            print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
-        for itrk, mytrk in enumerate(evt.tracks):
-          print(".. otrk {0} id: {1} pt: {2} eta: {3} mode: {4}".format(itrk, (mytrk.endcap, mytrk.sector, -1, -1, -1), mytrk.pt, mytrk.eta, mytrk.mode))
+      all_emtf2026_tracks[name] = self.ghost.run_table(tracks, hits)
+      all_emtf2026_matched[name] = self.mucorr.run(evt_particles, all_emtf2026_tracks[name])
+
+    # Print the tracks of the main model
+    emtf2026_tracks = all_emtf2026_tracks[self.ptassig.names[0]]
+    main_slim_roads = slim_roads[self.ptassig.model_inputs[self.ptassig.names[0]]]
+
+    found_high_pt_tracks = np.any(emtf2026_tracks.pt > 20.)
+
+    if found_high_pt_tracks:
+      print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, len(roads), len(clean_roads), len(evt_tracks), len(emtf2026_tracks)))
+      for ipart, part in enumerate(evt_particles):
+        if part.pt > 5.:
+          part.invpt = np.true_divide(part.q, part.pt)
+          print(".. part invpt: {0} pt: {1} phi: {2} eta: {3} theta: {4}".format(part.invpt, part.pt, part.phi, part.eta, part.theta))
+      for iroad, myroad in enumerate(clean_roads):
+        print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
+        #for ihit, myhit in enumerate(myroad.hits):
+        #  print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+      for itrk, mytrk in enumerate(emtf2026_tracks):
+        mytrk_id = (mytrk.endcap, mytrk.sector, mytrk.ipt, mytrk.ieta, mytrk.iphi)
+        print(".. trk {0} id: {1} nhits: {2} mode: {3} pt: {4} y_pred: {5} y_discr: {6}".format(itrk, mytrk_id, mytrk.nhits, mytrk.mode, mytrk.pt, mytrk.y_pred, mytrk.y_discr))
+        for ihit, myhit in enumerate(main_slim_roads[mytrk.road].hits):
+          print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+      for itrk, mytrk in enumerate(evt_tracks):
+        print(".. otrk {0} id: {1} pt: {2} eta: {3} mode: {4}".format(itrk, (mytrk.endcap, mytrk.sector, -1, -1, -1), mytrk.pt, mytrk.eta, mytrk.mode))
 
-      # ________________________________________________________________________
-      # Fill histograms
-      histograms["nevents"].fill(1.0)
-
-      def fill_highest_pt():
-        highest_pt = -999999.
-        for itrk, trk in enumerate(tracks):
-          if select(trk):
-            if highest_pt < trk.pt:  # using scaled pT
-              highest_pt = trk.pt
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-4, highest_pt)
-          histograms[hname].fill(highest_pt)
-
-      def fill_highest_pt_matched():
-        highest_pt = -999999.
-        highest_pt_itrk = -999
-        for itrk, trk in enumerate(tracks):
-          if select(trk):
-            if highest_pt < trk.pt:  # using scaled pT
-              highest_pt = trk.pt
-              highest_pt_itrk = itrk
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-4, highest_pt)
-          highest_pt_trk = tracks[highest_pt_itrk]
-          if highest_pt_trk.matched:
-            histograms[hname_matched1].fill(highest_pt)
-          else:
-            histograms[hname_matched0].fill(highest_pt)
+    # __________________________________________________________________________
+    # Record the event and its tracks, the histograms are filled from the
+    # summary tables at the end (see emtf_summary.py)
+    entry = self.summary.add_event(jobid=jobid, event=ievt, pileup=self.pileup)
+    self.summary.add_tracks(entry, "emtf", evt_tracks)
+    for (name, mtag) in zip(self.ptassig.names, self.model_tags):
+      self.summary.add_tracks(entry, mtag, all_emtf2026_tracks[name], matched=all_emtf2026_matched[name].any(axis=0))
 
-      def fill_eta():
-        h = histograms[hname]
-        eta_bins = [False] * (h.GetNbinsX()+2)
-        for itrk, trk in enumerate(tracks):
-          if select(trk):  # using scaled pT
-            b = h.FindFixBin(abs(trk.eta))
-            eta_bins[b] = True
-        for b in xrange(len(eta_bins)):
-          if eta_bins[b]:
-            h.fill(h.GetBinCenter(b))
-
-      # EMTF tracks
-      tracks = evt.tracks
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) < 1.65) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) < 2.15) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-      hname = "highest_emtf_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l))
-        hname = "emtf_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
-
-      # EMTF++ tracks
-      tracks = emtf2026_tracks
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 1.65)
-      hname = "highest_emtf2026_absEtaMin1.24_absEtaMax1.65_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (1.65 <= abs(trk.eta) <= 2.15)
-      hname = "highest_emtf2026_absEtaMin1.65_absEtaMax2.15_qmin12_pt"
-      fill_highest_pt()
-      select = lambda trk: trk and (2.15 <= abs(trk.eta) <= 2.4)
-      hname = "highest_emtf2026_absEtaMin2.15_absEtaMax2.4_qmin12_pt"
-      fill_highest_pt()
-      for l in xrange(14,22+1):
-        select = lambda trk: trk and (0 <= abs(trk.eta) <= 9.9) and (trk.pt > float(l))
-        hname = "emtf2026_ptmin%i_qmin12_eta" % (l)
-        fill_eta()
+  def end(self):
+    histograms = self.histograms
+    summary = self.summary
 
-      # For fake rate plot (EMTF++ tracks only)
-      for itrk, mytrk in enumerate(emtf2026_tracks):
-        m = emtf2026_matched[:, itrk]
-        mytrk.matched = m.any()
+    # Process the remaining events
+    self.batcher.flush()
 
-      tracks = emtf2026_tracks
-      select = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4)
-      hname_matched0 = "highest_emtf2026_absEtaMin1.24_absEtaMax2.4_qmin12_matched0_pt"
-      hname_matched1 = "highest_emtf2026_absEtaMin1.24_absEtaMax2.4_qmin12_matched1_pt"
-      fill_highest_pt_matched()
+    # __________________________________________________________________________
+    # Fill histograms
+    fill_rates_histograms(histograms, summary.get_events(), summary.get_tracks(), summary.algos)
 
-    # End loop over events
-    unload_tree()
+    # __________________________________________________________________________
+    # Save summary tables
+    if write_summary:
+      outfile = 'histos_tbb_summary.npz'
+      if use_condor:
+        outfile = outfile[:-4] + ('_%i.npz' % jobid)
+      print('[INFO] Creating file: %s' % outfile)
+      summary.save(outfile)
 
     # __________________________________________________________________________
     # Save histograms
-    outfile = 'histos_tbb.root'
+    self.save_histograms(histograms)
+
+  def run_summary(self, infiles):
+    # Fill the histograms from the summary tables written by run()
+    events, tracks, algos = load_summary(infiles)
+    print('[INFO] Using {0} events from {1} summary files'.format(len(events), len(infiles)))
+    histograms = self.book_histograms(model_tags=algos[1:])
+    fill_rates_histograms(histograms, events, tracks, algos)
+    self.save_histograms(histograms)
+
+  def save_histograms(self, histograms):
+    # The condor jobs write .npz files, which are merged with emtf_histograms.py
     if use_condor:
-      outfile = outfile[:-5] + ('_%i.root' % jobid)
+      outfile = 'histos_tbb_%i.npz' % jobid
+      print('[INFO] Creating file: %s' % outfile)
+      histograms.save(outfile)
+    else:
+      outfile = 'histos_tbb.root'
+      print('[INFO] Creating file: %s' % outfile)
+      histograms.save_root(outfile)
+
+
+# ______________________________________________________________________________
+# Analysis: rates vs pileup
+
+# A shard is one input file of one pileup point, run by a worker process of the
+# pool. The pT assignment of a worker is kept across its shards.
+pu_scan_ptassig = None
+
+def run_rates_shard(args):
+  global jobid, pu_scan_ptassig
+  (pileup, k, omtf_input, run2_input) = args
+  start_time = datetime.datetime.now()
+
+  jobid = k  # used by load_minbias_batch()
+  if pu_scan_ptassig is None:
+    pu_scan_ptassig = PtAssignment(kerasfile, omtf_input=omtf_input, run2_input=run2_input, backend=nn_backend,
+                                   cachesize=nn_cachesize, cachefile=nn_cachefile, names=nn_models)
+  rates = RatesAnalysis()
+  multi = MultiAnalysis([(rates, dict(pileup=pileup, ptassig=pu_scan_ptassig))])
+  multi.begin(omtf_input=omtf_input, run2_input=run2_input)
+  multi.loop()
+  rates.batcher.flush()
+
+  stop_time = datetime.datetime.now()
+  seconds = (stop_time - start_time).total_seconds()
+  return (pileup, k, rates.summary.get_events(), rates.summary.get_tracks(), rates.summary.algos, seconds)
+
+class PileupScanAnalysis(DummyAnalysis):
+  def estimate_costs(self):
+    # Time per shard of each pileup point, as measured by the previous scan if
+    # it has all the points, otherwise pileup ** pu_scan_cost_exponent
+    costs = dict((pileup, float(pileup) ** pu_scan_cost_exponent) for pileup in pu_scan_points)
+    if os.path.isfile(pu_scan_outfile):
+      with np.load(pu_scan_outfile) as f:
+        points = f['points'] if 'points' in f.files else np.array([], dtype=pileup_point_dtype)
+      measured = dict((int(p['pileup']), p['seconds'] / p['nshards']) for p in points if p['nshards'] > 0)
+      if all([pileup in measured for pileup in pu_scan_points]):
+        costs = dict((pileup, measured[pileup]) for pileup in pu_scan_points)
+    return costs
+
+  def get_shards(self, costs):
+    shards = []
+    for pileup in pu_scan_points:
+      nfiles = len(get_minbias_batch_files(pileup))
+      if pu_scan_files is not None:
+        nfiles = min(nfiles, pu_scan_files)
+      shards += [(pileup, k) for k in range(nfiles)]
+
+    # Longest processing time first: the pool hands the next shard to the first
+    # free worker, so the shards of the highest pileup do not end up last
+    shards.sort(key=lambda shard: (-costs[shard[0]], shard))
+    return shards
+
+  def run(self, omtf_input=False, run2_input=False):
+    import multiprocessing
+    costs = self.estimate_costs()
+    shards = self.get_shards(costs)
+    print('[INFO] Running {0} shards of pileup {1} with {2} workers'.format(len(shards), pu_scan_points, pu_scan_workers))
+
+    # __________________________________________________________________________
+    # Run the shards
+    results = []
+    pool = multiprocessing.Pool(processes=pu_scan_workers)
+    try:
+      args = [(pileup, k, omtf_input, run2_input) for (pileup, k) in shards]
+      for result in pool.imap_unordered(run_rates_shard, args, chunksize=1):
+        (pileup, k, events, tracks, algos, seconds) = result
+        print('[INFO] Done pileup {0} file {1}: {2} events in {3:.0f} s'.format(pileup, k, len(events), seconds))
+        results.append(result)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+
+    # __________________________________________________________________________
+    # Merge the shards, ordered by pileup and file
+    results.sort(key=lambda result: result[:2])
+    algos = results[0][4]
+    (events, tracks) = concatenate_summaries([(result[2], result[3]) for result in results])
+
+    points = np.zeros(len(pu_scan_points), dtype=pileup_point_dtype)
+    for (i, pileup) in enumerate(pu_scan_points):
+      mine = [result for result in results if result[0] == pileup]
+      points[i] = (pileup, len(mine), sum([len(result[2]) for result in mine]), sum([result[5] for result in mine]))
+      print('[INFO] Pileup {0}: {1} shards, {2} events, {3:.1f} events/s per worker'.format(
+          pileup, points[i]['nshards'], points[i]['nevents'], points[i]['nevents'] / max(points[i]['seconds'], 1e-9)))
+
+    outfile = pu_scan_outfile
     print('[INFO] Creating file: %s' % outfile)
-    with root_open(outfile, 'recreate') as f:
-      for (k, v) in histograms.iteritems():
-        v.Write()
+    np.savez_compressed(outfile, events=events, tracks=tracks, algos=np.array(algos), points=points)
+
+    # __________________________________________________________________________
+    # Fill and save the histograms of each pileup point
+    for pileup in pu_scan_points:
+      (pu_events, pu_tracks) = select_events(events, tracks, events['pileup'] == pileup)
+      histograms = RatesAnalysis().book_histograms(model_tags=algos[1:])
+      fill_rates_histograms(histograms, pu_events, pu_tracks, algos)
+      outfile = 'histos_tbb_%i.root' % pileup
+      print('[INFO] Creating file: %s' % outfile)
+      histograms.save_root(outfile)
 
 
 # ______________________________________________________________________________
 # Analysis: effie
 
 class EffieAnalysis(DummyAnalysis):
-  def run(self, omtf_input=False, run2_input=False, pileup=0):
-    # Book histograms
-    histograms = {}
+  def book_histograms(self):
+    # The histograms are filled with NumPy and converted into ROOT histograms
+    # when written (see emtf_histograms.py)
+    histograms = HistogramRegistry()
     eff_pt_bins = (0., 0.5, 1., 1.5, 2., 3., 4., 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 100., 120.)
     eff_highpt_bins = (2., 2.5, 3., 3.5, 4., 4.5, 5., 6., 7., 8., 10., 12., 14., 16., 18., 20., 22., 24., 26., 28., 30., 34., 40., 48., 60., 80., 100., 120., 250., 500., 1000.)
 
@@ -2413,51 +3084,56 @@ class EffieAnalysis(DummyAnalysis):
       for l in (0, 5, 10, 20, 30, 40, 50, 60):
         for k in ("denom", "numer"):
           hname = "%s_eff_vs_genpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genpt_highpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(eff_highpt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+          histograms.book(hname, eff_highpt_bins, title="; gen p_{T} [GeV]", type='F')
           hname = "%s_eff_vs_genphi_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(76, -190, 190, name=hname, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 76, -190, 190, title="; gen #phi {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_genphi_lowpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(76, -190, 190, name=hname, title="; gen #phi {5 < gen p_{T} #leq 20 GeV}", type='F')
+          histograms.book(hname, 76, -190, 190, title="; gen #phi {5 < gen p_{T} #leq 20 GeV}", type='F')
           hname = "%s_eff_vs_geneta_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(26, 1.2, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 26, 1.2, 2.5, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_geneta_lowpt_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(26, 1.2, 2.5, name=hname, title="; gen |#eta| {5 < gen p_{T} #leq 20 GeV}", type='F')
+          histograms.book(hname, 26, 1.2, 2.5, title="; gen |#eta| {5 < gen p_{T} #leq 20 GeV}", type='F')
           hname = "%s_eff_vs_gend0_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(80, 0, 120, name=hname, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 80, 0, 120, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
           hname = "%s_eff_vs_gendz_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist(80, 0, 40, name=hname, title="; gen |d_{z}| [cm] {gen p_{T} > 20 GeV}", type='F')
+          histograms.book(hname, 80, 0, 40, title="; gen |d_{z}| [cm] {gen p_{T} > 20 GeV}", type='F')
 
           hname = "%s_eff_vs_gend0d1_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist2D(60, -120, 120, 50, -0.5, 0.5, name=hname, title="; gen d_{0} [cm]; gen q/p_{T} [1/GeV]", type='F')
+          histograms.book(hname, 60, -120, 120, 50, -0.5, 0.5, title="; gen d_{0} [cm]; gen q/p_{T} [1/GeV]", type='F')
           hname = "%s_eff_vs_genetad1_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist2D(52, 1.2, 2.5, 50, -0.5, 0.5, name=hname, title="; gen |#eta|; gen q/p_{T} [1/GeV]", type='F')
+          histograms.book(hname, 52, 1.2, 2.5, 50, -0.5, 0.5, title="; gen |#eta|; gen q/p_{T} [1/GeV]", type='F')
           hname = "%s_eff_vs_genetad0_l1pt%i_%s" % (m,l,k)
-          histograms[hname] = Hist2D(52, 1.2, 2.5, 60, -120, 120, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}; gen d_{0} [cm]", type='F')
+          histograms.book(hname, 52, 1.2, 2.5, 60, -120, 120, title="; gen |#eta| {gen p_{T} > 20 GeV}; gen d_{0} [cm]", type='F')
 
           if l == 0:
             hname = "%s_eff_vs_genpt_roads_%s" % (m,k)
-            histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+            histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F')
             hname = "%s_eff_vs_genpt_croads_%s" % (m,k)
-            histograms[hname] = Hist(eff_pt_bins, name=hname, title="; gen p_{T} [GeV]", type='F')
+            histograms.book(hname, eff_pt_bins, title="; gen p_{T} [GeV]", type='F')
             hname = "%s_eff_vs_geneta_roads_%s" % (m,k)
-            histograms[hname] = Hist(26, 1.2, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
+            histograms.book(hname, 26, 1.2, 2.5, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
             hname = "%s_eff_vs_geneta_croads_%s" % (m,k)
-            histograms[hname] = Hist(26, 1.2, 2.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
+            histograms.book(hname, 26, 1.2, 2.5, title="; gen |#eta| {gen p_{T} > 20 GeV}", type='F')
             hname = "%s_eff_vs_gend0_roads_%s" % (m,k)
-            histograms[hname] = Hist(80, 0, 120, name=hname, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
+            histograms.book(hname, 80, 0, 120, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
             hname = "%s_eff_vs_gend0_croads_%s" % (m,k)
-            histograms[hname] = Hist(80, 0, 120, name=hname, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
+            histograms.book(hname, 80, 0, 120, title="; gen |d_{0}| [cm] {gen p_{T} > 20 GeV}", type='F')
 
       hname = "%s_l1pt_vs_genpt" % m
-      histograms[hname] = Hist2D(100, -0.5, 0.5, 200, -0.5, 0.5, name=hname, title="; gen q/p_{T} [1/GeV]; q/p_{T} [1/GeV]", type='F')
+      histograms.book(hname, 100, -0.5, 0.5, 200, -0.5, 0.5, title="; gen q/p_{T} [1/GeV]; q/p_{T} [1/GeV]", type='F')
       hname = "%s_l1ptres_vs_genpt" % m
-      histograms[hname] = Hist2D(100, -0.5, 0.5, 200, -3, 3, name=hname, title="; gen q/p_{T} [1/GeV]; #Delta(p_{T})/p_{T}", type='F')
+      histograms.book(hname, 100, -0.5, 0.5, 200, -3, 3, title="; gen q/p_{T} [1/GeV]; #Delta(p_{T})/p_{T}", type='F')
       hname = "%s_l1pt_vs_geneta" % m
-      histograms[hname] = Hist2D(52, 1.2, 2.5, 200, -0.5, 0.5, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}; q/p_{T} [1/GeV]", type='F')
+      histograms.book(hname, 52, 1.2, 2.5, 200, -0.5, 0.5, title="; gen |#eta| {gen p_{T} > 20 GeV}; q/p_{T} [1/GeV]", type='F')
       hname = "%s_l1ptres_vs_geneta" % m
-      histograms[hname] = Hist2D(52, 1.2, 2.5, 200, -15, 15, name=hname, title="; gen |#eta| {gen p_{T} > 20 GeV}; #Delta(p_{T})/p_{T}", type='F')
+      histograms.book(hname, 52, 1.2, 2.5, 200, -15, 15, title="; gen |#eta| {gen p_{T} > 20 GeV}; #Delta(p_{T})/p_{T}", type='F')
+    return histograms
+
+  def run(self, omtf_input=False, run2_input=False, pileup=0):
+    # Book histograms
+    histograms = self.book_histograms()
 
     # Load tree
     #tree = load_pgun_batch(jobid)
@@ -2469,11 +3145,15 @@ class EffieAnalysis(DummyAnalysis):
     recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
     clean = RoadCleaning()
     slim = RoadSlimming(bank)
-    ptassig = PtAssignment(kerasfile, omtf_input=omtf_input, run2_input=run2_input)
+    ptassig = PtAssignment(kerasfile, omtf_input=omtf_input, run2_input=run2_input, backend=nn_backend,
+                           cachesize=nn_cachesize, cachefile=nn_cachefile)
     trkprod = TrackProducer(omtf_input=omtf_input, run2_input=run2_input)
     ghost = GhostBusting()
     mucorr = TrackMuonCorrelation()
 
+    # Summary tables
+    summary = SummaryTable(effie_event_dtype, ["emtf", "emtf2026"])
+
     # Event range
     maxEvents = -1
 
@@ -2545,208 +3225,44 @@ class EffieAnalysis(DummyAnalysis):
           print(".. otrk {0} id: {1} pt: {2} eta: {3} mode: {4}".format(itrk, (mytrk.endcap, mytrk.sector, -1, -1, -1), mytrk.pt, mytrk.eta, mytrk.mode))
 
       # ________________________________________________________________________
-      # Fill histograms
-
-      def base_fill_efficiency(harvest_part, select_part, select_track):
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(harvest_part(part))
-          if trigger:
-            numer.fill(harvest_part(part))
-
-      def fill_efficiency_pt():
-        harvest_part = lambda part: part.pt
-        base_fill_efficiency(harvest_part, select_part, select_track)
-
-      def fill_efficiency_phi():
-        harvest_part = lambda part: np.rad2deg(part.phi)
-        base_fill_efficiency(harvest_part, select_part, select_track)
-
-      def fill_efficiency_eta():
-        harvest_part = lambda part: abs(part.eta)
-        select_part_eta = lambda part: (part.bx == 0) and (abs(part.d0) >= 0)  # no cut on eta
-        base_fill_efficiency(harvest_part, select_part_eta, select_track)
-
-      def fill_efficiency_d0():
-        harvest_part = lambda part: abs(part.d0)
-        select_part_d0 = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4)  # no cut on d0
-        base_fill_efficiency(harvest_part, select_part_d0, select_track)
-
-      def fill_efficiency_dz():
-        harvest_part = lambda part: abs(part.vz)
-        base_fill_efficiency(harvest_part, select_part, select_track)
-
-      def base_fill_efficiency_2D(harvest_part_x, harvest_part_y, select_part, select_track):
-        if select_part(part):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          denom = histograms[hname + "_denom"]
-          numer = histograms[hname + "_numer"]
-          denom.fill(harvest_part_x(part), harvest_part_y(part))
-          if trigger:
-            numer.fill(harvest_part_x(part), harvest_part_y(part))
-
-      def fill_efficiency_d0d1():
-        harvest_part_x = lambda part: part.d0
-        harvest_part_y = lambda part: part.invpt
-        select_part_d0 = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4)  # no cut on d0
-        base_fill_efficiency_2D(harvest_part_x, harvest_part_y, select_part_d0, select_track)
-
-      def fill_efficiency_etad1():
-        harvest_part_x = lambda part: abs(part.eta)
-        harvest_part_y = lambda part: part.invpt
-        select_part_d0 = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4)  # no cut on d0
-        base_fill_efficiency_2D(harvest_part_x, harvest_part_y, select_part_d0, select_track)
-
-      def fill_efficiency_etad0():
-        harvest_part_x = lambda part: abs(part.eta)
-        harvest_part_y = lambda part: part.d0
-        select_part_d0 = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4)  # no cut on d0
-        base_fill_efficiency_2D(harvest_part_x, harvest_part_y, select_part_d0, select_track)
-
-      def base_fill_efficiency_for_roads(harvest_part, select_part, select_track):
-        if select_part(part):
-          trigger_roads = len(roads) > 0
-          denom = histograms[hname_roads + "_denom"]
-          numer = histograms[hname_roads + "_numer"]
-          denom.fill(harvest_part(part))
-          if trigger_roads:
-            numer.fill(harvest_part(part))
-          #
-          trigger_croads = len(clean_roads) > 0
-          denom = histograms[hname_croads + "_denom"]
-          numer = histograms[hname_croads + "_numer"]
-          denom.fill(harvest_part(part))
-          if trigger_croads:
-            numer.fill(harvest_part(part))
-
-      def fill_efficiency_pt_for_roads():
-        harvest_part = lambda part: part.pt
-        base_fill_efficiency_for_roads(harvest_part, select_part, select_track)
-
-      def fill_efficiency_eta_for_roads():
-        harvest_part = lambda part: abs(part.eta)
-        select_part_eta = lambda part: (part.bx == 0)
-        base_fill_efficiency_for_roads(harvest_part, select_part_eta, select_track)
-
-      def fill_efficiency_d0_for_roads():
-        harvest_part = lambda part: abs(part.d0)
-        base_fill_efficiency_for_roads(harvest_part, select_part, select_track)
-
-      def fill_resolution():
-        if (part.bx == 0):
-          trigger = any([select_track(trk) for trk in tracks])  # using scaled pT
-          if trigger:
-            trk = tracks[0]
-            trk.invpt = np.true_divide(trk.q, trk.xml_pt)  # using unscaled pT
-            histograms[hname1].fill(part.invpt, trk.invpt)
-            #histograms[hname2].fill(abs(part.invpt), abs(part.invpt/trk.invpt) - 1)
-            histograms[hname2].fill(part.invpt, -(trk.invpt - part.invpt)/abs(part.invpt))
-            if part.pt > 20.:
-              histograms[hname3].fill(abs(part.eta), trk.invpt)
-              histograms[hname4].fill(abs(part.eta), -(trk.invpt - part.invpt)/abs(part.invpt))
-
-      # Check various L1 pT thresholds
-      for l in (0, 5, 10, 20, 30, 40, 50, 60):
-        # EMTF tracks
-        tracks = evt.tracks
-        select_part = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0)
-        select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15)) and (trk.pt > float(l)) and (trk.eta * part.eta > 0)
-
-        hname = "emtf_eff_vs_genpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        hname = "emtf_eff_vs_genpt_highpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf_eff_vs_genphi_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf_eff_vs_geneta_l1pt%i" % (l)
-          fill_efficiency_eta()
-          hname = "emtf_eff_vs_gend0_l1pt%i" % (l)
-          fill_efficiency_d0()
-          hname = "emtf_eff_vs_gendz_l1pt%i" % (l)
-          fill_efficiency_dz()
-        elif 5 < part.pt <= 20.:
-          hname = "emtf_eff_vs_genphi_lowpt_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf_eff_vs_geneta_lowpt_l1pt%i" % (l)
-          fill_efficiency_eta()
-
-        hname = "emtf_eff_vs_gend0d1_l1pt%i" % (l)
-        fill_efficiency_d0d1()
-        hname = "emtf_eff_vs_genetad1_l1pt%i" % (l)
-        fill_efficiency_etad1()
-        if part.pt > 20.:
-          hname = "emtf_eff_vs_genetad0_l1pt%i" % (l)
-          fill_efficiency_etad0()
-
-        if l == 0:
-          # Resolution
-          hname1 = "emtf_l1pt_vs_genpt"
-          hname2 = "emtf_l1ptres_vs_genpt"
-          hname3 = "emtf_l1pt_vs_geneta"
-          hname4 = "emtf_l1ptres_vs_geneta"
-          fill_resolution()
-
-        # EMTF++ tracks
-        tracks = emtf2026_tracks
-        select_part = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0)
-        select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.pt > float(l))
-        #select_track = lambda trk: trk and (1.1 <= abs(trk.eta) <= 2.6) and (trk.pt_displ > float(l)) and (abs(trk.d0_displ) >= 0)
-
-        hname = "emtf2026_eff_vs_genpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        hname = "emtf2026_eff_vs_genpt_highpt_l1pt%i" % (l)
-        fill_efficiency_pt()
-        if part.pt > 20.:
-          hname = "emtf2026_eff_vs_genphi_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf2026_eff_vs_geneta_l1pt%i" % (l)
-          fill_efficiency_eta()
-          hname = "emtf2026_eff_vs_gend0_l1pt%i" % (l)
-          fill_efficiency_d0()
-          hname = "emtf2026_eff_vs_gendz_l1pt%i" % (l)
-          fill_efficiency_dz()
-        elif 5 < part.pt <= 20.:
-          hname = "emtf2026_eff_vs_genphi_lowpt_l1pt%i" % (l)
-          fill_efficiency_phi()
-          hname = "emtf2026_eff_vs_geneta_lowpt_l1pt%i" % (l)
-          fill_efficiency_eta()
-
-        hname = "emtf2026_eff_vs_gend0d1_l1pt%i" % (l)
-        fill_efficiency_d0d1()
-        hname = "emtf2026_eff_vs_genetad1_l1pt%i" % (l)
-        fill_efficiency_etad1()
-        if part.pt > 20.:
-          hname = "emtf2026_eff_vs_genetad0_l1pt%i" % (l)
-          fill_efficiency_etad0()
-
-        if l == 0:
-          # Resolution
-          hname1 = "emtf2026_l1pt_vs_genpt"
-          hname2 = "emtf2026_l1ptres_vs_genpt"
-          hname3 = "emtf2026_l1pt_vs_geneta"
-          hname4 = "emtf2026_l1ptres_vs_geneta"
-          fill_resolution()
-
-        if l == 0:
-          # Pattern recognition & road cleaning (EMTF++ tracks only)
-          hname_roads = "emtf2026_eff_vs_genpt_roads"
-          hname_croads = "emtf2026_eff_vs_genpt_croads"
-          fill_efficiency_pt_for_roads()
-          if part.pt > 20.:
-            hname_roads = "emtf2026_eff_vs_geneta_roads"
-            hname_croads = "emtf2026_eff_vs_geneta_croads"
-            fill_efficiency_eta_for_roads()
-            hname_roads = "emtf2026_eff_vs_gend0_roads"
-            hname_croads = "emtf2026_eff_vs_gend0_croads"
-            fill_efficiency_d0_for_roads()
+      # Record the event and its tracks, the histograms are filled from the
+      # summary tables at the end (see emtf_summary.py)
+      entry = summary.add_event(jobid=jobid, event=ievt, pileup=pileup,
+                                part_pt=part.pt, part_eta=part.eta, part_phi=part.phi, part_q=part.q,
+                                part_invpt=part.invpt, part_d0=part.d0, part_vz=part.vz, part_bx=part.bx,
+                                nroads=len(roads), nclean_roads=len(clean_roads))
+      summary.add_tracks(entry, "emtf", evt.tracks)
+      summary.add_tracks(entry, "emtf2026", emtf2026_tracks, matched=emtf2026_matched.any(axis=0))
 
     # End loop over events
     unload_tree()
 
     # __________________________________________________________________________
+    # Fill histograms
+    fill_effie_histograms(histograms, summary.get_events(), summary.get_tracks(), summary.algos)
+
+    # __________________________________________________________________________
+    # Save summary tables
+    if write_summary:
+      outfile = 'histos_tbc_summary.npz'
+      if use_condor:
+        outfile = outfile[:-4] + ('_%i.npz' % jobid)
+      print('[INFO] Creating file: %s' % outfile)
+      summary.save(outfile)
+
+    # __________________________________________________________________________
+    # Save histograms
+    self.save_histograms(histograms)
+
+  def run_summary(self, infiles):
+    # Fill the histograms from the summary tables written by run()
+    events, tracks, algos = load_summary(infiles)
+    print('[INFO] Using {0} events from {1} summary files'.format(len(events), len(infiles)))
+    histograms = self.book_histograms()
+    fill_effie_histograms(histograms, events, tracks, algos)
+    self.save_histograms(histograms)
+
+  def save_histograms(self, histograms):
     # Quick efficiency
     for l in (0, 5, 10, 20, 30, 40, 50, 60):
       for k in ("denom", "numer"):
@@ -2759,124 +3275,112 @@ class EffieAnalysis(DummyAnalysis):
           ntotal = h.GetBinContent(h.FindBin(l))
       print('[INFO] @%i GeV npassed/ntotal: %i/%i = %f' % (l, npassed, ntotal, float(npassed)/ntotal if ntotal > 0 else 0.))
 
-    # __________________________________________________________________________
-    # Save histograms
-    outfile = 'histos_tbc.root'
+    # The condor jobs write .npz files, which are merged with emtf_histograms.py
     if use_condor:
-      outfile = outfile[:-5] + ('_%i.root' % jobid)
-    print('[INFO] Creating file: %s' % outfile)
-    with root_open(outfile, 'recreate') as f:
-      for (k, v) in histograms.iteritems():
-        v.Write()
+      outfile = 'histos_tbc_%i.npz' % jobid
+      print('[INFO] Creating file: %s' % outfile)
+      histograms.save(outfile)
+    else:
+      outfile = 'histos_tbc.root'
+      print('[INFO] Creating file: %s' % outfile)
+      histograms.save_root(outfile)
 
 
 # ______________________________________________________________________________
 # Analysis: mixing
 
-class MixingAnalysis(DummyAnalysis):
-  def run(self, omtf_input=False, run2_input=False):
-    # Load tree
-    tree = load_minbias_batch_for_mixing(jobid)
+class MixingAnalysis(EventAnalysis):
+  def load_tree(self):
+    return load_minbias_batch_for_mixing(jobid)
 
-    # Workers
-    bank = PatternBank(bankfile)
-    recog = PatternRecognition(bank, omtf_input=omtf_input, run2_input=run2_input)
-    clean = RoadCleaning()
-    slim = RoadSlimming(bank)
-    ghost = GhostBusting()
-    mucorr = TrackMuonCorrelation()
-    mucorr.also_check_pt = False
-
-    out_particles = []
-    out_roads = []
-    out_aux = []
-
-    def make_tracks_without_pt(roads):
-      tracks = []
-      for myroad in roads:
-        mode = myroad.mode
-        zone = myroad.id[3]
-        phi_median = myroad.phi_median
-        theta_median = myroad.theta_median
-        xml_pt, pt, trk_q, y_pred, y_discr, d1_pred, d0_pred = 0, 0, 0, 0, 0, 0, 0
-        trk = Track(myroad.id, myroad.hits, mode, myroad.quality, myroad.sort_code,
-                    xml_pt, pt, trk_q, y_pred, y_discr, d1_pred, d0_pred, phi_median, theta_median)
-        trk.myroad = myroad
-        tracks.append(trk)
-      return tracks
-
-    # Event range
-    maxEvents = -1
+  def begin(self, omtf_input=False, run2_input=False):
+    super(MixingAnalysis, self).begin(omtf_input=omtf_input, run2_input=run2_input)
 
-    # __________________________________________________________________________
-    # Loop over events
-    for ievt, evt in enumerate(tree):
-      if maxEvents != -1 and ievt == maxEvents:
-        break
-
-      roads = recog.run(evt.hits)
-      clean_roads = clean.run(roads)
-      slim_roads = slim.run(clean_roads)
-      assert(len(clean_roads) == len(slim_roads))
+    # Workers
+    self.ghost = GhostBusting()
+    self.mucorr = TrackMuonCorrelation()
+    self.mucorr.also_check_pt = False
 
-      tracks_without_pt = make_tracks_without_pt(slim_roads)
-      emtf2026_tracks = ghost.run(tracks_without_pt)
-      emtf2026_matched = mucorr.run(evt.particles, emtf2026_tracks)
+    self.out_particles = []
+    self.out_roads = []
+    self.out_aux = []
 
-      def find_highest_part_pt():
-        highest_pt = -999999.
-        for ipart, part in enumerate(evt.particles):
-          if select_part(part):
-            if highest_pt < part.pt:
-              highest_pt = part.pt
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-4, highest_pt)
-        return highest_pt
-
-      def find_highest_track_pt():
-        highest_pt = -999999.
-        for itrk, trk in enumerate(evt.tracks):
-          if select_track(trk):
-            if highest_pt < trk.pt:  # using scaled pT
-              highest_pt = trk.pt
-        if highest_pt > 0.:
-          highest_pt = min(100.-1e-4, highest_pt)
-        return highest_pt
-
-      select_part = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0)
-      select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
-
-      #highest_part_pt = find_highest_part_pt()
-      highest_track_pt = find_highest_track_pt()
-
-      for itrk, mytrk in enumerate(emtf2026_tracks):
-        m = emtf2026_matched[:, itrk]
-        if m.any():
-          assert(np.squeeze(m.nonzero()).ndim == 0)
-          m_ipart = np.asscalar(np.squeeze(m.nonzero()))
-          m_part = evt.particles[m_ipart]
-          mypart = Particle(m_part.pt, m_part.eta, m_part.phi, m_part.q, m_part.vx, m_part.vy, m_part.vz)
-          highest_part_pt = m_part.pt
-        else:
-          mypart = Particle(0., 0., 0., -1, 0., 0., 0.)
-          highest_part_pt = -999999.
-        aux = (jobid, ievt, highest_part_pt, highest_track_pt)
-        out_particles.append(mypart)
-        out_roads.append(mytrk.myroad)
-        out_aux.append(aux)
+  def make_tracks_without_pt(self, roads):
+    tracks = []
+    for myroad in roads:
+      mode = myroad.mode
+      zone = myroad.id[3]
+      phi_median = myroad.phi_median
+      theta_median = myroad.theta_median
+      xml_pt, pt, trk_q, y_pred, y_discr, d1_pred, d0_pred = 0, 0, 0, 0, 0, 0, 0
+      trk = Track(myroad.id, myroad.hits, mode, myroad.quality, myroad.sort_code,
+                  xml_pt, pt, trk_q, y_pred, y_discr, d1_pred, d0_pred, phi_median, theta_median)
+      trk.myroad = myroad
+      tracks.append(trk)
+    return tracks
 
-      debug_event_list = set([2826, 2937, 3675, 4581, 4838, 5379, 7640])
+  def process(self, ievt, evt, reco):
+    roads = reco.roads
+    clean_roads = reco.clean_roads
+    slim_roads = reco.slim_roads
+    assert(len(clean_roads) == len(slim_roads))
 
-      if ievt < 20 or (ievt in debug_event_list):
-        print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, len(roads), len(clean_roads), len(evt.tracks), '?'))
-        for iroad, myroad in enumerate(clean_roads):
-          print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
-          for ihit, myhit in enumerate(myroad.hits):
-            print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
+    tracks_without_pt = self.make_tracks_without_pt(slim_roads)
+    emtf2026_tracks = self.ghost.run(tracks_without_pt)
+    emtf2026_matched = self.mucorr.run(evt.particles, emtf2026_tracks)
 
-    # End loop over events
-    unload_tree()
+    def find_highest_part_pt():
+      highest_pt = -999999.
+      for ipart, part in enumerate(evt.particles):
+        if select_part(part):
+          if highest_pt < part.pt:
+            highest_pt = part.pt
+      if highest_pt > 0.:
+        highest_pt = min(100.-1e-4, highest_pt)
+      return highest_pt
+
+    def find_highest_track_pt():
+      highest_pt = -999999.
+      for itrk, trk in enumerate(evt.tracks):
+        if select_track(trk):
+          if highest_pt < trk.pt:  # using scaled pT
+            highest_pt = trk.pt
+      if highest_pt > 0.:
+        highest_pt = min(100.-1e-4, highest_pt)
+      return highest_pt
+
+    select_part = lambda part: (part.bx == 0) and (1.24 <= abs(part.eta) <= 2.4) and (abs(part.d0) >= 0)
+    select_track = lambda trk: trk and (1.24 <= abs(trk.eta) <= 2.4) and (trk.bx == 0) and (trk.mode in (11,13,14,15))
+
+    #highest_part_pt = find_highest_part_pt()
+    highest_track_pt = find_highest_track_pt()
+
+    for itrk, mytrk in enumerate(emtf2026_tracks):
+      m = emtf2026_matched[:, itrk]
+      if m.any():
+        assert(np.squeeze(m.nonzero()).ndim == 0)
+        m_ipart = np.asscalar(np.squeeze(m.nonzero()))
+        m_part = evt.particles[m_ipart]
+        mypart = Particle(m_part.pt, m_part.eta, m_part.phi, m_part.q, m_part.vx, m_part.vy, m_part.vz)
+        highest_part_pt = m_part.pt
+      else:
+        mypart = Particle(0., 0., 0., -1, 0., 0., 0.)
+        highest_part_pt = -999999.
+      aux = (jobid, ievt, highest_part_pt, highest_track_pt)
+      self.out_particles.append(mypart)
+      self.out_roads.append(mytrk.myroad)
+      self.out_aux.append(aux)
+
+    debug_event_list = set([2826, 2937, 3675, 4581, 4838, 5379, 7640])
+
+    if ievt < 20 or (ievt in debug_event_list):
+      print("evt {0} has {1} roads, {2} clean roads, {3} old tracks, {4} new tracks".format(ievt, len(roads), len(clean_roads), len(evt.tracks), '?'))
+      for iroad, myroad in enumerate(clean_roads):
+        print(".. croad {0} id: {1} nhits: {2} mode: {3} qual: {4} sort: {5}".format(iroad, myroad.id, len(myroad.hits), myroad.mode, myroad.quality, myroad.sort_code))
+        for ihit, myhit in enumerate(myroad.hits):
+          print(".. .. hit {0} id: {1} lay: {2} ph: {3} th: {4} tp: {5}".format(ihit, myhit.id, myhit.emtf_layer, myhit.emtf_phi, myhit.emtf_theta, myhit.sim_tp))
 
+  def end(self):
     # __________________________________________________________________________
     # Save objects
     outfile = 'histos_tbd.npz'
@@ -2884,11 +3388,11 @@ class MixingAnalysis(DummyAnalysis):
       outfile = outfile[:-4] + ('_%i.npz' % jobid)
     print('[INFO] Creating file: %s' % outfile)
     with contextlib_nullcontext(outfile) as f:
-      assert(len(out_particles) == len(out_roads))
-      assert(len(out_particles) == len(out_aux))
-      parameters = particles_to_parameters(out_particles)
-      variables = roads_to_variables(out_roads)
-      out_aux = np.array(out_aux, dtype=np.float32)
+      assert(len(self.out_particles) == len(self.out_roads))
+      assert(len(self.out_particles) == len(self.out_aux))
+      parameters = particles_to_parameters(self.out_particles)
+      variables = roads_to_variables(self.out_roads)
+      out_aux = np.array(self.out_aux, dtype=np.float32)
       np.savez_compressed(f, parameters=parameters, variables=variables, aux=out_aux)
 
 
@@ -3107,160 +3611,153 @@ class AugmentationAnalysis(DummyAnalysis):
 # ______________________________________________________________________________
 # Analysis: images
 
-class ImagesAnalysis(DummyAnalysis):
-  def run(self, omtf_input=False, run2_input=False):
-    # Load tree
-    if omtf_input:
-      tree = load_pgun_omtf()
+class ImagesAnalysis(EventAnalysis):
+  # Event range
+  maxEvents = 2000000
+
+  def load_tree(self):
+    if self.omtf_input:
+      return load_pgun_omtf()
     else:
-      tree = load_pgun()
+      return load_pgun()
 
-    out_part = []
-    out_hits = []
+  def begin(self, omtf_input=False, run2_input=False):
+    super(ImagesAnalysis, self).begin(omtf_input=omtf_input, run2_input=run2_input)
+    self.out_part = []
+    self.out_hits = []
 
-    # Event range
-    maxEvents = 2000000
+  def process(self, ievt, evt, reco):
+    # Skip events with very few hits
+    if self.omtf_input:
+      if not len(evt.hits) >= 2:
+        return
+    else:
+      if not len(evt.hits) >= 3:
+        return
+
+    # Skip events without ME1 hits
+    has_ME1 = False
+    for ihit, hit in enumerate(evt.hits):
+      if hit.sim_tp1 == 0:
+        if hit.type == kCSC and hit.station == 1:
+          has_ME1 = True
+          break
+        elif hit.type == kME0 and hit.station == 1:
+          has_ME1 = True
+          break
+        elif hit.type == kDT and (hit.station == 1 or hit.station == 2):
+          has_ME1 = True
+          break
+    if not has_ME1:
+      return
 
-    # __________________________________________________________________________
-    # Loop over events
-    for ievt, evt in enumerate(tree):
-      if maxEvents != -1 and ievt == maxEvents:
-        break
+    part = evt.particles[0]  # particle gun
+    part.invpt = np.true_divide(part.q, part.pt)
+    part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
 
-      # Skip events with very few hits
-      if omtf_input:
-        if not len(evt.hits) >= 2:
-          continue
-      else:
-        if not len(evt.hits) >= 3:
-          continue
+    images_hits = filter(is_emtf_images_hit, evt.hits)
 
-      # Skip events without ME1 hits
-      has_ME1 = False
-      for ihit, hit in enumerate(evt.hits):
-        if hit.sim_tp1 == 0:
-          if hit.type == kCSC and hit.station == 1:
-            has_ME1 = True
-            break
-          elif hit.type == kME0 and hit.station == 1:
-            has_ME1 = True
-            break
-          elif hit.type == kDT and (hit.station == 1 or hit.station == 2):
-            has_ME1 = True
-            break
-      if not has_ME1:
-        continue
+    # Find the best sector (using csc-only 'mode')
+    sector_mode_array = np.zeros((12,), dtype=np.int32)
+    sector_hits_array = np.empty((12,), dtype=np.object)
+    for ind in np.ndindex(sector_hits_array.shape):
+      sector_hits_array[ind] = []
 
-      part = evt.particles[0]  # particle gun
-      part.invpt = np.true_divide(part.q, part.pt)
-      part.d0 = calculate_d0(part.invpt, part.phi, part.vx, part.vy)
+    # Loop over hits
+    for ihit, hit in enumerate(images_hits):
+      #assert(hit.emtf_phi < 5040)  # 84*60
+      assert(hit.emtf_phi < 5400)  # 90*60
+
+      endsec = find_endsec(hit.endcap, hit.sector)
+      sector_hits_array[endsec].append(hit)
+
+      if hit.sim_tp1 == 0:
+        if hit.type == kCSC:
+          sector_mode_array[endsec] |= (1 << (4 - hit.station))
+        elif hit.type == kME0:
+          sector_mode_array[endsec] |= (1 << (4 - 1))
+        elif hit.type == kDT:
+          sector_mode_array[endsec] |= (1 << (4 - 1))
 
-      images_hits = filter(is_emtf_images_hit, evt.hits)
+    # Get the best sector
+    #best_sector = np.argmax(sector_mode_array)
+    best_sector = np.argmax(sector_mode_array * 100 + [len(x) for x in sector_hits_array])
+    mode = sector_mode_array[best_sector]
 
-      # Find the best sector (using csc-only 'mode')
-      sector_mode_array = np.zeros((12,), dtype=np.int32)
-      sector_hits_array = np.empty((12,), dtype=np.object)
-      for ind in np.ndindex(sector_hits_array.shape):
-        sector_hits_array[ind] = []
+    # Skip events without station 1
+    if not is_emtf_singlehit(mode):
+      return
 
-      # Loop over hits
-      for ihit, hit in enumerate(images_hits):
-        #assert(hit.emtf_phi < 5040)  # 84*60
-        assert(hit.emtf_phi < 5400)  # 90*60
+    # Get the hits
+    sector_hits = sector_hits_array[best_sector]
 
-        endsec = find_endsec(hit.endcap, hit.sector)
-        sector_hits_array[endsec].append(hit)
+    amap = {}  # zone -> hits
 
+    # Loop over sector hits
+    for ihit, hit in enumerate(sector_hits):
+      hit.emtf_layer = find_emtf_layer(hit)
+      assert(hit.emtf_layer != -99)
+
+      zones = find_emtf_zones(hit)
+      for z in zones:
+        amap.setdefault(np.asscalar(z), []).append(hit)
+      continue  # end loop over sector_hits
+
+    # Loop over map of zone -> hits
+    ievt_part = []
+    ievt_hits = []
+
+    for k, v in amap.iteritems():
+      zone = k
+      hits = v
+
+      # Skip zones with very few hits
+      if not ((zone in (0,1,2,3,4) and len(hits) >= 3) or (zone in (5,6) and len(hits) >= 2)):
+        continue
+
+      zone_mode = 0
+      for ihit, hit in enumerate(hits):
         if hit.sim_tp1 == 0:
           if hit.type == kCSC:
-            sector_mode_array[endsec] |= (1 << (4 - hit.station))
+            zone_mode |= (1 << (4 - hit.station))
           elif hit.type == kME0:
-            sector_mode_array[endsec] |= (1 << (4 - 1))
+            zone_mode |= (1 << (4 - 1))
           elif hit.type == kDT:
-            sector_mode_array[endsec] |= (1 << (4 - 1))
+            zone_mode |= (1 << (4 - 1))
 
-      # Get the best sector
-      #best_sector = np.argmax(sector_mode_array)
-      best_sector = np.argmax(sector_mode_array * 100 + [len(x) for x in sector_hits_array])
-      mode = sector_mode_array[best_sector]
-
-      # Skip events without station 1
-      if not is_emtf_singlehit(mode):
+      # Skip zones without station 1
+      if not is_emtf_singlehit(zone_mode):
         continue
 
-      # Get the hits
-      sector_hits = sector_hits_array[best_sector]
+      zone_layers = np.zeros(16, dtype=np.bool)
+      for ihit, hit in enumerate(hits):
+        zone_layers[hit.emtf_layer] = True
 
-      amap = {}  # zone -> hits
+      # Skip zones without at least 2 stations
+      if not (zone_layers.sum() >= 2):
+        continue
 
-      # Loop over sector hits
-      for ihit, hit in enumerate(sector_hits):
-        hit.emtf_layer = find_emtf_layer(hit)
-        assert(hit.emtf_layer != -99)
-
-        zones = find_emtf_zones(hit)
-        for z in zones:
-          amap.setdefault(np.asscalar(z), []).append(hit)
-        continue  # end loop over sector_hits
-
-      # Loop over map of zone -> hits
-      ievt_part = []
-      ievt_hits = []
-
-      for k, v in amap.iteritems():
-        zone = k
-        hits = v
-
-        # Skip zones with very few hits
-        if not ((zone in (0,1,2,3,4) and len(hits) >= 3) or (zone in (5,6) and len(hits) >= 2)):
-          continue
-
-        zone_mode = 0
-        for ihit, hit in enumerate(hits):
-          if hit.sim_tp1 == 0:
-            if hit.type == kCSC:
-              zone_mode |= (1 << (4 - hit.station))
-            elif hit.type == kME0:
-              zone_mode |= (1 << (4 - 1))
-            elif hit.type == kDT:
-              zone_mode |= (1 << (4 - 1))
-
-        # Skip zones without station 1
-        if not is_emtf_singlehit(zone_mode):
-          continue
-
-        zone_layers = np.zeros(16, dtype=np.bool)
-        for ihit, hit in enumerate(hits):
-          zone_layers[hit.emtf_layer] = True
-
-        # Skip zones without at least 2 stations
-        if not (zone_layers.sum() >= 2):
-          continue
-
-        # Particle info
-        part_info = np.array([part.invpt, part.eta, part.phi, part.d0, zone, best_sector])
-
-        # Hits info
-        #get_hit_info = lambda hit: (hit.emtf_layer, hit.emtf_phi)
-        get_hit_info = lambda hit: (hit.emtf_layer, find_emtf_phi(hit))
-        hits_info = np.array([get_hit_info(hit) for hit in hits])
-
-        ievt_part.append(part_info)
-        ievt_hits.append(hits_info)
-        continue  # end loop over map of zone -> hits
+      # Particle info
+      part_info = np.array([part.invpt, part.eta, part.phi, part.d0, zone, best_sector])
 
-      if ievt < 20:
-        ievt_nhits = [len(x) for x in ievt_hits]
-        print ievt, part.pt, ievt_part, ievt_nhits
+      # Hits info
+      #get_hit_info = lambda hit: (hit.emtf_layer, hit.emtf_phi)
+      get_hit_info = lambda hit: (hit.emtf_layer, find_emtf_phi(hit))
+      hits_info = np.array([get_hit_info(hit) for hit in hits])
 
-      # Output
-      out_part += ievt_part
-      out_hits += ievt_hits
-      continue  # end loop over events
+      ievt_part.append(part_info)
+      ievt_hits.append(hits_info)
+      continue  # end loop over map of zone -> hits
 
-    # End loop over events
-    unload_tree()
+    if ievt < 20:
+      ievt_nhits = [len(x) for x in ievt_hits]
+      print ievt, part.pt, ievt_part, ievt_nhits
 
+    # Output
+    self.out_part += ievt_part
+    self.out_hits += ievt_hits
+
+  def end(self):
     # __________________________________________________________________________
     # Save objects
     outfile = 'histos_tbi.npz'
@@ -3268,9 +3765,9 @@ class ImagesAnalysis(DummyAnalysis):
       outfile = outfile[:-4] + ('_%i.npz' % jobid)
     print('[INFO] Creating file: %s' % outfile)
     with contextlib_nullcontext(outfile) as f:
-      assert(len(out_part) == len(out_hits))
-      out_part = np.asarray(out_part, dtype=np.float32)
-      out_hits = create_ragged_array(out_hits)
+      assert(len(self.out_part) == len(self.out_hits))
+      out_part = np.asarray(self.out_part, dtype=np.float32)
+      out_hits = create_ragged_array(self.out_hits)
       print out_part.shape, out_hits.shape
       np.savez_compressed(f, out_part=out_part, out_hits_values=out_hits.values, out_hits_row_splits=out_hits.row_splits)
 
@@ -3300,6 +3797,10 @@ analysis = 'effie'
 #analysis = 'collusion'
 #analysis = 'augmentation'
 #analysis = 'images'
+#analysis = 'rates_summary'
+#analysis = 'effie_summary'
+#analysis = 'rates_pu_scan'
+#analysis = 'rates,roads,images'  # several analyses in one loop (see event_analyses below)
 if use_condor:
   analysis = sys.argv[2]
 
@@ -3316,6 +3817,51 @@ kerasfile = ['model.29.json', 'model_weights.29.h5',
              'model_run3.29.json', 'model_run3_weights.29.h5',
              'model_omtf.29.json', 'model_omtf_weights.29.h5',]
 
+# NN inference backend ('keras', 'graph', 'numpy' or 'quant')
+# the 'graph' backend needs the frozen graphs, see test5/convert_to_constant_graph.py
+# the 'numpy' and 'quant' (fixed-point) backends need the converted models, see nn_numpy.py
+nn_backend = 'keras'
+
+# Number of roads per pT assignment call (1: call once per event)
+batch_size = 1024
+
+# NN models to run on the same events, out of 'default', 'run3' and 'omtf' (None: one model chosen by
+# omtf_input and run2_input); the first one is the main model, the rates of the others are saved as
+# 'emtf2026_<model name>' histograms
+# Each model runs on the roads of its own algo (e.g. with zone 6 for 'omtf', with the Run-2 hits only
+# for 'run3'): the pattern recognition, road cleaning and road slimming are done once per event for
+# each algo of the models, in the same loop over the input
+nn_models = None
+
+# Cache of the NN outputs, keyed by the encoded road features and the model (see nn_cache.py)
+# nn_cachesize is the max number of entries kept in memory (0: no memory cache)
+# nn_cachefile is a sqlite file that keeps the entries across jobs (None: no disk cache), e.g. when
+# the rates are redone with a different trigger threshold
+nn_cachesize = 0
+nn_cachefile = None
+
+# Per-event summary tables of the rates and effie analyses (see emtf_summary.py), saved as
+# histos_tbb_summary.npz and histos_tbc_summary.npz. The 'rates_summary' and 'effie_summary'
+# analyses fill the histograms again from summary_files, without running the track building
+write_summary = True
+summary_files = None  # None: histos_tbb_summary*.npz or histos_tbc_summary*.npz
+
+# Cache of the stage outputs of the rates analysis, i.e. the roads and the pT assignment results, per
+# input file (see emtf_stage_cache.py). The next run with the same input, pattern bank and NN models
+# starts from the deepest cached stage, e.g. when tuning the track producer or the ghost busting
+stage_cache_dir = None  # None: no cache, e.g. 'stage_cache'
+
+# Pileup scan of the rates ('rates_pu_scan'): the input files of all the pileup points are run as
+# shards by a pool of pu_scan_workers processes, the most expensive ones first. The time per event
+# grows faster than linearly with the pileup, the time per shard is taken from the previous scan.
+# The events of all the points are saved in pu_scan_outfile, with the number of events and the time
+# of each point, and the histograms of each point in histos_tbb_<pileup>.root
+pu_scan_points = [140, 200, 250, 300]
+pu_scan_files = None  # max number of input files per pileup point (None: all)
+pu_scan_workers = 4
+pu_scan_cost_exponent = 2.  # until measured: time per shard ~ pileup ** pu_scan_cost_exponent
+pu_scan_outfile = 'rates_vs_pu.npz'
+
 
 # ______________________________________________________________________________
 # Input files
@@ -3349,6 +3895,10 @@ def load_tree_single(infile):
   define_collections(tree)
   return tree
 
+def get_tree_identity(tree, maxEvents=-1):
+  # The file UUID changes whenever the file is written again, so the contents need not be read
+  return '{0}:{1}:{2}:{3}'.format(infile_r.GetName(), infile_r.GetUUID().AsString(), tree.GetEntries(), maxEvents)
+
 def load_tree_multiple(infiles):
   print('[INFO] Opening file: %s' % ' '.join(infiles))
   tree = TreeChain('ntupler/tree', infiles)
@@ -3392,7 +3942,7 @@ def load_pgun_displ_batch(k):
     infiles.append(eos_prefix + 'SingleMuon_Displaced2_2GeV_PhaseIITDRSpring19/ParticleGuns/CRAB3/190923_212452/%04i/ntuple_SingleMuon_Displaced2_%i.root' % ((j+1)//1000, (j+1)))
   return load_tree_multiple(infiles)
 
-def load_minbias_batch(k, pileup=200):
+def get_minbias_batch_files(pileup=200):
   if pileup == 140:
     pufiles = [eos_prefix + 'ntuple_SingleNeutrino_PU140_PhaseIITDRSpring19/Nu_E10-pythia8-gun/CRAB3/190926_145646/0000/ntuple_%i.root' % (i+1) for i in range(63)]
   elif pileup == 200:
@@ -3403,6 +3953,10 @@ def load_minbias_batch(k, pileup=200):
     pufiles = [eos_prefix + 'ntuple_SingleNeutrino_PU300_PhaseIITDRSpring19/Nu_E10-pythia8-gun/CRAB3/191002_214457/0000/ntuple_%i.root' % (i+1) for i in range(111)]
   else:
     raise RuntimeError('Cannot recognize pileup: {0}'.format(pileup))
+  return pufiles
+
+def load_minbias_batch(k, pileup=200):
+  pufiles = get_minbias_batch_files(pileup)
   #
   infile = pufiles[k]
   return load_tree_single(infile)
@@ -3477,6 +4031,19 @@ def load_minbias_batch_for_collusion(k):
 # ______________________________________________________________________________
 # Main
 
+# Analyses that can run in the same loop: name -> (class, keyword arguments of begin())
+# Each class at most once per loop, and the rates first (e.g. 'rates140,roads')
+event_analyses = {
+  'roads': (RoadsAnalysis, {}),
+  'rates': (RatesAnalysis, {}),
+  'rates140': (RatesAnalysis, dict(pileup=140)),
+  'rates200': (RatesAnalysis, dict(pileup=200)),
+  'rates250': (RatesAnalysis, dict(pileup=250)),
+  'rates300': (RatesAnalysis, dict(pileup=300)),
+  'mixing': (MixingAnalysis, {}),
+  'images': (ImagesAnalysis, {}),
+}
+
 if __name__ == "__main__":
   start_time = datetime.datetime.now()
   print('[INFO] Current time    : {0}'.format(start_time))
@@ -3496,7 +4063,19 @@ if __name__ == "__main__":
   else:
     omtf_input = False
 
-  if analysis == 'dummy':
+  if ',' in analysis:
+    # Run the analyses in the same loop over the input of the first one, the
+    # reconstruction of each event is done once and shared
+    analyses = []
+    for name in analysis.split(','):
+      if name not in event_analyses:
+        raise RuntimeError('Cannot run analysis in the same loop: {0}'.format(name))
+      (cls, kwargs) = event_analyses[name]
+      analyses.append((cls(), kwargs))
+    analysis = MultiAnalysis(analyses)
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+
+  elif analysis == 'dummy':
     analysis = DummyAnalysis()
     analysis.run(omtf_input=omtf_input, run2_input=run2_input)
 
@@ -3533,6 +4112,17 @@ if __name__ == "__main__":
     analysis = EffieAnalysis()
     analysis.run(omtf_input=omtf_input, run2_input=run2_input, pileup=300)
 
+  elif analysis == 'rates_summary':
+    analysis = RatesAnalysis()
+    analysis.run_summary(summary_files or sorted(glob.glob('histos_tbb_summary*.npz')))
+  elif analysis == 'effie_summary':
+    analysis = EffieAnalysis()
+    analysis.run_summary(summary_files or sorted(glob.glob('histos_tbc_summary*.npz')))
+
+  elif analysis == 'rates_pu_scan':
+    analysis = PileupScanAnalysis()
+    analysis.run(omtf_input=omtf_input, run2_input=run2_input)
+
   elif analysis == 'mixing':
     analysis = MixingAnalysis()
     analysis.run(omtf_input=omtf_input, run2_input=run2_input)
@@ -3554,4 +4144,5 @@ if __name__ == "__main__":
 
   stop_time = datetime.datetime.now()
   print('[INFO] Elapsed time    : {0}'.format(stop_time - start_time))
+  print('[INFO] Max RSS         : {0:.0f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
   # DONE!
@@ -0,0 +1,261 @@
+"""Training throughput benchmark of the pT assignment network.
+
+A create_model_bn-style network is trained for a few epochs on mixed muon and
+pileup batches (see MixedBatches in nn_data.py), for every combination of
+batch size and number of threads. Each configuration is trained in a new
+worker process, so that its thread settings and its peak memory do not depend
+on the previous ones. The data, either synthetic or the encoded training data
+(see load_search_data() in nn_search.py), are made once by the main process
+and shared by the workers after the fork.
+
+For each configuration, the report gives per epoch:
+  - the time of the epoch and the number of samples
+  - the time spent between the end of a batch and the start of the next one,
+    which is mostly the wait for the data (wait_seconds)
+  - the time spent by the data pipeline to make the batches (data_seconds),
+    which may overlap with the training as fit_generator() prefetches them
+and the samples per second and data-wait fraction averaged over the epochs
+after the first (which includes the setup of the graph), with the peak RSS
+of the worker.
+
+The report is a JSON file with the run info (machine, versions, settings, as
+collected by BenchmarkFileLogger in old/cnn_benchmark.py) and the results. It
+is rewritten after each configuration.
+
+  python nn_benchmark.py
+"""
+
+import numpy as np
+
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+
+from nn_search import limit_threads, set_search_data, get_mixed_batches
+
+from nn_logging import getLogger
+logger = getLogger()
+
+
+# ______________________________________________________________________________
+def make_synthetic_data(nsamples=200000, pu_nsamples=50000, nvariables=36, mask_value=100., seed=2026):
+  """Sets random data with the shapes of the encoded training data as the benchmark data."""
+  rng = np.random.RandomState(seed)
+  x_train = rng.normal(size=(nsamples, nvariables)).astype(np.float32)
+  y_train = [rng.uniform(-1., 1., size=nsamples).astype(np.float32), np.ones(nsamples, dtype=np.float32)]
+  pu_x_train = rng.normal(size=(pu_nsamples, nvariables)).astype(np.float32)
+  pu_y_train = [np.full(pu_nsamples, mask_value, dtype=np.float32), np.zeros(pu_nsamples, dtype=np.float32)]
+  set_search_data(x_train, y_train, pu_x_train, pu_y_train, validation_split=0.)
+
+def get_peak_rss():
+  """Peak resident memory of this process in MB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kB on Linux
+
+class TimedBatches(object):
+  """Batches of an iterable, counting the time spent to make them."""
+
+  def __init__(self, batches):
+    self.batches = batches
+    self.seconds = 0.
+
+  def __len__(self):
+    return len(self.batches)
+
+  def __iter__(self):
+    it = iter(self.batches)
+    while True:
+      start = time.time()
+      try:
+        batch = next(it)
+      except StopIteration:
+        return
+      self.seconds += time.time() - start
+      yield batch
+
+class EpochTimer(object):
+  """Times the epochs and the gaps between the batches, from Keras callbacks."""
+
+  def __init__(self, data):
+    self.data = data
+    self.epochs = []
+
+  def on_epoch_begin(self, epoch, logs):
+    self.epoch_start = self.batch_end = time.time()
+    self.data_start = self.data.seconds
+    self.samples = 0
+    self.wait_seconds = 0.
+
+  def on_batch_begin(self, batch, logs):
+    self.wait_seconds += time.time() - self.batch_end
+
+  def on_batch_end(self, batch, logs):
+    self.batch_end = time.time()
+    self.samples += logs.get('size', 0)
+
+  def on_epoch_end(self, epoch, logs):
+    seconds = time.time() - self.epoch_start
+    self.epochs.append(dict(epoch=epoch, seconds=seconds, samples=self.samples, wait_seconds=self.wait_seconds,
+                            data_seconds=self.data.seconds - self.data_start, loss=float(logs.get('loss', np.nan))))
+
+  def get_callback(self):
+    from keras.callbacks import LambdaCallback
+    return LambdaCallback(on_epoch_begin=self.on_epoch_begin, on_epoch_end=self.on_epoch_end,
+                          on_batch_begin=self.on_batch_begin, on_batch_end=self.on_batch_end)
+
+def run_config(task):
+  """Trains one configuration in a worker process. Returns its result."""
+  limit_threads(task['nthreads'])
+  import nn_models
+  from nn_training import train_model
+  from nn_search import search_data
+
+  params = dict(task['params'])
+  build_fn = getattr(nn_models, params.pop('build_fn', 'create_model_bn'))
+  model = build_fn(nvariables=search_data['x_train'].shape[1], **params)
+
+  train, _ = get_mixed_batches(task['batch_size'])
+  data = TimedBatches(train)
+  timer = EpochTimer(data)
+  steps_per_epoch = min(task['steps_per_epoch'] or len(train), len(train))
+  model_name = os.path.join(task['outdir'], 'model_bs%i_nt%i' % (task['batch_size'], task['nthreads']))
+  train_model(model, data, model_name=model_name, epochs=task['epochs'], verbose=0,
+              callbacks=[timer.get_callback()], steps_per_epoch=steps_per_epoch)
+
+  result = dict((k, task[k]) for k in ('batch_size', 'nthreads', 'epochs'))
+  result['steps_per_epoch'] = steps_per_epoch
+  result['epoch_info'] = timer.epochs
+  timed = timer.epochs[task['skip_epochs']:] or timer.epochs
+  seconds = sum([e['seconds'] for e in timed])
+  result['samples_per_second'] = sum([e['samples'] for e in timed]) / seconds
+  result['seconds_per_epoch'] = seconds / len(timed)
+  result['data_wait_fraction'] = sum([e['wait_seconds'] for e in timed]) / seconds
+  result['data_seconds_per_epoch'] = sum([e['data_seconds'] for e in timed]) / len(timed)
+  result['peak_rss_mb'] = get_peak_rss()
+  return result
+
+
+# ______________________________________________________________________________
+def gather_run_info(run_params):
+  """Machine and software info, like _gather_run_info() in old/cnn_benchmark.py."""
+  run_info = dict(run_date=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                  run_parameters=run_params, machine_config={})
+  run_info['python_version'] = platform.python_version()
+  run_info['numpy_version'] = np.__version__
+  run_info['environment_variables'] = dict((k, v) for (k, v) in sorted(os.environ.items())
+                                           if k.startswith('TF_') or k.endswith('_NUM_THREADS'))
+
+  cpu_info = dict(num_cores=multiprocessing.cpu_count(), machine=platform.machine())
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith('model name'):
+          cpu_info['cpu_info'] = line.split(':', 1)[1].strip()
+          break
+  except IOError:
+    logger.warning('Cannot read /proc/cpuinfo. CPU model will not be logged.')
+  run_info['machine_config']['cpu_info'] = cpu_info
+
+  try:
+    import psutil
+    vmem = psutil.virtual_memory()
+    run_info['machine_config']['memory_total'] = vmem.total
+    run_info['machine_config']['memory_available'] = vmem.available
+  except ImportError:
+    try:
+      run_info['machine_config']['memory_total'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+      logger.warning('psutil not imported. Memory info will not be logged.')
+  return run_info
+
+def get_versions(_):
+  # Imported by a worker, not by the main process before the fork
+  import tensorflow as tf
+  import keras
+  return dict(tensorflow_version=dict(version=tf.VERSION, git_hash=tf.GIT_VERSION), keras_version=keras.__version__)
+
+class ThroughputBenchmark(object):
+  def __init__(self, batch_sizes, nthreads_list, outdir='nn_benchmark', epochs=3, skip_epochs=1,
+               steps_per_epoch=None, params=None):
+    """Trains for epochs with each batch size and number of threads, at most
+    steps_per_epoch batches per epoch (all the training data if None). params
+    are passed to the build_fn of nn_models.py, e.g. dict(build_fn='create_model_bn2', nodes1=30)."""
+    self.configs = list(itertools.product(batch_sizes, nthreads_list))
+    self.outdir = outdir
+    self.epochs = epochs
+    self.skip_epochs = skip_epochs
+    self.steps_per_epoch = steps_per_epoch
+    self.params = params or {}
+    if not os.path.exists(outdir):
+      os.makedirs(outdir)
+    self.report_file = os.path.join(outdir, 'report.json')
+
+  def run_in_worker(self, func, arg):
+    # One new process per call
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+      result = pool.apply(func, (arg,))
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    return result
+
+  def write_report(self, report):
+    tmpname = self.report_file + '.tmp'
+    with open(tmpname, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+    os.rename(tmpname, self.report_file)
+
+  def run(self):
+    run_params = dict(epochs=self.epochs, skip_epochs=self.skip_epochs, steps_per_epoch=self.steps_per_epoch,
+                      params=self.params, configs=self.configs)
+    report = dict(run_info=gather_run_info(run_params), results=[])
+    report['run_info'].update(self.run_in_worker(get_versions, None))
+    report['run_info']['main_peak_rss_mb'] = get_peak_rss()
+
+    for (batch_size, nthreads) in self.configs:
+      task = dict(batch_size=batch_size, nthreads=nthreads, params=self.params, epochs=self.epochs,
+                  skip_epochs=self.skip_epochs, steps_per_epoch=self.steps_per_epoch, outdir=self.outdir)
+      result = self.run_in_worker(run_config, task)
+      report['results'].append(result)
+      self.write_report(report)
+      logger.info('Batch size {0} with {1} threads: {2:.0f} samples/s, {3:.2f} s/epoch, data wait {4:.1%}, peak RSS {5:.0f} MB'.format(
+          batch_size, nthreads, result['samples_per_second'], result['seconds_per_epoch'],
+          result['data_wait_fraction'], result['peak_rss_mb']))
+    logger.info('Wrote {0}'.format(self.report_file))
+    return report
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  from functools import partial
+  from nn_encode import create_encoder
+  from nn_search import load_search_data
+
+  # Not from nn_globals.py, which imports TensorFlow before the workers are forked
+  from nn_constants import reg_pt_scale, reg_dxy_scale, mask_value, discr_pt_cut_low, discr_loss_weight, \
+                           infile_muon, infile_pileup
+
+  use_synthetic = True
+
+  if use_synthetic:
+    make_synthetic_data(nsamples=200000, pu_nsamples=50000, mask_value=mask_value)
+  else:
+    load_search_data(infile_muon, infile_pileup, partial(create_encoder, reg_pt_scale=reg_pt_scale, reg_dxy_scale=reg_dxy_scale),
+                     mask_value=mask_value, reg_pt_scale=reg_pt_scale, discr_pt_cut_low=discr_pt_cut_low, validation_split=0.)
+
+  max_threads = multiprocessing.cpu_count()
+  nthreads_list = sorted(set([1, 2, 4, 8, 16, max_threads]) & set(range(1, max_threads + 1)))
+  benchmark = ThroughputBenchmark(batch_sizes=[128, 256, 512, 1024, 2048, 4096], nthreads_list=nthreads_list,
+                                  outdir='nn_benchmark', epochs=3, skip_epochs=1,
+                                  params=dict(build_fn='create_model_bn', nodes1=30, nodes2=25, nodes3=20,
+                                              discr_loss_weight=discr_loss_weight))
+  benchmark.run()
+  logger.info('DONE')
@@ -2,35 +2,106 @@ import numpy as np
 from sklearn.model_selection import train_test_split
 from itertools import chain
 
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import sys
+
+from nn_encode import encode_chunked
+from nn_stream import encode_shard
+
 from nn_logging import getLogger
 logger = getLogger()
 
 
 # ______________________________________________________________________________
-def muon_data(filename, create_encoder):
+# Cache of the encoded data, next to the input file, e.g. muon.npz is encoded
+# into muon_encoded_<key>/x.npy, y.npy, etc. The key is the SHA-1 of the
+# contents of the input file, the encoder function and its options, and the
+# source code of the encoder module, so a different file or encoding never
+# reuses the cache. The arrays are opened as memory maps.
+
+def file_identity(filename):
+  h = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()
+
+def encoder_identity(create_encoder):
+  # Unwrap the partials, e.g. partial(create_encoder, reg_pt_scale=100., reg_dxy_scale=0.4)
+  func, args, keywords = create_encoder, (), {}
+  while isinstance(func, functools.partial):
+    args = func.args + args
+    merged = dict(func.keywords or {})
+    merged.update(keywords)
+    func, keywords = func.func, merged
+  source = inspect.getsource(sys.modules[func.__module__])
+  return repr((func.__module__, func.__name__, args, sorted(keywords.items()))) + source
+
+def encoded_cache_dir(filename, create_encoder):
+  h = hashlib.sha1()
+  h.update(file_identity(filename).encode('utf-8'))
+  h.update(encoder_identity(create_encoder).encode('utf-8'))
+  return os.path.splitext(filename)[0] + '_encoded_' + h.hexdigest()[:16]
+
+def load_encoded(filename, create_encoder, use_cache=True):
+  """Returns a dict of the encoded arrays ('x', 'y', 'dxy', 'dz', 'x_mask', 'x_road'), plus 'aux' if in the file."""
+  cache_dir = encoded_cache_dir(filename, create_encoder) if use_cache else None
+  if cache_dir is not None and os.path.isdir(cache_dir):
+    logger.info('Loading encoded data from {0} ...'.format(cache_dir))
+    return dict((os.path.splitext(f)[0], np.load(os.path.join(cache_dir, f), mmap_mode='r')) for f in os.listdir(cache_dir))
+
   try:
-    logger.info('Loading muon data from {0} ...'.format(filename))
     with np.load(filename) as loaded:
-      the_variables = loaded['variables']
-      the_parameters = loaded['parameters']
-    logger.info('Loaded the variables with shape {0}'.format(the_variables.shape))
-    logger.info('Loaded the parameters with shape {0}'.format(the_parameters.shape))
+      keys = [k for k in ('variables', 'parameters', 'aux') if k in loaded.files]
+      arrays = dict((k, loaded[k]) for k in keys)
+    for k in keys:
+      logger.info('Loaded the {0} with shape {1}'.format(k, arrays[k].shape))
   except:
     logger.error('Failed to load data from file: {0}'.format(filename))
+    raise
 
-  assert(the_variables.shape[0] == the_parameters.shape[0])
+  assert(arrays['variables'].shape[0] == arrays['parameters'].shape[0])
+  if 'aux' in arrays:
+    assert(arrays['variables'].shape[0] == arrays['aux'].shape[0])
 
-  encoder = create_encoder(the_variables, the_parameters)
-  x, y, dxy, dz, x_mask, x_road = encoder.get_x(), encoder.get_y(), \
-      encoder.get_dxy(), encoder.get_dz(), encoder.get_x_mask(), encoder.get_x_road()
+  if cache_dir is None:
+    encoded = encode_chunked(create_encoder, arrays['variables'], arrays['parameters'])
+    assert(np.isfinite(encoded['x']).all())
+    assert(np.isfinite(encoded['y']).all())
+    if 'aux' in arrays:
+      encoded['aux'] = arrays['aux']
+    return encoded
+
+  # Write into a temporary directory, which is renamed when complete
+  tmp_dir = cache_dir + '.tmp%i' % os.getpid()
+  try:
+    os.makedirs(tmp_dir)
+    encode_shard(arrays, create_encoder, tmp_dir)
+    os.rename(tmp_dir, cache_dir)
+    logger.info('Wrote encoded data to {0}'.format(cache_dir))
+  except:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not os.path.isdir(cache_dir):  # unless written by another job in the meantime
+      raise
+  return load_encoded(filename, create_encoder, use_cache=use_cache)
+
+
+# ______________________________________________________________________________
+def muon_data(filename, create_encoder, use_cache=True):
+  logger.info('Loading muon data from {0} ...'.format(filename))
+  encoded = load_encoded(filename, create_encoder, use_cache=use_cache)
+  x, y, dxy, dz, x_mask, x_road = encoded['x'], encoded['y'], \
+      encoded['dxy'], encoded['dz'], encoded['x_mask'], encoded['x_road']
   logger.info('Loaded the encoded variables with shape {0}'.format(x.shape))
   logger.info('Loaded the encoded parameters with shape {0}'.format(y.shape))
-  assert(np.isfinite(x).all())
-  assert(np.isfinite(y).all())
   return x, y, dxy, dz, x_mask, x_road
 
-def muon_data_split(filename, create_encoder, test_size=0.5, no_warn=True):
-  x, y, dxy, dz, x_mask, x_road = muon_data(filename, create_encoder)
+def muon_data_split(filename, create_encoder, test_size=0.5, no_warn=True, use_cache=True):
+  x, y, dxy, dz, x_mask, x_road = muon_data(filename, create_encoder, use_cache=use_cache)
 
   # Split dataset in training and testing
   x_train, x_test, y_train, y_test, dxy_train, dxy_test, dz_train, dz_test, \
@@ -54,34 +125,21 @@ def muon_data_split(filename, create_encoder, test_size=0.5, no_warn=True):
 
 
 # ______________________________________________________________________________
-def pileup_data(filename, create_encoder):
-  try:
-    logger.info('Loading pileup data from {0} ...'.format(filename))
-    with np.load(filename) as loaded:
-      the_variables = loaded['variables']
-      the_parameters = loaded['parameters']
-      aux = loaded['aux']
-    logger.info('Loaded the variables with shape {0}'.format(the_variables.shape))
-    logger.info('Loaded the auxiliary PU info with shape {0}'.format(aux.shape))
-  except:
-    logger.error('Failed to load data from file: {0}'.format(filename))
-
-  assert(the_variables.shape[0] == the_parameters.shape[0])
-  assert(the_variables.shape[0] == aux.shape[0])
+def pileup_data(filename, create_encoder, use_cache=True):
+  logger.info('Loading pileup data from {0} ...'.format(filename))
+  encoded = load_encoded(filename, create_encoder, use_cache=use_cache)
+  aux = encoded['aux']
   assert(aux.shape[1] == 4)  # jobid, ievt, highest_part_pt, highest_track_pt
 
-  encoder = create_encoder(the_variables, the_parameters)
-  x, y, dxy, dz, x_mask, x_road = encoder.get_x(), encoder.get_y(), \
-      encoder.get_dxy(), encoder.get_dz(), encoder.get_x_mask(), encoder.get_x_road()
+  x, y, dxy, dz, x_mask, x_road = encoded['x'], encoded['y'], \
+      encoded['dxy'], encoded['dz'], encoded['x_mask'], encoded['x_road']
   logger.info('Loaded the encoded variables with shape {0}'.format(x.shape))
   logger.info('Loaded the encoded parameters with shape {0}'.format(y.shape))
   logger.info('Loaded the encoded auxiliary PU info with shape {0}'.format(aux.shape))
-  assert(np.isfinite(x).all())
-  assert(np.isfinite(y).all())
   return x, y, dxy, dz, x_mask, x_road, aux
 
-def pileup_data_split(filename, create_encoder, test_job=159):
-  x, y, dxy, dz, x_mask, x_road, aux = pileup_data(filename, create_encoder)
+def pileup_data_split(filename, create_encoder, test_job=159, use_cache=True):
+  x, y, dxy, dz, x_mask, x_road, aux = pileup_data(filename, create_encoder, use_cache=use_cache)
 
   # Split dataset in training and testing
   split = aux[:,0].astype(np.int32) < test_job
@@ -138,3 +196,64 @@ def mix_training_inputs(x_train, y_train, pu_x_train, pu_y_train, tile=10):
 
   logger.info('Mixed muon data with pileup data. x_train_new has shape {0}, y_train_new has shape {1},{2}'.format(x_train_new.shape, y_train_new[0].shape, y_train_new[1].shape))
   return x_train_new, y_train_new
+
+class MixedBatches(object):
+  def __init__(self, x_train, y_train, pu_x_train, pu_y_train, batch_size=256, index_array=None, shuffle=True, seed=2026):
+    """Same mixing as mix_training_inputs(), without building the mixed arrays.
+
+    Each batch has batch_size//2 muon rows followed by as many pileup rows. The
+    muon row i is paired with the pileup row i % len(pu_x_train), like the tiled
+    pileup arrays. The rows are gathered when the batch is yielded, so the
+    memory does not grow with the dataset. The muon rows are shuffled by epoch
+    if shuffle, reproducibly for a given seed.
+    """
+    assert(len(y_train) == 2)
+    assert(len(pu_y_train) == 2)
+    assert(x_train.shape[0] == y_train[0].shape[0] == y_train[1].shape[0])
+    assert(pu_x_train.shape[0] == pu_y_train[0].shape[0] == pu_y_train[1].shape[0])
+    assert(pu_x_train.shape[0] > 0)
+    self.x_train, self.y_train = x_train, y_train
+    self.pu_x_train, self.pu_y_train = pu_x_train, pu_y_train
+    self.sample_batch_size = max(batch_size // 2, 1)
+    self.index_array = np.arange(x_train.shape[0]) if index_array is None else np.asarray(index_array)
+    self.shuffle = shuffle
+    self.seed = seed
+
+  def __len__(self):
+    """Number of batches per epoch."""
+    return (len(self.index_array) + self.sample_batch_size - 1) // self.sample_batch_size
+
+  def get_batch(self, batch_ids):
+    pu_batch_ids = batch_ids % self.pu_x_train.shape[0]
+    x = np.concatenate((self.x_train[batch_ids], self.pu_x_train[pu_batch_ids]))
+    y = [np.concatenate((self.y_train[i][batch_ids], self.pu_y_train[i][pu_batch_ids])) for i in range(2)]
+    return x, y
+
+  def epoch(self, iepoch=0):
+    """Yields the batches of an epoch."""
+    index_array = self.index_array
+    if self.shuffle:
+      index_array = index_array[np.random.RandomState(self.seed + iepoch).permutation(len(index_array))]
+    for start in range(0, len(index_array), self.sample_batch_size):
+      yield self.get_batch(index_array[start:start + self.sample_batch_size])
+
+  def __iter__(self):
+    """Yields the batches of all the epochs, as expected by fit_generator()."""
+    iepoch = 0
+    while True:
+      for batch in self.epoch(iepoch):
+        yield batch
+      iepoch += 1
+
+def mix_training_batches(x_train, y_train, pu_x_train, pu_y_train, batch_size=256, validation_split=0.1, seed=2026):
+  """Returns the training and validation MixedBatches, the last validation_split of the muon rows are used
+  for validation (like train_model(..., validation_split) on the mixed arrays)."""
+  num_samples = x_train.shape[0]
+  split_at = int(num_samples * (1. - validation_split))
+  index_array = np.arange(num_samples)
+  train = MixedBatches(x_train, y_train, pu_x_train, pu_y_train, batch_size=batch_size,
+                       index_array=index_array[:split_at], shuffle=True, seed=seed)
+  validation = MixedBatches(x_train, y_train, pu_x_train, pu_y_train, batch_size=batch_size,
+                            index_array=index_array[split_at:], shuffle=False, seed=seed)
+  logger.info('Mixing muon data with pileup data in batches of {0}. # of training and validation batches: {1}'.format(batch_size, (len(train), len(validation))))
+  return train, validation
@@ -151,47 +151,9 @@ class Encoder(object):
     return x
 
   def get_x(self, drop_columns_of_zeroes=True, drop_columns_emtf=True, drop_columns_omtf=False):
-    x_new = np.hstack((self.x_phi, self.x_theta, self.x_bend, self.x_qual, self.x_time))
-
-    # Drop input nodes
-    if drop_columns_of_zeroes:
-      drop_phi    = [nlayers*0 + x for x in xrange(0,0)]   # keep everyone
-      drop_theta  = [nlayers*1 + x for x in xrange(0,0)]   # keep everyone
-      drop_bend   = [nlayers*2 + x for x in xrange(5,11)]  # no bend for RPC, GEM
-      drop_qual   = [nlayers*3 + x for x in xrange(5,11)]  # no qual for RPC, GEM
-      drop_time   = [nlayers*4 + x for x in xrange(0,16)]  # no time for everyone
-
-      x_dropit = np.zeros(x_new.shape[1], dtype=np.bool)
-      for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
-        x_dropit[i] = True
-      x_new = x_new[:, ~x_dropit]
-
-    # Drop more input nodes (in EMTF mode)
-    if drop_columns_emtf:
-      drop_phi    = [nlayers*0 + x for x in [12,13,14,15]]  # drop MB1, MB2, MB3, MB4
-      drop_theta  = [nlayers*1 + x for x in [12,13,14,15]]  # drop MB1, MB2, MB3, MB4
-      drop_bend   = [nlayers*2 + x for x in [6,7,8,9]]      # drop MB1, MB2, MB3, MB4
-      drop_qual   = [nlayers*2 + x for x in [16,17,18,19]]  # drop MB1, MB2, MB3, MB4
-      drop_time   = [nlayers*2 + x for x in []]             # drop nothing
-      #
-      x_dropit = np.zeros(x_new.shape[1], dtype=np.bool)
-      for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
-        x_dropit[i] = True
-      x_new = x_new[:, ~x_dropit]
-
-    # Drop more input nodes (in OMTF mode)
+    x_columns = find_x_columns(drop_columns_of_zeroes, drop_columns_emtf, drop_columns_omtf)
+    x_new = self.x_copy[:, x_columns]
     if drop_columns_omtf:
-      drop_phi    = [nlayers*0 + x for x in [0,4,8,9,10,11,15]] # drop ME1/1, ME4, RE4, GE1/1, GE2/1, ME0, MB4
-      drop_theta  = [nlayers*1 + x for x in [0,4,8,9,10,11,15]] # drop ME1/1, ME4, RE4, GE1/1, GE2/1, ME0, MB4
-      drop_bend   = [nlayers*2 + x for x in [0,4,5,9]]          # drop ME1/1, ME4, ME0, MB4
-      drop_qual   = [nlayers*2 + x for x in [10,14,15,19]]      # drop ME1/1, ME4, ME0, MB4
-      drop_time   = [nlayers*2 + x for x in []]                 # drop nothing
-      #
-      x_dropit = np.zeros(x_new.shape[1], dtype=np.bool)
-      for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
-        x_dropit[i] = True
-      x_new = x_new[:, ~x_dropit]
-      #
       x_rsvd = np.zeros((x_new.shape[0],6), dtype=np.float32)
       x_new = np.hstack((x_new, x_rsvd))
     return x_new
@@ -225,9 +187,104 @@ class Encoder(object):
     return w_new
 
 
+# ______________________________________________________________________________
+# Columns of the input x that are kept by Encoder.get_x(), computed once for
+# each set of options
+_x_columns_cache = {}
+
+def find_x_columns(drop_columns_of_zeroes=True, drop_columns_emtf=True, drop_columns_omtf=False):
+  key = (drop_columns_of_zeroes, drop_columns_emtf, drop_columns_omtf)
+  if key in _x_columns_cache:
+    return _x_columns_cache[key]
+
+  # Same order as np.hstack((phi, theta, bend, qual, time))
+  x_columns = np.concatenate([np.arange(nlayers*i, nlayers*(i+1)) for i in (0, 1, 2, 3, 4)])
+
+  # Drop input nodes
+  if drop_columns_of_zeroes:
+    drop_phi    = [nlayers*0 + x for x in xrange(0,0)]   # keep everyone
+    drop_theta  = [nlayers*1 + x for x in xrange(0,0)]   # keep everyone
+    drop_bend   = [nlayers*2 + x for x in xrange(5,11)]  # no bend for RPC, GEM
+    drop_qual   = [nlayers*3 + x for x in xrange(5,11)]  # no qual for RPC, GEM
+    drop_time   = [nlayers*4 + x for x in xrange(0,16)]  # no time for everyone
+
+    x_dropit = np.zeros(x_columns.shape[0], dtype=np.bool)
+    for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
+      x_dropit[i] = True
+    x_columns = x_columns[~x_dropit]
+
+  # Drop more input nodes (in EMTF mode)
+  if drop_columns_emtf:
+    drop_phi    = [nlayers*0 + x for x in [12,13,14,15]]  # drop MB1, MB2, MB3, MB4
+    drop_theta  = [nlayers*1 + x for x in [12,13,14,15]]  # drop MB1, MB2, MB3, MB4
+    drop_bend   = [nlayers*2 + x for x in [6,7,8,9]]      # drop MB1, MB2, MB3, MB4
+    drop_qual   = [nlayers*2 + x for x in [16,17,18,19]]  # drop MB1, MB2, MB3, MB4
+    drop_time   = [nlayers*2 + x for x in []]             # drop nothing
+    #
+    x_dropit = np.zeros(x_columns.shape[0], dtype=np.bool)
+    for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
+      x_dropit[i] = True
+    x_columns = x_columns[~x_dropit]
+
+  # Drop more input nodes (in OMTF mode)
+  if drop_columns_omtf:
+    drop_phi    = [nlayers*0 + x for x in [0,4,8,9,10,11,15]] # drop ME1/1, ME4, RE4, GE1/1, GE2/1, ME0, MB4
+    drop_theta  = [nlayers*1 + x for x in [0,4,8,9,10,11,15]] # drop ME1/1, ME4, RE4, GE1/1, GE2/1, ME0, MB4
+    drop_bend   = [nlayers*2 + x for x in [0,4,5,9]]          # drop ME1/1, ME4, ME0, MB4
+    drop_qual   = [nlayers*2 + x for x in [10,14,15,19]]      # drop ME1/1, ME4, ME0, MB4
+    drop_time   = [nlayers*2 + x for x in []]                 # drop nothing
+    #
+    x_dropit = np.zeros(x_columns.shape[0], dtype=np.bool)
+    for i in drop_phi + drop_theta + drop_bend + drop_qual + drop_time:
+      x_dropit[i] = True
+    x_columns = x_columns[~x_dropit]
+
+  _x_columns_cache[key] = x_columns
+  return x_columns
+
 # ______________________________________________________________________________
 def create_encoder(x, y=None, reg_pt_scale=100., reg_dxy_scale=0.4):
   if y is None:
     y = np.zeros((x.shape[0], 1), dtype=np.float32)
   encoder = Encoder(x, y, reg_pt_scale, reg_dxy_scale)
   return encoder
+
+# ______________________________________________________________________________
+def encode_chunked(create_encoder, x, y=None, chunk_size=200000, out=None, x_kwargs=None):
+  """Runs the encoder chunk by chunk, and fills the results into full arrays.
+
+  Only one chunk of x (and y) is copied and transformed at a time, instead of
+  the full input. Works with any create_encoder (nn_encode, nn_encode_run3,
+  nn_encode_omtf, or a partial with different options).
+
+  Returns a dict with 'x', 'x_mask', 'x_road', and also 'y', 'dxy', 'dz' if y
+  is given. The arrays already in 'out' (e.g. preallocated buffers or memmaps)
+  are filled in place, the others are allocated after the first chunk.
+
+  x_kwargs maps output keys to get_x() options, e.g. {'x': {}, 'x_omtf':
+  dict(drop_columns_emtf=False, drop_columns_omtf=True)}, to get several
+  layouts of x from the same encoding.
+  """
+  if x_kwargs is None:
+    x_kwargs = {'x': {}}
+  getters = [(k, 'get_x', kwargs) for (k, kwargs) in sorted(x_kwargs.items())]
+  getters += [('x_mask', 'get_x_mask', {}), ('x_road', 'get_x_road', {})]
+  if y is not None:
+    assert(x.shape[0] == y.shape[0])
+    getters += [('y', 'get_y', {}), ('dxy', 'get_dxy', {}), ('dz', 'get_dz', {})]
+  if out is None:
+    out = {}
+
+  nentries = x.shape[0]
+  for start in (xrange(0, nentries, chunk_size) if nentries else [0]):
+    stop = min(start + chunk_size, nentries)
+    if y is None:
+      encoder = create_encoder(x[start:stop])
+    else:
+      encoder = create_encoder(x[start:stop], y[start:stop])
+    for (k, getter, kwargs) in getters:
+      value = getattr(encoder, getter)(**kwargs)
+      if k not in out:
+        out[k] = np.empty((nentries,) + value.shape[1:], dtype=value.dtype)
+      out[k][start:stop] = value
+  return out
@@ -4,33 +4,7 @@ logger = getLogger()
 # ______________________________________________________________________________
 # Globals
 
-mask_value = 100.
-
-reg_pt_scale = 100.
-reg_dxy_scale = 0.4
-
-discr_pt_cut_low = 4.
-discr_pt_cut_med = 8.
-discr_pt_cut_high = 14.
-
-discr_loss_weight = 20.
-
-l1_reg = 0.0
-l2_reg = 0.0
-
-infile_muon = '../test7/histos_tba.30.npz'
-infile_pileup = '../test7/histos_tbd.30.npz'
-infile_highpt = '../test7/histos_tbe.30.npz'
-infile_augmnt = '../test7/histos_tbf.30.npz'
-infile_displ = '../test7/histos_tba_displ.30.npz'
-
-infile_muon_run3 = '../test7/histos_tba_run3.27.npz'
-infile_pileup_run3 = '../test7/histos_tbd_run3.27.npz'
-infile_highpt_run3 = '../test7/histos_tbe_run3.27.npz'
-
-infile_muon_omtf = '../test7/histos_tba_omtf.27.npz'
-infile_pileup_omtf = '../test7/histos_tbd_omtf.27.npz'
-infile_highpt_omtf = '../test7/histos_tbe_omtf.27.npz'
+from nn_constants import *
 
 
 # ______________________________________________________________________________
@@ -0,0 +1,377 @@
+"""Parallel hyperparameter search with successive halving.
+
+nn_gridsearch.py trains every configuration fully, one after the other. Here,
+each trial (one set of hyperparameters) is trained in its own worker process,
+with a limited number of threads, so that several trials train at the same
+time on a multi-core machine. The trials are scheduled by successive halving:
+all of them are trained for min_epochs, the best 1/eta of them (by their last
+validation loss) are trained eta times longer, and so on until max_epochs. A
+trial resumes from the model saved at the end of its previous rung.
+
+The results of every rung of every trial (the loss and validation loss of each
+epoch) are appended to a JSON lines file. A search that is run again skips the
+rungs found in the file, so it can be resumed after a crash.
+
+The data are loaded once by the main process and shared by the workers after
+the fork, so TensorFlow is only imported by the workers.
+
+  python nn_search.py
+
+AsyncBayesSearch does a Bayesian optimization (with skopt) instead, see
+nn_skopt.py. Several points are evaluated at the same time, and the folds of
+the cross-validation of a point are trained in separate workers.
+"""
+
+import numpy as np
+
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from nn_logging import getLogger
+logger = getLogger()
+
+
+# ______________________________________________________________________________
+def limit_threads(nthreads):
+  """Limits the threads of the math libraries and of TensorFlow, to be called before importing Keras."""
+  for k in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ[k] = str(nthreads)
+  os.environ['KERAS_BACKEND'] = 'tensorflow'
+  import tensorflow as tf
+  from keras import backend as K
+  K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=nthreads, inter_op_parallelism_threads=nthreads, allow_soft_placement=True)))
+
+class TrialStore(object):
+  """Results of the trials, one JSON record per line."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.records = []
+    if os.path.exists(filename):
+      with open(filename) as f:
+        for line in f:
+          if line.strip():
+            self.records.append(json.loads(line))
+
+  def add(self, record):
+    with open(self.filename, 'a') as f:
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+    self.records.append(record)
+
+  def find(self, **kwargs):
+    return [r for r in self.records if all([r.get(k) == v for (k, v) in kwargs.items()])]
+
+
+# ______________________________________________________________________________
+# Data shared by the workers, set by set_search_data() before the pool is created
+search_data = None
+
+def set_search_data(x_train, y_train, pu_x_train, pu_y_train, validation_split=0.1):
+  global search_data
+  search_data = dict(x_train=x_train, y_train=y_train, pu_x_train=pu_x_train, pu_y_train=pu_y_train,
+                     validation_split=validation_split)
+
+def load_search_data(infile_muon, infile_pileup, create_encoder, mask_value=100., reg_pt_scale=100., discr_pt_cut_low=4.,
+                     test_size=0.31, test_job=159, validation_split=0.1):
+  """Loads the muon and pileup training data, with the targets of the (regr, discr) models."""
+  from nn_data import muon_data_split, pileup_data_split
+  x_train, x_test, y_train, y_test, dxy_train, dxy_test, dz_train, dz_test, \
+      x_mask_train, x_mask_test, x_road_train, x_road_test = \
+      muon_data_split(infile_muon, create_encoder, test_size=test_size)
+  pu_x_train, pu_x_test, pu_y_train, pu_y_test, pu_dxy_train, pu_dxy_test, pu_dz_train, pu_dz_test, \
+      pu_x_mask_train, pu_x_mask_test, pu_x_road_train, pu_x_road_test, pu_aux_train, pu_aux_test = \
+      pileup_data_split(infile_pileup, create_encoder, test_job=test_job)
+
+  # Add PU discrimator output node, the muons below discr_pt_cut_low are masked
+  labels = np.where(np.abs(1.0/y_train) >= discr_pt_cut_low/reg_pt_scale, 1., mask_value)
+  y_train = [y_train, labels.astype(np.float32)]
+
+  # Drop the pileup tracks matched to tracking particles, the regression is masked for pileup
+  keep = ~(pu_aux_train[:,2] > discr_pt_cut_low)
+  pu_x_train = pu_x_train[keep]
+  pu_y_train = [np.full(pu_x_train.shape[0], mask_value, dtype=np.float32), np.zeros(pu_x_train.shape[0], dtype=np.float32)]
+  set_search_data(x_train, y_train, pu_x_train, pu_y_train, validation_split=validation_split)
+
+def get_mixed_batches(batch_size, fold=None, nfolds=None):
+  # The last validation_split of the muon rows are used for validation, or
+  # the given fold out of nfolds consecutive folds (like KFold)
+  from nn_data import MixedBatches, mix_training_batches
+  arrays = (search_data['x_train'], search_data['y_train'], search_data['pu_x_train'], search_data['pu_y_train'])
+  if fold is None:
+    return mix_training_batches(*arrays, batch_size=batch_size, validation_split=search_data['validation_split'])
+  folds = np.array_split(np.arange(search_data['x_train'].shape[0]), nfolds)
+  train = MixedBatches(*arrays, batch_size=batch_size, index_array=np.concatenate(folds[:fold] + folds[fold+1:]), shuffle=True)
+  validation = MixedBatches(*arrays, batch_size=batch_size, index_array=folds[fold], shuffle=False)
+  return train, validation
+
+def train_trial(task):
+  """Trains a trial from initial_epoch to epochs, in a worker process. Returns its record.
+
+  The task is a dict with trial, params, initial_epoch, epochs, outdir and
+  nthreads, and optionally fold and nfolds. The other items are copied into
+  the record.
+  """
+  start_time = datetime.datetime.now()
+  limit_threads(task['nthreads'])
+  import nn_models
+  from nn_models import update_keras_custom_objects, lr_decay, terminate_on_nan
+  from nn_training import train_model
+  from keras.models import load_model
+
+  params = dict(task['params'])
+  build_fn = getattr(nn_models, params.pop('build_fn', 'create_model_bn2'))
+  batch_size = params.pop('batch_size', 256)
+  fold = task.get('fold')
+  model_name = os.path.join(task['outdir'], 'trial_%04i' % task['trial'])
+  if fold is not None:
+    model_name += '_fold%i' % fold
+  if task['initial_epoch'] > 0:
+    update_keras_custom_objects()
+    model = load_model(model_name + '.h5')
+  else:
+    model = build_fn(nvariables=search_data['x_train'].shape[1], **params)
+
+  train, validation = get_mixed_batches(batch_size, fold=fold, nfolds=task.get('nfolds'))
+  history = train_model(model, train, model_name=model_name, epochs=task['epochs'], initial_epoch=task['initial_epoch'], verbose=0,
+                        callbacks=[lr_decay, terminate_on_nan], steps_per_epoch=len(train),
+                        validation_data=validation, validation_steps=len(validation))
+
+  record = dict((k, v) for (k, v) in task.items() if k not in ('outdir', 'nthreads', 'initial_epoch'))
+  record['loss'] = [float(v) for v in history.history['loss']]
+  record['val_loss'] = [float(v) for v in history.history['val_loss']]
+  record['seconds'] = (datetime.datetime.now() - start_time).total_seconds()
+  return record
+
+def get_score(record):
+  # Last validation loss, the trials that diverged are ranked last
+  val_loss = record['val_loss'][-1] if record['val_loss'] else np.nan
+  return val_loss if np.isfinite(val_loss) else np.inf
+
+
+# ______________________________________________________________________________
+class SuccessiveHalving(object):
+  def __init__(self, param_grid, outdir='nn_search', min_epochs=5, max_epochs=100, eta=3, nworkers=None, nthreads=1):
+    self.trials = [dict(zip(sorted(param_grid), values)) for values in
+                   itertools.product(*[param_grid[k] for k in sorted(param_grid)])]
+    self.outdir = outdir
+    self.min_epochs = min_epochs
+    self.max_epochs = max_epochs
+    self.eta = eta
+    self.nthreads = nthreads
+    self.nworkers = nworkers or max(multiprocessing.cpu_count() // nthreads, 1)
+    if not os.path.exists(outdir):
+      os.makedirs(outdir)
+    self.store = TrialStore(os.path.join(outdir, 'trials.jsonl'))
+
+  def get_rungs(self):
+    # Total number of epochs at the end of each rung
+    rungs = []
+    epochs = self.min_epochs
+    while epochs < self.max_epochs:
+      rungs.append(epochs)
+      epochs *= self.eta
+    rungs.append(self.max_epochs)
+    return rungs
+
+  def run_rung(self, rung, trial_ids, initial_epoch, epochs):
+    # Returns the records of the trials, the ones already in the store are not trained again
+    records = {}
+    tasks = []
+    for trial_id in trial_ids:
+      found = self.store.find(trial=trial_id, rung=rung)
+      if found:
+        if found[-1]['params'] != self.trials[trial_id]:
+          raise ValueError('The trial store has different parameters for trial {0}'.format(trial_id))
+        records[trial_id] = found[-1]
+      else:
+        tasks.append(dict(trial=trial_id, params=self.trials[trial_id], rung=rung, initial_epoch=initial_epoch,
+                          epochs=epochs, outdir=self.outdir, nthreads=self.nthreads))
+    logger.info('Rung {0}: training {1} trials up to epoch {2}, {3} found in the store'.format(
+        rung, len(tasks), epochs, len(records)))
+
+    # Each trial gets a new worker process
+    pool = multiprocessing.Pool(processes=self.nworkers, maxtasksperchild=1)
+    try:
+      for record in pool.imap_unordered(train_trial, tasks, chunksize=1):
+        self.store.add(record)
+        records[record['trial']] = record
+        logger.info('Trial {0} rung {1}: val_loss {2:.5f} in {3:.0f} s with {4}'.format(
+            record['trial'], rung, get_score(record), record['seconds'], record['params']))
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    return records
+
+  def run(self):
+    trial_ids = list(range(len(self.trials)))
+    initial_epoch = 0
+    for (rung, epochs) in enumerate(self.get_rungs()):
+      records = self.run_rung(rung, trial_ids, initial_epoch, epochs)
+      ranked = sorted(trial_ids, key=lambda trial_id: (get_score(records[trial_id]), trial_id))
+      if epochs < self.max_epochs:
+        trial_ids = ranked[:max(len(ranked) // self.eta, 1)]
+      initial_epoch = epochs
+    return [records[trial_id] for trial_id in ranked]
+
+
+# ______________________________________________________________________________
+def to_builtin(v):
+  # numpy scalars (e.g. from skopt) cannot be dumped to JSON
+  return v.item() if hasattr(v, 'item') else v
+
+class AsyncBayesSearch(object):
+  def __init__(self, space, outdir='nn_skopt', n_calls=50, n_initial_points=10, nfolds=3, nparallel=None,
+               nthreads=1, epochs=25, fixed_params=None, failed_score=1e3, random_state=0):
+    """Bayesian optimization with skopt's ask/tell interface, keeping up to
+    nparallel points in flight.
+
+    space is a list of named skopt dimensions, fixed_params are added to the
+    params of every point. The score of a point is the mean over the folds of
+    the last validation loss. The points that are still being evaluated are
+    told to a copy of the optimizer with the lowest score so far as their
+    score (the constant liar strategy), so that the next point asked is a
+    different one. The points whose training diverged get failed_score.
+    """
+    import skopt
+    self.space = space
+    self.names = [dim.name for dim in space]
+    self.outdir = outdir
+    self.n_calls = n_calls
+    self.nfolds = nfolds
+    self.nthreads = nthreads
+    self.nparallel = nparallel or max(multiprocessing.cpu_count() // (nthreads * nfolds), 1)
+    self.epochs = epochs
+    self.fixed_params = fixed_params or {}
+    self.failed_score = failed_score
+    self.optimizer = skopt.Optimizer(space, base_estimator='GP', n_initial_points=n_initial_points,
+                                     random_state=random_state)
+    self.result = None
+    self.x_iters = []
+    self.func_vals = []
+    if not os.path.exists(outdir):
+      os.makedirs(outdir)
+    self.store = TrialStore(os.path.join(outdir, 'trials.jsonl'))
+
+  def get_params(self, x):
+    params = dict(self.fixed_params)
+    params.update(zip(self.names, x))
+    return params
+
+  def get_tasks(self, trial_id, x, folds):
+    return [dict(trial=trial_id, x=x, params=self.get_params(x), fold=fold, nfolds=self.nfolds, initial_epoch=0,
+                 epochs=self.epochs, outdir=self.outdir, nthreads=self.nthreads) for fold in folds]
+
+  def tell(self, x, y):
+    if not np.isfinite(y):
+      y = self.failed_score
+    self.x_iters.append(x)
+    self.func_vals.append(y)
+    self.result = self.optimizer.tell(x, y)
+
+  def ask(self, pending):
+    if not pending or not self.func_vals:
+      return [to_builtin(v) for v in self.optimizer.ask()]
+    optimizer = self.optimizer.copy(random_state=self.optimizer.rng)
+    for x in pending:
+      optimizer.tell(x, min(self.func_vals))
+    return [to_builtin(v) for v in optimizer.ask()]
+
+  def resume(self):
+    # Tells the completed points to the optimizer, returns the points with missing folds
+    trials = {}
+    for record in self.store.records:
+      trials.setdefault(record['trial'], {})[record['fold']] = record
+    incomplete = {}
+    for trial_id in sorted(trials):
+      records = trials[trial_id]
+      x = list(records.values())[0]['x']
+      if len(records) == self.nfolds:
+        self.tell(x, np.mean([get_score(records[fold]) for fold in range(self.nfolds)]))
+      else:
+        incomplete[trial_id] = (x, records)
+    logger.info('Found {0} points in the store, {1} of them incomplete'.format(len(self.func_vals), len(incomplete)))
+    return incomplete
+
+  def run(self):
+    trials = self.resume()  # trial_id -> (x, records of the done folds)
+    next_trial_id = max([r['trial'] for r in self.store.records] + [-1]) + 1
+    in_flight = []  # (task, async result)
+
+    pool = multiprocessing.Pool(processes=self.nparallel * self.nfolds, maxtasksperchild=1)
+    try:
+      for (trial_id, (x, records)) in sorted(trials.items()):
+        for task in self.get_tasks(trial_id, x, [fold for fold in range(self.nfolds) if fold not in records]):
+          in_flight.append((task, pool.apply_async(train_trial, (task,))))
+
+      while len(self.func_vals) < self.n_calls or trials:
+        # Ask for new points while there are free slots
+        while len(trials) < self.nparallel and len(self.func_vals) + len(trials) < self.n_calls:
+          x = self.ask([x for (x, records) in trials.values()])
+          trials[next_trial_id] = (x, {})
+          for task in self.get_tasks(next_trial_id, x, range(self.nfolds)):
+            in_flight.append((task, pool.apply_async(train_trial, (task,))))
+          logger.info('Trial {0}: evaluating {1}'.format(next_trial_id, self.get_params(x)))
+          next_trial_id += 1
+
+        done = [(task, result) for (task, result) in in_flight if result.ready()]
+        if not done:
+          time.sleep(1)
+          continue
+        for (task, result) in done:
+          in_flight.remove((task, result))
+          record = result.get()  # raises the error of the worker, if any
+          self.store.add(record)
+          (x, records) = trials[record['trial']]
+          records[record['fold']] = record
+          if len(records) == self.nfolds:
+            del trials[record['trial']]
+            scores = [get_score(records[fold]) for fold in range(self.nfolds)]
+            self.tell(x, np.mean(scores))
+            logger.info('Trial {0}: score {1:.5f} +/- {2:.5f} in {3:.0f} s with {4}'.format(
+                record['trial'], np.mean(scores), np.std(scores), max([r['seconds'] for r in records.values()]),
+                record['params']))
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    return self.result
+
+
+# ______________________________________________________________________________
+if __name__ == '__main__':
+  from functools import partial
+  from nn_encode import create_encoder
+
+  # Not from nn_globals.py, which imports TensorFlow before the workers are forked
+  from nn_constants import reg_pt_scale, reg_dxy_scale, mask_value, discr_pt_cut_low, discr_loss_weight, \
+                           infile_muon, infile_pileup
+
+  param_grid = dict(
+    build_fn=['create_model_bn2'],
+    lr=[0.001, 0.01, 0.1],
+    batch_size=[256, 1024, 4096],
+    nodes1=[30, 60], nodes2=[25], nodes3=[20],
+    discr_loss_weight=[discr_loss_weight],
+  )
+  logger.info('Using parameter grid: %r' % param_grid)
+
+  load_search_data(infile_muon, infile_pileup, partial(create_encoder, reg_pt_scale=reg_pt_scale, reg_dxy_scale=reg_dxy_scale),
+                   mask_value=mask_value, reg_pt_scale=reg_pt_scale, discr_pt_cut_low=discr_pt_cut_low)
+
+  search = SuccessiveHalving(param_grid, outdir='nn_search', min_epochs=5, max_epochs=100, eta=3, nthreads=2)
+  results = search.run()
+
+  for record in results:
+    print('%f after %i epochs with: %r' % (get_score(record), record['epochs'], record['params']))
+  logger.info('DONE')
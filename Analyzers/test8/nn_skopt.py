@@ -17,53 +17,51 @@ cd ../..
 
 
 # ______________________________________________________________________________
-from nn_globals import *
+# The points are evaluated by AsyncBayesSearch (see nn_search.py): up to
+# nparallel points are trained at the same time, with the 3 folds of each point
+# in separate workers. The folds are appended to nn_skopt/trials.jsonl when
+# done, so the search is resumed by running it again, and extended by raising
+# n_calls.
 
-from nn_encode import nlayers, nvariables
+import os
+from functools import partial
 
-from nn_data import muon_data, pileup_data, muon_data_split, pileup_data_split, \
-                    mix_training_inputs
+from nn_encode import create_encoder
 
-from nn_models import create_model, create_model_bn, \
-                      create_model_sequential, create_model_sequential_regularized, \
-                      lr_decay, modelbestcheck, modelbestcheck_weights
+from nn_search import load_search_data, AsyncBayesSearch
 
-from nn_training import train_model, train_model_sequential
+from nn_logging import getLogger
+logger = getLogger()
 
-
-# ______________________________________________________________________________
 import skopt
 logger.info('Using skopt {0}'.format(skopt.__version__))
 
+# Not from nn_globals.py, which imports TensorFlow before the workers are forked
+import nn_constants
+from nn_constants import reg_pt_scale, reg_dxy_scale, mask_value, discr_pt_cut_low, discr_loss_weight
+
+learning_rate = 0.001
+
 use_hpe = ('SLURM_JOB_ID' in os.environ)
 
 if use_hpe:
   infile_muon = '/scratch/CMS/L1MuonTrigger/P2_10_1_5/SingleMuon_Toy_2GeV/histos_tba.16.npz'
   infile_pileup = '/scratch/CMS/L1MuonTrigger/P2_10_1_5/SingleMuon_Toy_2GeV/histos_tbd.16.npz'
+else:
+  infile_muon = nn_constants.infile_muon
+  infile_pileup = nn_constants.infile_pileup
 
 
 # ______________________________________________________________________________
-# Import muon data
-x_train, x_test, y_train, y_test, w_train, w_test, x_mask_train, x_mask_test = \
-    muon_data_split(infile_muon, adjust_scale=adjust_scale, reg_pt_scale=reg_pt_scale, test_size=0.3)
-
-# ______________________________________________________________________________
-# Create KerasRegressor
+# Import muon and pileup data
 
-from nn_models import NewKerasRegressor
-estimator = NewKerasRegressor(build_fn=create_model_sequential, reg_pt_scale=reg_pt_scale,
-                              min_pt=20., max_pt=22., coverage=90.,
-                              nvariables=nvariables, lr=learning_rate, l1_reg=l1_reg, l2_reg=l2_reg,
-                              epochs=25, batch_size=256, verbose=0)
-callbacks_list = [lr_decay,modelbestcheck]
+load_search_data(infile_muon, infile_pileup, partial(create_encoder, reg_pt_scale=reg_pt_scale, reg_dxy_scale=reg_dxy_scale),
+                 mask_value=mask_value, reg_pt_scale=reg_pt_scale, discr_pt_cut_low=discr_pt_cut_low)
 
 # ______________________________________________________________________________
-# Create Objective
+# Create search
 
-from sklearn.model_selection import cross_val_score, cross_validate, KFold
-from sklearn.metrics import mean_squared_error
-from skopt.space import Space, Real, Integer, Categorical
-from skopt.utils import use_named_args
+from skopt.space import Integer, Categorical
 
 space = [
   #Real(1e-4, 1e-1, prior='log-uniform', name='lr'),
@@ -73,42 +71,16 @@ space = [
   Integer(4, 128, name='nodes3'),
 ]
 
-@use_named_args(space)
-def objective(**params):
-  estimator.set_params(**params)
-
-  #scores = cross_val_score(estimator, x_train, y_train, scoring='neg_mean_squared_error', cv=KFold(3),
-  #                         n_jobs=1, verbose=0, fit_params=dict(callbacks=callbacks_list))
+fixed_params = dict(build_fn='create_model_bn2', lr=learning_rate, discr_loss_weight=discr_loss_weight)
 
-  cv_results = cross_validate(estimator, x_train, y_train, scoring={'score': 'neg_mean_squared_error'}, cv=KFold(3),
-                              n_jobs=1, verbose=0, fit_params=dict(callbacks=callbacks_list), return_train_score=False)
-  scores = cv_results['test_score']
-
-  print("score: {0} +/- {1} with {2}".format(np.mean(scores), np.std(scores), params))
-  return -np.mean(scores)
+search = AsyncBayesSearch(space, outdir='nn_skopt', n_calls=50, n_initial_points=12, nfolds=3, nthreads=2, epochs=25,
+                          fixed_params=fixed_params, random_state=0)
 
 
 # ______________________________________________________________________________
 # Fit
 
-debug = False
-
-if debug:
-  estimator.model = estimator.build_fn(**estimator.filter_sk_params(estimator.build_fn))
-
-  from keras.models import Sequential
-  fit_args = estimator.filter_sk_params(Sequential.fit)
-  print fit_args
-
-  history = estimator.model.fit(x_train, y_train, **fit_args)
-  print history.history
-
-  print estimator.score(x_test, y_test)
-  print
-
-else:
-  #res_gp = skopt.gp_minimize(objective, space, n_calls=50, random_state=0, n_random_starts=12, verbose=True)
-  res_gp = skopt.gp_minimize(objective, space, n_calls=1, random_state=0, n_random_starts=1, verbose=True)
+res_gp = search.run()
 
 
 # ______________________________________________________________________________
@@ -0,0 +1,239 @@
+"""Streaming training data, read from memory-mapped shards.
+
+muon_data() and pileup_data() load the full arrays and encode them before the
+training starts, so the number of roads is bounded by the memory. Here, the
+npz file is first converted into shards of uncompressed .npy files (without
+loading the full arrays):
+
+  write_shards('muon.npz', 'muon_shards')
+
+StreamingData reads the shards as memory maps, and yields the batches of an
+epoch block by block: the blocks (block_size consecutive rows of a shard) are
+visited in a random order, and the rows of a block are shuffled. Each block is
+read, encoded and checked in a background thread, a few blocks ahead of the
+training. The shards can also hold encoded arrays (see encode_shards()), then
+the blocks are only read.
+
+  data = StreamingData(ShardedData('muon_shards'), create_encoder, batch_size=256)
+  history = train_model(model, data, model_name='model', epochs=epochs, steps_per_epoch=len(data))
+"""
+
+import numpy as np
+
+import glob
+import os
+import zipfile
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from nn_encode import encode_chunked
+
+from nn_logging import getLogger
+logger = getLogger()
+
+
+# ______________________________________________________________________________
+def iter_npz_chunks(filename, key, chunk_size):
+  """Reads an array of the npz file chunk by chunk of rows, without loading it fully."""
+  with zipfile.ZipFile(filename) as zf:
+    f = zf.open(key + '.npy')
+    try:
+      version = np.lib.format.read_magic(f)
+      if version == (1, 0):
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+      else:
+        (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+      assert(not fortran_order and not dtype.hasobject)
+      row_shape = shape[1:]
+      row_bytes = dtype.itemsize * int(np.prod(row_shape))
+      for start in range(0, shape[0], chunk_size):
+        stop = min(start + chunk_size, shape[0])
+        buf = f.read((stop - start) * row_bytes)
+        yield np.frombuffer(buf, dtype=dtype).reshape((stop - start,) + row_shape)
+    finally:
+      f.close()
+
+def write_shards(filename, outdir, shard_size=1000000):
+  """Converts the arrays of the npz file into shards of .npy files, e.g. outdir/shard_0000/variables.npy."""
+  with zipfile.ZipFile(filename) as zf:
+    keys = [name[:-4] for name in zf.namelist() if name.endswith('.npy')]
+  nshards = 0
+  for key in keys:
+    for (i, chunk) in enumerate(iter_npz_chunks(filename, key, shard_size)):
+      shard_dir = os.path.join(outdir, 'shard_%04i' % i)
+      if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+      np.save(os.path.join(shard_dir, key + '.npy'), chunk)
+      nshards = max(nshards, i + 1)
+  logger.info('Wrote {0} shards of {1} to {2}'.format(nshards, filename, outdir))
+  return ShardedData(outdir)
+
+def encode_shards(data, create_encoder, outdir):
+  """Encodes the 'variables' and 'parameters' of each shard into outdir, with the 'aux' if any."""
+  for (i, arrays) in enumerate(data.shards):
+    shard_dir = os.path.join(outdir, 'shard_%04i' % i)
+    if not os.path.exists(shard_dir):
+      os.makedirs(shard_dir)
+    encode_shard(arrays, create_encoder, shard_dir)
+  logger.info('Encoded {0} shards to {1}'.format(len(data.shards), outdir))
+  return ShardedData(outdir)
+
+def encode_shard(arrays, create_encoder, shard_dir):
+  # The encoded arrays are filled in place as memory maps
+  variables, parameters = arrays['variables'], arrays['parameters']
+  encoder = create_encoder(variables[:1], parameters[:1])
+  out = {}
+  for (k, getter) in [('x', 'get_x'), ('x_mask', 'get_x_mask'), ('x_road', 'get_x_road'),
+                      ('y', 'get_y'), ('dxy', 'get_dxy'), ('dz', 'get_dz')]:
+    value = getattr(encoder, getter)()
+    out[k] = np.lib.format.open_memmap(os.path.join(shard_dir, k + '.npy'), mode='w+', dtype=value.dtype,
+                                       shape=(len(variables),) + value.shape[1:])
+  encode_chunked(create_encoder, variables, parameters, out=out)
+  for (k, value) in out.items():
+    if k in ('x', 'y'):
+      assert(np.isfinite(value).all())
+    value.flush()
+  if 'aux' in arrays:
+    np.save(os.path.join(shard_dir, 'aux.npy'), arrays['aux'])
+
+class ShardedData(object):
+  def __init__(self, dirname):
+    self.dirname = dirname
+    self.shards = []
+    for shard_dir in sorted(glob.glob(os.path.join(dirname, 'shard_*'))):
+      arrays = {}
+      for f in sorted(glob.glob(os.path.join(shard_dir, '*.npy'))):
+        arrays[os.path.basename(f)[:-4]] = np.load(f, mmap_mode='r')
+      sizes = set([a.shape[0] for a in arrays.values()])
+      if len(sizes) != 1:
+        raise ValueError('Arrays with different numbers of rows in shard: {0}'.format(shard_dir))
+      self.shards.append(arrays)
+    if not self.shards:
+      raise ValueError('Cannot find any shard in: {0}'.format(dirname))
+    self.keys = sorted(self.shards[0].keys())
+
+  def __len__(self):
+    return sum([self.shard_size(i) for i in range(len(self.shards))])
+
+  def shard_size(self, i):
+    return self.shards[i][self.keys[0]].shape[0]
+
+  def get_blocks(self, block_size):
+    """Returns the blocks as (shard, start, stop)."""
+    blocks = []
+    for i in range(len(self.shards)):
+      n = self.shard_size(i)
+      blocks += [(i, start, min(start + block_size, n)) for start in range(0, n, block_size)]
+    return blocks
+
+  def read_block(self, block):
+    (i, start, stop) = block
+    return dict((k, np.array(a[start:stop])) for (k, a) in self.shards[i].items())
+
+
+# ______________________________________________________________________________
+def split_blocks(blocks, test_size=0.5, seed=2026):
+  """Splits the blocks randomly in training and testing blocks."""
+  index_array = np.random.RandomState(seed).permutation(len(blocks))
+  ntest = int(round(len(blocks) * test_size))
+  return [blocks[i] for i in sorted(index_array[ntest:])], [blocks[i] for i in sorted(index_array[:ntest])]
+
+def get_x_y(arrays):
+  return arrays['x'], arrays['y']
+
+def prefetch(func, items, nthreads=2, depth=4):
+  """Calls func on the items in background threads, and yields the results in
+  the order of the items, computing at most depth results ahead."""
+  pool = ThreadPool(nthreads)
+  try:
+    pending = deque()
+    for item in items:
+      pending.append(pool.apply_async(func, (item,)))
+      if len(pending) >= depth:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+
+class StreamingData(object):
+  def __init__(self, data, create_encoder=None, batch_size=128, block_size=65536, blocks=None,
+               select=None, get_xy=get_x_y, shuffle=True, seed=2026, nthreads=2, depth=4):
+    """Batches of the blocks of data (all the blocks if blocks is None).
+
+    create_encoder encodes the 'variables' and 'parameters' of each block. If
+    None, the shards already hold the encoded arrays. select gives the rows to
+    keep from the arrays of a block (e.g. by 'aux'), as a boolean mask or
+    indices. It is also given the memory-mapped arrays of each block to count
+    the batches, so it should only read the arrays it needs. get_xy gives
+    (x, y) of a batch from the encoded arrays, e.g. (x, [y, dxy]).
+    """
+    self.data = data
+    self.create_encoder = create_encoder
+    self.batch_size = batch_size
+    self.blocks = data.get_blocks(block_size) if blocks is None else blocks
+    self.select = select
+    self.get_xy = get_xy
+    self.shuffle = shuffle
+    self.seed = seed
+    self.nthreads = nthreads
+    self.depth = depth
+    self.block_sizes = None  # after selection, known once all the blocks are read
+    if select is None:
+      self.block_sizes = [stop - start for (i, start, stop) in self.blocks]
+
+  def __len__(self):
+    """Number of batches per epoch."""
+    if self.block_sizes is None:
+      self.block_sizes = [self.count_selected(block) for block in self.blocks]
+    return sum([(n + self.batch_size - 1) // self.batch_size for n in self.block_sizes])
+
+  def count_selected(self, block):
+    # Number of rows kept by select, without reading the whole block nor encoding it
+    (i, start, stop) = block
+    selected = np.asarray(self.select(dict((k, a[start:stop]) for (k, a) in self.data.shards[i].items())))
+    return int(np.count_nonzero(selected)) if selected.dtype == np.bool_ else len(selected)
+
+  def load_block(self, block, rng=None):
+    arrays = self.data.read_block(block)
+    if self.select is not None:
+      selected = self.select(arrays)
+      arrays = dict((k, a[selected]) for (k, a) in arrays.items())
+    if rng is not None:
+      index_array = rng.permutation(len(arrays[self.data.keys[0]]))
+      arrays = dict((k, a[index_array]) for (k, a) in arrays.items())
+    if self.create_encoder is not None:
+      encoded = encode_chunked(self.create_encoder, arrays.pop('variables'), arrays.pop('parameters'))
+      assert(np.isfinite(encoded['x']).all())
+      assert(np.isfinite(encoded['y']).all())
+      arrays.update(encoded)
+    return arrays
+
+  def load_batches(self, args):
+    (block, block_seed) = args
+    rng = np.random.RandomState(block_seed) if self.shuffle else None
+    arrays = self.load_block(block, rng)
+    n = len(arrays['x'])
+    batches = []
+    for start in range(0, n, self.batch_size):
+      stop = min(start + self.batch_size, n)
+      batches.append(self.get_xy(dict((k, a[start:stop]) for (k, a) in arrays.items())))
+    return batches
+
+  def epoch(self, iepoch=0):
+    """Yields the batches of an epoch."""
+    rng = np.random.RandomState(self.seed + iepoch)
+    order = rng.permutation(len(self.blocks)) if self.shuffle else np.arange(len(self.blocks))
+    block_seeds = rng.randint(0, 2**31 - 1, size=len(self.blocks))
+    args = [(self.blocks[i], block_seeds[i]) for i in order]
+    for batches in prefetch(self.load_batches, args, nthreads=self.nthreads, depth=self.depth):
+      for batch in batches:
+        yield batch
+
+  def __iter__(self):
+    """Yields the batches of all the epochs, as expected by fit_generator()."""
+    iepoch = 0
+    while True:
+      for batch in self.epoch(iepoch):
+        yield batch
+      iepoch += 1
@@ -17,7 +17,11 @@ class TrainingLog(object):
     import tempfile
     keras_logs = 'keras_logs'
     if not os.path.exists(keras_logs):
-      os.makedirs(keras_logs)
+      try:
+        os.makedirs(keras_logs)
+      except OSError:  # created by another process in the meantime
+        if not os.path.isdir(keras_logs):
+          raise
     fd, name = tempfile.mkstemp(suffix='.txt', prefix='keras_output_', dir=keras_logs, text=True)
     self.file = os.fdopen(fd, 'w')
     self.name = name
@@ -35,14 +39,24 @@ class TrainingLog(object):
 
 
 # ______________________________________________________________________________
-def train_model(model, x, y, model_name='model', batch_size=None, epochs=1, verbose=1, callbacks=None,
-                validation_split=0., shuffle=True, class_weight=None, sample_weight=None):
+def train_model(model, x, y=None, model_name='model', batch_size=None, epochs=1, verbose=1, callbacks=None,
+                validation_split=0., shuffle=True, class_weight=None, sample_weight=None,
+                steps_per_epoch=None, validation_data=None, validation_steps=None, initial_epoch=0):
   start_time = datetime.datetime.now()
   logger.info('Begin training ...')
 
   with TrainingLog() as tlog:  # redirect sys.stdout
-    history = model.fit(x, y, batch_size=batch_size, epochs=epochs, verbose=verbose, callbacks=callbacks,
-                        validation_split=validation_split, shuffle=shuffle, class_weight=class_weight, sample_weight=sample_weight)
+    if steps_per_epoch is None:
+      history = model.fit(x, y, batch_size=batch_size, epochs=epochs, verbose=verbose, callbacks=callbacks,
+                          validation_split=validation_split, validation_data=validation_data, shuffle=shuffle,
+                          class_weight=class_weight, sample_weight=sample_weight, initial_epoch=initial_epoch)
+    else:
+      # x yields the batches of all the epochs, e.g. a StreamingData (see nn_stream.py)
+      if validation_data is not None and not isinstance(validation_data, tuple):
+        validation_data = iter(validation_data)
+      history = model.fit_generator(iter(x), steps_per_epoch=steps_per_epoch, epochs=epochs, verbose=verbose, callbacks=callbacks,
+                                    validation_data=validation_data, validation_steps=validation_steps, class_weight=class_weight,
+                                    initial_epoch=initial_epoch)
 
   logger.info('Done training. Time elapsed: {0} sec'.format(str(datetime.datetime.now() - start_time)))
 